@@ -0,0 +1,182 @@
+"""Measure the overhead of the crawl loop offline.
+
+The real Crawler, TorController, Visit and manifest code run against a fake
+tor binary (benchmarks/fake_tor.py), a fake Tor Browser driver and a fake
+capture, with the sleep constants of helper.utils scaled down. The report
+compares the time spent in each visit phase with the sleeps and fake delays
+it contains; what is left is the crawler's own overhead.
+
+    python -m benchmarks.crawl_benchmark --visits 20 --json bench.json
+    python -m benchmarks.crawl_benchmark --visits 20 --baseline bench.json
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+from stem.control import Controller
+
+from benchmarks.fakes import FAKE_CLIENT_IP, FakeSniffer, FakeTorBrowserDriver, make_fake_tbb
+from helper import utils
+from models import crawler as crawler_module
+from models import session as session_module
+from models import visit as visit_module
+from models.crawler import Crawler
+from models.manifest import Manifest
+from models.torstate import TOR_STATE_MODES
+
+SCALED_SLEEPS = ('WAIT_AFTER_DUMP', 'INTERVAL_BETWEEN_VISIT', 'WAIT_FOR_VISIT', 'WAIT_FOR_VISIT_ONION',
+                 'INTERVAL_WHEN_TOR_LAUNCH_ERROR', 'DEMUX_GRACE')
+
+
+def scale_sleeps(scale):
+    for name in SCALED_SLEEPS:
+        setattr(utils, name, getattr(utils, name) * scale)
+    get_newnym_wait = Controller.get_newnym_wait  # Tor's rate limit of NEWNYM between the visits of a block
+    Controller.get_newnym_wait = lambda self: get_newnym_wait(self) * scale
+
+
+def install_fakes(page_load_time, packet_rate):
+    FakeTorBrowserDriver.page_load_time = page_load_time
+    FakeSniffer.packet_rate = packet_rate
+    visit_module.TorBrowserDriver = FakeTorBrowserDriver
+    session_module.TorBrowserDriver = FakeTorBrowserDriver
+    visit_module.get_sniffer = lambda backend=None, **kwargs: FakeSniffer(**kwargs)
+
+
+def time_record_visit(record_times):
+    record_visit = crawler_module.Crawler.record_visit
+
+    def timed_record_visit(self, *args, **kwargs):
+        start = time.perf_counter()
+        record_visit(self, *args, **kwargs)
+        record_times.append(time.perf_counter() - start)
+    crawler_module.Crawler.record_visit = timed_record_visit
+
+
+def get_dir_usage(path):
+    files = size = 0
+    for root, _, names in os.walk(path):
+        for name in names:
+            files += 1
+            size += os.path.getsize(os.path.join(root, name))
+    return files, size
+
+
+def run_benchmark(args, work_dir):
+    os.environ['FAKE_TOR_BOOTSTRAP'] = str(args.bootstrap_time)
+    utils.USED_SOCKS_PORT, utils.USED_CONTROL_PORT = args.base_port, args.base_port + 1
+    utils.TOR_DATA_DIR = os.path.join(work_dir, 'tor-data')
+    utils.MY_IP = FAKE_CLIENT_IP
+    scale_sleeps(args.scale)
+    install_fakes(args.page_load_time, args.packet_rate)
+    record_times = []
+    time_record_visit(record_times)
+
+    tbb_path = make_fake_tbb(work_dir)
+    torrc_dir = utils.create_dir(os.path.join(work_dir, 'torrc'))
+    for i in range(args.torrcs):
+        with open(os.path.join(torrc_dir, 'torrc-{}'.format(i)), 'w') as fp:
+            fp.write('CircuitBuildTimeout {}\n'.format(60 + i))
+    torrc_paths = [os.path.join(torrc_dir, name) for name in sorted(os.listdir(torrc_dir))]
+    urls = ['site{}.example'.format(i) for i in range(args.visits)]
+
+    crawler = Crawler(torrc_paths, urls, [], False, tbb_path, os.path.join(work_dir, 'output'),
+                      screenshot=args.screenshot, tor_pool_size=args.tor_pool,
+                      profile_pool_size=args.profile_pool, tor_state_mode=args.tor_state,
+                      browser_restart_every=args.persistent_browser, pipeline=args.pipeline,
+                      snaplen=args.snaplen, compress=args.compress,
+                      screen_check=args.screen_check, bad_screens=args.bad_screens,
+                      torrc_block=args.torrc_block)
+    start = time.monotonic()
+    try:
+        crawler.crawl(args.batches)
+    finally:
+        crawler.stop_crawl()
+    elapsed = time.monotonic() - start
+
+    records = list(Manifest(crawler.crawl_dir).read())
+    files, size = get_dir_usage(crawler.crawl_dir)
+    expected = {'capture_start': utils.WAIT_AFTER_DUMP, 'page_open': args.page_load_time,
+                'dwell': utils.WAIT_FOR_VISIT, 'tor_bootstrap': args.bootstrap_time}
+    phases = {}
+    for name in sorted({name for record in records for name in record.get('phases', {})}):
+        durations = np.array([record['phases'][name] for record in records if name in record.get('phases', {})])
+        phases[name] = {'mean': float(durations.mean()), 'p95': float(np.percentile(durations, 95)),
+                        'overhead': float(durations.mean() - expected.get(name, 0.0))}
+    ok = sum(1 for record in records if record['status'] == 'ok')
+    sleeps = sum(expected.values()) + utils.INTERVAL_BETWEEN_VISIT
+    return {
+        'visits': len(records),
+        'ok': ok,
+        'elapsed': elapsed,
+        'visits_per_sec': len(records) / elapsed if elapsed else 0.0,
+        'overhead_per_visit': elapsed / len(records) - sleeps if records else 0.0,
+        'phases': phases,
+        'record_ms': 1000 * float(np.mean(record_times)) if record_times else 0.0,
+        'files_per_visit': files / len(records) if records else 0,
+        'bytes_per_visit': size / len(records) if records else 0,
+    }
+
+
+def print_report(results):
+    print('\nvisits {visits} ({ok} ok) in {elapsed:.2f}s: {visits_per_sec:.2f} visits/s, '
+          '{overhead_per_visit:.3f}s overhead per visit'.format(**results))
+    print('{:<16}{:>10}{:>10}{:>10}'.format('phase', 'mean', 'p95', 'overhead'))
+    for name, phase in results['phases'].items():
+        print('{:<16}{mean:>10.4f}{p95:>10.4f}{overhead:>10.4f}'.format(name, **phase))
+    print('file I/O: {files_per_visit:.1f} files and {bytes_per_visit:.0f} bytes per visit, '
+          '{record_ms:.2f} ms to record a visit'.format(**results))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the crawl loop against fake Tor, browser and capture.')
+    parser.add_argument('--visits', default=20, type=int, help='URLs per batch')
+    parser.add_argument('--batches', default=1, type=int, help='Number of batches')
+    parser.add_argument('--torrcs', default=2, type=int, help='Number of torrcs')
+    parser.add_argument('--torrc_block', default=utils.TORRC_BLOCK_SIZE, type=int, help='Visits served by one Tor process (default: 1, Tor restarts for every visit)')
+    parser.add_argument('--scale', default=0.01, type=float, help='Factor applied to the sleep constants of utils')
+    parser.add_argument('--bootstrap_time', default=0.05, type=float, help='Fake Tor bootstrap time (s)')
+    parser.add_argument('--page_load_time', default=0.05, type=float, help='Fake page load time (s)')
+    parser.add_argument('--packet_rate', default=1000, type=int, help='Packets per second of the fake capture')
+    parser.add_argument('--screenshot', action='store_true', help='Take (fake) screenshots')
+    parser.add_argument('--screen_check', action='store_true', help='Hash and check the screenshots')
+    parser.add_argument('--bad_screens', default='', type=str, help='Bad-page signatures of the screenshot check')
+    parser.add_argument('--tor_pool', default=0, type=int, help='Number of pre-warmed Tor processes')
+    parser.add_argument('--profile_pool', default=0, type=int, help='Number of pre-baked browser profiles')
+    parser.add_argument('--tor_state', default='persistent', type=str, choices=TOR_STATE_MODES, help='Tor DataDirectory mode')
+    parser.add_argument('--persistent_browser', default=0, type=int, help='Restart the browser every N visits (0 per visit)')
+    parser.add_argument('--pipeline', action='store_true', help='Pipeline visit preparation and teardown')
+    parser.add_argument('--snaplen', default=0, type=int, help='Bytes kept of each captured packet')
+    parser.add_argument('--compress', action='store_true', help='Gzip the captures in the background')
+    parser.add_argument('--base_port', default=19050, type=int, help='First socks/control port of the fake Tor')
+    parser.add_argument('--json', default='', type=str, help='Write the results to this file')
+    parser.add_argument('--baseline', default='', type=str, help='Fail if visits/s drops below a previous --json result')
+    parser.add_argument('--tolerance', default=0.1, type=float, help='Allowed visits/s drop relative to the baseline')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='crawl-benchmark-')
+    try:
+        results = run_benchmark(args, work_dir)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    results['args'] = vars(args)
+    print_report(results)
+    if args.json:
+        with open(args.json, 'w') as fp:
+            json.dump(results, fp, indent=2)
+    if args.baseline:
+        with open(args.baseline, 'r') as fp:
+            baseline = json.load(fp)
+        floor = baseline['visits_per_sec'] * (1 - args.tolerance)
+        if results['visits_per_sec'] < floor:
+            print('ERROR\tThroughput regression: {:.2f} visits/s, baseline {:.2f}'.format(
+                results['visits_per_sec'], baseline['visits_per_sec']))
+            sys.exit(1)
+        print('INFO\tWithin {:.0%} of the baseline ({:.2f} visits/s)'.format(args.tolerance, baseline['visits_per_sec']))
@@ -0,0 +1,140 @@
+"""Stand-in for the tor binary, speaking enough of the control protocol for stem.
+
+It reads its torrc from stdin (``tor -f -``), reports bootstrap progress on
+stdout like tor does, and answers the controller commands the crawler uses
+on ControlPort. No relay connection is ever made. The bootstrap time is read
+from the FAKE_TOR_BOOTSTRAP environment variable (seconds).
+"""
+import os
+import socket
+import socketserver
+import sys
+import threading
+import time
+
+VERSION = '0.4.8.10'
+GUARD_FINGERPRINT = 'A' * 40
+MIDDLE_FINGERPRINT = 'B' * 40
+EXIT_FINGERPRINT = 'C' * 40
+
+
+class FakeTor(object):
+
+    def __init__(self, bootstrap_time):
+        self.bootstrap_time = bootstrap_time
+        self.started = time.monotonic()
+
+    def is_bootstrapped(self):
+        return time.monotonic() - self.started >= self.bootstrap_time
+
+    def get_info(self, key):
+        done = self.is_bootstrapped()
+        if key == 'version':
+            return VERSION
+        if key == 'status/bootstrap-phase':
+            if done:
+                return 'NOTICE BOOTSTRAP PROGRESS=100 TAG=done SUMMARY="Done"'
+            return 'NOTICE BOOTSTRAP PROGRESS=50 TAG=loading_descriptors SUMMARY="Loading relay descriptors"'
+        if key == 'status/circuit-established':
+            return '1' if done else '0'
+        if key == 'circuit-status':
+            if not done:
+                return ''
+            return '1 BUILT ${}~guard,${}~middle,${}~exit PURPOSE=GENERAL'.format(
+                GUARD_FINGERPRINT, MIDDLE_FINGERPRINT, EXIT_FINGERPRINT)
+        if key == 'entry-guards':
+            return '${}~guard {}'.format(GUARD_FINGERPRINT, 'up' if done else 'never-connected')
+        if key in ('stream-status', 'orconn-status'):
+            return ''
+        if key == 'process/pid':
+            return str(os.getpid())
+        if key.startswith('ns/id/'):
+            return ('r guard {} AAAAAAAAAAAAAAAAAAAAAAAAAAA 2024-01-01 00:00:00 192.0.2.1 9001 0\n'
+                    's Fast Guard Running Stable Valid'.format('qqqqqqqqqqqqqqqqqqqqqqqqqqo'))
+        return None
+
+
+class ControlHandler(socketserver.StreamRequestHandler):
+
+    tor: FakeTor
+
+    def send(self, lines):
+        self.wfile.write(''.join(line + '\r\n' for line in lines).encode())
+
+    def handle(self):
+        for raw in self.rfile:
+            line = raw.decode('utf-8', 'replace').strip()
+            if not line:
+                continue
+            command, _, args = line.partition(' ')
+            command = command.upper()
+            if command == 'PROTOCOLINFO':
+                self.send(['250-PROTOCOLINFO 1', '250-AUTH METHODS=NULL',
+                           '250-VERSION Tor="{}"'.format(VERSION), '250 OK'])
+            elif command == 'GETINFO':
+                self.get_info(args.split())
+            elif command == 'GETCONF':
+                self.send(['250-{}'.format(key) for key in args.split()[:-1]] + ['250 {}'.format(args.split()[-1])])
+            elif command == 'QUIT':
+                self.send(['250 closing connection'])
+                return
+            elif command in ('AUTHENTICATE', 'SETEVENTS', 'SIGNAL', 'CLOSESTREAM', 'TAKEOWNERSHIP',
+                             'RESETCONF', 'SETCONF', 'DROPGUARDS'):
+                self.send(['250 OK'])
+            else:
+                self.send(['510 Unrecognized command "{}"'.format(command)])
+
+    def get_info(self, keys):
+        reply = []
+        for key in keys:
+            value = self.tor.get_info(key)
+            if value is None:
+                self.send(['552 Unrecognized key "{}"'.format(key)])
+                return
+            if '\n' in value or not value:
+                reply += ['250+{}='.format(key)] + value.splitlines() + ['.']
+            else:
+                reply.append('250-{}={}'.format(key, value))
+        self.send(reply + ['250 OK'])
+
+
+class ControlServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def parse_torrc(text):
+    conf = {}
+    for line in text.splitlines():
+        key, _, value = line.strip().partition(' ')
+        if key:
+            conf.setdefault(key, []).append(value)
+    return conf
+
+
+def main():
+    if '--version' in sys.argv:
+        print('Tor version {}.'.format(VERSION))
+        return
+    conf = parse_torrc(sys.stdin.read() if sys.argv[1:3] == ['-f', '-'] else open(sys.argv[2]).read())
+    control_port = int(conf['ControlPort'][0])
+    socks_port = int(conf['SOCKSPort'][0])
+
+    tor = FakeTor(float(os.environ.get('FAKE_TOR_BOOTSTRAP', '0')))
+    handler = type('BoundControlHandler', (ControlHandler,), {'tor': tor})
+    control = ControlServer(('127.0.0.1', control_port), handler)
+    socks = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    socks.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    socks.bind(('127.0.0.1', socks_port))
+    socks.listen()
+    threading.Thread(target=control.serve_forever, daemon=True).start()
+
+    print('Jan 01 00:00:00.000 [notice] Bootstrapped 0% (starting): Starting', flush=True)
+    # stem closes our stdout once it has seen the first bootstrap line
+    while True:
+        connection, _ = socks.accept()
+        connection.close()
+
+
+if __name__ == '__main__':
+    main()
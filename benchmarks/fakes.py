@@ -0,0 +1,140 @@
+"""Stand-ins for Tor Browser, the capture and the TBB directory used by the benchmarks."""
+import os
+import shutil
+import stat
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+from helper import utils
+from helper.pcaputils import PcapWriter
+from models.dumputils import Sniffer
+from models.torutils import get_tbb_profile_path, get_tor_bin_path, get_tor_data_path
+
+FAKE_TOR_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_tor.py')
+FAKE_CLIENT_IP = '192.0.2.1'
+# an Ethernet/IPv4/TCP frame from a relay to the client, carrying a TLS record of two Tor cells
+FAKE_TLS_RECORD = b'\x17\x03\x03\x04\x15' + b'\x00' * (2 * 514 + 17)
+FAKE_FRAME = (b'\x00' * 12 + b'\x08\x00' + b'\x45\x00' + (40 + len(FAKE_TLS_RECORD)).to_bytes(2, 'big') +
+              b'\x00' * 4 + b'\x40\x06\x00\x00' + bytes([192, 0, 2, 2]) + bytes([192, 0, 2, 1]) +
+              b'\x23\x29\xc0\x00' + b'\x00' * 8 + b'\x50\x10\xff\xff' + b'\x00' * 4 + FAKE_TLS_RECORD)
+
+
+def make_png(width, height):
+    """Return a grey PNG of a horizontal gradient."""
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data))
+    rows = b''.join(b'\x00' + bytes(x * 255 // (width - 1) for x in range(width)) for _ in range(height))
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0)) +
+            chunk(b'IDAT', zlib.compress(rows)) + chunk(b'IEND', b''))
+
+
+FAKE_PNG = make_png(utils.DEFAULT_XVFB_WIN_W, utils.DEFAULT_XVFB_WIN_H)
+
+
+def make_fake_tbb(base_dir):
+    """Create a TBB tree whose tor binary is fake_tor.py and return its path."""
+    tbb_path = os.path.join(base_dir, 'tor-browser')
+    tor_binary = get_tor_bin_path(tbb_path)
+    os.makedirs(os.path.dirname(tor_binary))
+    with open(tor_binary, 'w') as fp:
+        fp.write('#!/bin/sh\nexec {} {} "$@"\n'.format(sys.executable, FAKE_TOR_PATH))
+    os.chmod(tor_binary, os.stat(tor_binary).st_mode | stat.S_IXUSR)
+    os.makedirs(get_tor_data_path(tbb_path))
+    profile_path = get_tbb_profile_path(tbb_path)
+    os.makedirs(profile_path)
+    for name, size in (('prefs.js', 4096), ('places.sqlite', 1 << 20), ('cert9.db', 256 << 10)):
+        with open(os.path.join(profile_path, name), 'wb') as fp:
+            fp.write(b'\x00' * size)
+    return tbb_path
+
+
+class FakeSwitchTo(object):
+
+    def window(self, handle):
+        pass
+
+
+class FakeTorBrowserDriver(object):
+    """Tor Browser driver that copies the profile like the real one and 'loads' pages by sleeping."""
+
+    page_load_time = 0.0
+
+    def __init__(self, tbb_logfile_path=None, tbb_path=None, socks_port=utils.USED_SOCKS_PORT,
+                 profile_provisioner=None, display=None, headless=False):
+        self.profile_provisioner = profile_provisioner
+        if profile_provisioner:
+            self.prof_dir_path = profile_provisioner.acquire(socks_port)
+        else:
+            self.prof_dir_path = tempfile.mkdtemp(prefix='fake-profile-')
+            shutil.copytree(get_tbb_profile_path(tbb_path), self.prof_dir_path, dirs_exist_ok=True)
+        self.window_handles = ['tab-0', 'tab-1']
+        self.switch_to = FakeSwitchTo()
+        self.is_running = True
+
+    def set_page_load_timeout(self, timeout):
+        pass
+
+    def execute_script(self, script):
+        time.sleep(self.page_load_time)
+
+    def get_screenshot_as_file(self, path):
+        with open(path, 'wb') as fp:
+            fp.write(FAKE_PNG)
+        return True
+
+    def reset_state(self, socks_port):
+        pass
+
+    def is_healthy(self):
+        return self.is_running
+
+    def quit(self):
+        self.is_running = False
+        if self.profile_provisioner:
+            self.profile_provisioner.release(self.prof_dir_path)
+        else:
+            shutil.rmtree(self.prof_dir_path)
+
+    def kill(self):
+        self.is_running = False
+
+
+class FakeSniffer(Sniffer):
+    """Sniffer writing synthetic packets at `packet_rate` per second into the visit's pcap."""
+
+    packet_rate = 1000
+
+    def __init__(self, snaplen=0):
+        super(FakeSniffer, self).__init__(snaplen)
+        self.stopped = threading.Event()
+        self.writer_thread = None
+
+    def start_capture(self, pcap_path=None, pcap_filter=""):
+        if pcap_filter:
+            self.set_capture_filter(pcap_filter)
+        if pcap_path:
+            self.set_pcap_path(pcap_path)
+        self.stopped.clear()
+        self.writer_thread = threading.Thread(target=self.write_packets, name='fake-capture', daemon=True)
+        self.writer_thread.start()
+        self.is_recording = True
+
+    def write_packets(self):
+        writer = PcapWriter(self.pcap_file, self.snaplen)
+        interval = 1.0 / self.packet_rate
+        try:
+            while not self.stopped.wait(interval):
+                now = time.time_ns()
+                writer.write(now // 10 ** 9, now % 10 ** 9, len(FAKE_FRAME), FAKE_FRAME)
+        finally:
+            self.stats = {'packets': writer.packets}
+            writer.close()
+
+    def stop_capture(self):
+        self.stopped.set()
+        self.writer_thread.join()
+        self.is_recording = False
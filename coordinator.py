@@ -0,0 +1,53 @@
+from __future__ import annotations
+
+import argparse
+import os
+
+from helper import utils
+from helper.urlsource import UrlSource
+from models.coordinator import JobStore, make_coordinator_server
+from models.workers import gen_jobs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Hand out the jobs of a crawl to the data collectors of several hosts.')
+    parser.add_argument('--urls_closeworld', default='', type=str, help='Close world URLs file path')
+    parser.add_argument('--urls_openworld', default='', type=str, help='Open world URLs file path')
+    parser.add_argument('--open_world', default='cw', type=str, help='close world(cw)/open world(ow)')
+    parser.add_argument('--open_world_num', default=10000, type=int, help='open world num')
+    parser.add_argument('--batch', default=5, type=int, help='Number of batches')
+    parser.add_argument('--torrc_dir_path', default='', type=str, help='path to torrc config dir')
+    parser.add_argument('--db', default='output/coordinator.sqlite', type=str, help='Job database, reused if it exists')
+    parser.add_argument('--host', default='127.0.0.1', type=str, help='Address to listen on')
+    parser.add_argument('--port', default=utils.COORDINATOR_PORT, type=int, help='Port to listen on')
+    parser.add_argument('--lease', default=utils.COORDINATOR_LEASE_TIMEOUT, type=float, help='Lease timeout (s)')
+    parser.add_argument('--torrc_block', default=utils.TORRC_BLOCK_SIZE, type=int, help='Consecutive visits with a torrc served by one Tor process, handed to the same node')
+    args = parser.parse_args()
+
+    assert os.path.isfile(args.urls_closeworld)
+    with open(args.urls_closeworld, 'r') as fp:
+        urls_closeworld_list = fp.read().splitlines()
+    if args.open_world == 'ow':
+        assert os.path.isfile(args.urls_openworld)
+        url_list = UrlSource(args.urls_openworld, exclude=urls_closeworld_list, limit=args.open_world_num)
+    else:
+        url_list = urls_closeworld_list
+    assert os.path.isdir(args.torrc_dir_path)
+    torrc_paths = [os.path.join(args.torrc_dir_path, torrc_path) for torrc_path in os.listdir(args.torrc_dir_path)]
+
+    utils.create_dir(os.path.dirname(args.db) or '.')
+    store = JobStore(args.db, lease_timeout=args.lease, torrc_block=max(args.torrc_block, 1))
+    if store.add_jobs(gen_jobs(url_list, torrc_paths, args.batch, store.torrc_block)):
+        print('INFO\tQueued {} urls x {} batches in {}'.format(len(url_list), args.batch, args.db))
+    else:
+        print('INFO\tResuming the jobs of {}: {}'.format(args.db, store.get_stats()))
+
+    server = make_coordinator_server(store, args.host, args.port)
+    print('INFO\tCoordinator listening on http://{}:{}'.format(args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    print('INFO\tCoordinator stopped: {}'.format(store.get_stats()))
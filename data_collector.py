@@ -6,7 +6,13 @@ import sys
 import traceback
 
 from helper import log, utils
+from helper.urlsource import HashRing, UrlSource
+from models.budget import BudgetModel
 from models.crawler import Crawler
+from models.display import DISPLAY_MODES
+from models.dumputils import CAPTURE_BACKENDS
+from models.dwell import DWELL_MODES, DwellPolicy
+from models.torstate import TOR_STATE_MODES
 
 sys.path.append('models')
 
@@ -26,14 +32,43 @@ if __name__ == '__main__':
     parser.add_argument('--output', default='output', type=str, help='Path of the output file')
     parser.add_argument('--tbbpath', default='../tbb/tor-browser_zh-CN', type=str, help='Path of tbb')
     parser.add_argument('--xvfb', default=False, type=bool, help='Use XVFB (for headless testing)')
+    parser.add_argument('--display', default='', type=str, choices=DISPLAY_MODES, help='Browser display: an Xvfb per visit (xvfb)/a pool of long-lived Xvfb displays (pool)/headless browser (headless), --xvfb alone means xvfb')
     parser.add_argument('--screenshot', default=False, type=bool, help='Capture page screenshots)')
+    parser.add_argument('--screen_check', action='store_true', help='Flag visits whose screenshot is an error page or unlike the earlier ones of the URL, and visit bad pages again')
+    parser.add_argument('--bad_screens', default='', type=str, help='Bad-page signatures: dir of sample screenshots or JSON file of label: dhash')
     parser.add_argument('--torrc_dir_path', default='', type=str, help='path to torrc config dir')
+    parser.add_argument('--torrc_block', default=utils.TORRC_BLOCK_SIZE, type=int, help='Consecutive visits with a torrc served by one Tor process, with a new identity between them (default: 1, Tor restarts for every visit)')
     parser.add_argument('--open_world', default='cw', type=str, help='close world(cw)/open world(ow)')
     parser.add_argument('--open_world_num', default=10000, type=int, help='open world num')
     parser.add_argument('--open_world_server_conf_path', default='', type=str, help='open_world_server_conf_path')
     parser.add_argument('--myexip', default='/root/myexip', type=str, help='path to myexip')
+    parser.add_argument('--workers', default=1, type=int, help='Number of parallel Tor + Tor Browser workers')
+    parser.add_argument('--tor_pool', default=0, type=int, help='Number of pre-warmed Tor processes per worker (0 to disable)')
+    parser.add_argument('--profile_pool', default=0, type=int, help='Number of pre-baked browser profiles kept ready (0 to copy the TBB profile per visit)')
+    parser.add_argument('--tor_state', default='persistent', type=str, choices=TOR_STATE_MODES, help='Tor DataDirectory: shared across restarts (persistent)/fresh per process (cold)/fresh with a shared consensus cache (warm)')
+    parser.add_argument('--persistent_browser', default=0, type=int, help='Keep the browser across visits, restarting it every N visits (0 to start one per visit)')
+    parser.add_argument('--capture', default=utils.CAPTURE_BACKEND, type=str, choices=CAPTURE_BACKENDS, help='Capture backend: tcpdump subprocess (tcpdump)/in-process AF_PACKET ring (native)')
+    parser.add_argument('--snaplen', default=0, type=int, help='Bytes kept of each captured packet (0 for whole packets)')
+    parser.add_argument('--headers_only', action='store_true', help='Keep only the packet headers, same as --snaplen {}'.format(utils.HEADER_SNAPLEN))
+    parser.add_argument('--compress', action='store_true', help='Gzip the captures of finished visits in the background')
+    parser.add_argument('--continuous_capture', action='store_true', help='Capture once per worker and cut the stream into per-visit pcaps')
+    parser.add_argument('--resume', action='store_true', help='Continue the crawl in the output dir from its manifest')
+    parser.add_argument('--coordinator', default='', type=str, help='Lease jobs from a coordinator (http://host:port) instead of planning them')
+    parser.add_argument('--pipeline', action='store_true', help='Prepare the next visit and tear down the previous one in the background')
+    parser.add_argument('--metrics_port', default=0, type=int, help='Serve Prometheus metrics of the crawl on this port (0 to disable)')
+    parser.add_argument('--quota', default=0, type=int, help='Visit until every URL has this many successful visits, retrying failures (0 to crawl --batch batches)')
+    parser.add_argument('--quota_per_torrc', action='store_true', help='Apply the quota to every URL and torrc pair')
+    parser.add_argument('--dwell', default='fixed', type=str, choices=DWELL_MODES, help='Dwell mode: fixed sleep (fixed)/end on quiet traffic (adaptive)')
+    parser.add_argument('--min_dwell', default=utils.ADAPTIVE_MIN_DWELL, type=float, help='Minimum adaptive dwell (s)')
+    parser.add_argument('--max_dwell', default=0, type=float, help='Maximum adaptive dwell (s), 0 for WAIT_FOR_VISIT')
+    parser.add_argument('--quiet_period', default=utils.ADAPTIVE_QUIET_PERIOD, type=float, help='Quiet time that ends an adaptive visit (s)')
+    parser.add_argument('--budget_history', default=None, nargs='*', type=str, help='Learn per-URL dwell and timeouts from these crawl dirs and the finished batches of this crawl')
+    parser.add_argument('--budget_cache', default='', type=str, help='Cache of the learned load times, <output>/budgets.json by default')
 
     args = parser.parse_args()
+    if (args.workers > 1 or args.tor_pool) and not args.continuous_capture:
+        # a per-visit capture filters on the relay connections open when the visit starts
+        parser.error('--workers and --tor_pool need --continuous_capture, which follows the new relay connections')
 
     # Load data
     urls_closeworld = args.urls_closeworld
@@ -48,6 +83,14 @@ if __name__ == '__main__':
     open_world_num = args.open_world_num
     open_world_server_conf_path = args.open_world_server_conf_path
     myexip = args.myexip
+    workers = args.workers
+    assert workers >= 1
+    assert not (args.quota and args.coordinator), "A coordinator plans the jobs, --quota cannot be used with it"
+    budgets = None
+    if args.budget_history is not None:
+        budgets = BudgetModel(args.budget_history, args.budget_cache or os.path.join(output, 'budgets.json'))
+        print('INFO\tBudget model: {} new visits, {} urls'.format(budgets.refresh(), len(budgets)))
+    dwell_policy = DwellPolicy(args.dwell, args.min_dwell, args.max_dwell or None, args.quiet_period, budgets)
 
     urls_closeworld_list = []
     assert os.path.isfile(urls_closeworld)
@@ -55,15 +98,6 @@ if __name__ == '__main__':
     with open(urls_closeworld, 'r') as fp:
         urls_closeworld_list = fp.read().splitlines()
 
-    urls_openworld_list = []
-    if is_open_world:
-        assert os.path.isfile(urls_openworld)
-        assert urls_openworld
-        with open(urls_openworld, 'r') as fp:
-            urls_openworld_list = fp.read().splitlines()
-        for i in urls_closeworld_list:
-            urls_openworld_list.remove(i) if i in urls_openworld_list else None
-
     assert os.path.isdir(torrc_dir_path)
     torrc_paths = [os.path.join(torrc_dir_path, torrc_path) for torrc_path in os.listdir(torrc_dir_path)]
 
@@ -76,15 +110,28 @@ if __name__ == '__main__':
         with open(args.open_world_server_conf_path, 'r') as fp:
             open_world_servers_list = fp.read().splitlines()
         assert myip in open_world_servers_list
-        open_world_start_index = int(open_world_num*(open_world_servers_list.index(myip)/len(open_world_servers_list)))
-        open_world_end_index = int(
-            (open_world_num*(open_world_servers_list.index(myip)+1)/len(open_world_servers_list)))
+        # the first open_world_num URLs (closed world excluded) are spread over the servers by consistent hashing
+        assert os.path.isfile(urls_openworld)
+        urls_openworld_list = UrlSource(urls_openworld, exclude=urls_closeworld_list, limit=open_world_num,
+                                        ring=HashRing(open_world_servers_list), shard=myip)
+        open_world_start_index = 0
+        open_world_end_index = len(urls_openworld_list)
     else:
+        urls_openworld_list = []
         open_world_start_index = 0
         open_world_end_index = 0
 
     crawler = Crawler(torrc_paths, urls_closeworld_list, urls_openworld_list, is_open_world, tbb_path,
-                      output, xvfb, screenshot, open_world_start_index, open_world_end_index)
+                      output, xvfb, screenshot, open_world_start_index, open_world_end_index, workers,
+                      dwell_policy=dwell_policy, tor_pool_size=args.tor_pool,
+                      profile_pool_size=args.profile_pool, tor_state_mode=args.tor_state,
+                      browser_restart_every=args.persistent_browser, capture_backend=args.capture,
+                      continuous_capture=args.continuous_capture, resume=args.resume,
+                      coordinator_url=args.coordinator, pipeline=args.pipeline,
+                      metrics_port=args.metrics_port, quota=args.quota, quota_per_torrc=args.quota_per_torrc,
+                      snaplen=utils.HEADER_SNAPLEN if args.headers_only else args.snaplen, compress=args.compress,
+                      display_mode=args.display, screen_check=args.screen_check, bad_screens=args.bad_screens,
+                      torrc_block=args.torrc_block)
     print('INFO\tInit crawler finish in {}'.format(utils.cal_now_time()))
     print("INFO\tCommand line parameters: %s" % sys.argv)
 
@@ -93,7 +140,7 @@ if __name__ == '__main__':
     try:
         print('INFO\tData Collection start in {}'.format(utils.cal_now_time()))
         print('INFO\tPredicted time: {:.1f} hours'.format((utils.WAIT_AFTER_DUMP+utils.INTERVAL_WAIT_AFTER_RESTART +
-              utils.WAIT_FOR_VISIT)*len(urls_closeworld_list)*num_batches/3600))
+              utils.WAIT_FOR_VISIT)*len(urls_closeworld_list)*num_batches/workers/3600))
         crawler.crawl(num_batches)
     except KeyboardInterrupt:
         log.wl_log.warning("WARNING\tKeyboard interrupt! Quitting in {}...".format(utils.cal_now_time()))
@@ -0,0 +1,22 @@
+from __future__ import annotations
+
+import argparse
+import os
+import time
+
+from helper.dataset import PackedDataset, pack_crawl
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pack the converted traces of a crawl into one memory-mapped dataset.')
+    parser.add_argument('--crawl_dir', default='output/crawl', type=str, help='Crawl directory (converted with pcap_converter.py)')
+    parser.add_argument('--crawl_id', default='', type=str, help='Name of the crawl in the dataset, the absolute path of --crawl_dir by default')
+    parser.add_argument('--output', default='output/packed', type=str, help='Packed dataset directory, appended to if it exists')
+    args = parser.parse_args()
+
+    assert os.path.isdir(args.crawl_dir), "Invalid crawl dir {}".format(args.crawl_dir)
+    start = time.time()
+    added = pack_crawl(args.crawl_dir, args.output, args.crawl_id or None)
+    dataset = PackedDataset(args.output)
+    print('INFO\tPacked {} new visits in {:.1f}s, {} visits / {} packets / {} labels in {}'.format(
+        added, time.time() - start, len(dataset), dataset.packets, len(dataset.label_names), args.output))
@@ -0,0 +1,211 @@
+import json
+import os
+
+import numpy as np
+
+from helper.traceutils import TRACE_DTYPE, get_trace_path, iter_visit_dirs
+from helper.validation import VALIDATION_FILENAME
+from models.manifest import STATUS_OK, Manifest
+
+# Files of a packed dataset. Every binary file only grows; meta.json holds the
+# committed visit and packet counts and is replaced last, so an interrupted
+# append is rolled back by truncating the files to those counts.
+TRACES_FILE = 'traces.bin'    # TRACE_DTYPE records of all the visits, concatenated
+OFFSETS_FILE = 'offsets.bin'  # int64 end offset of each visit in traces.bin
+COLUMN_FILES = {'label': 'labels.bin', 'batch': 'batches.bin', 'torrc': 'torrcs.bin'}  # int32 per visit
+VOCAB_FILES = {'label': 'labels.txt', 'torrc': 'torrcs.txt'}
+VISITS_FILE = 'visits.txt'    # crawl id and crawl-relative path of each visit, to skip them on append
+META_FILE = 'meta.json'
+
+
+def read_meta(pack_dir):
+    try:
+        with open(os.path.join(pack_dir, META_FILE), 'r') as fp:
+            return json.load(fp)
+    except FileNotFoundError:
+        return {'dtype': TRACE_DTYPE.descr, 'visits': 0, 'packets': 0}
+
+
+def write_meta(pack_dir, meta):
+    tmp_path = os.path.join(pack_dir, META_FILE + '.tmp')
+    with open(tmp_path, 'w') as fp:
+        json.dump(meta, fp)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(tmp_path, os.path.join(pack_dir, META_FILE))
+
+
+def read_lines(path):
+    try:
+        with open(path, 'r') as fp:
+            return fp.read().splitlines()
+    except FileNotFoundError:
+        return []
+
+
+def write_lines(path, lines):
+    """Replace a text file atomically, so a crash never leaves it shorter than meta.json says."""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as fp:
+        fp.writelines(line + '\n' for line in lines)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(tmp_path, path)
+
+
+def truncate(path, size):
+    with open(path, 'ab') as fp:
+        fp.truncate(size)
+
+
+def read_visit_file(visit_dir, filename):
+    with open(os.path.join(visit_dir, filename), 'r') as fp:
+        return fp.readline().strip()
+
+
+def get_ok_visits(crawl_dir):
+    """Return the crawl-relative paths of the visits the manifest of a crawl records as successful."""
+    return {os.path.join('batch-{}'.format(entry['batch']), 'url-{}'.format(entry['index']))
+            for entry in Manifest(crawl_dir).read() if entry['status'] == STATUS_OK}
+
+
+def is_valid_visit(visit_dir):
+    """Whether the capture of a visit passed validation."""
+    try:
+        with open(os.path.join(visit_dir, VALIDATION_FILENAME), 'r') as fp:
+            return json.load(fp).get('valid') is True
+    except (OSError, ValueError):
+        return False
+
+
+def pack_crawl(crawl_dir, pack_dir, crawl_id=None):
+    """Append the converted visits of a crawl that are not packed yet; return how many were added.
+
+    Only the visits recorded as successful in the manifest, or whose capture
+    passed validation, are packed. They are known in the pack by `crawl_id`
+    (the absolute path of the crawl by default) and their path in the crawl,
+    so that several crawls can be packed together.
+    """
+    crawl_id = crawl_id or os.path.abspath(crawl_dir)
+    os.makedirs(pack_dir, exist_ok=True)
+    meta = read_meta(pack_dir)
+    visits, packets = meta['visits'], meta['packets']
+
+    # roll back whatever an interrupted append left behind
+    truncate(os.path.join(pack_dir, TRACES_FILE), packets * TRACE_DTYPE.itemsize)
+    truncate(os.path.join(pack_dir, OFFSETS_FILE), visits * 8)
+    for filename in COLUMN_FILES.values():
+        truncate(os.path.join(pack_dir, filename), visits * 4)
+    packed = read_lines(os.path.join(pack_dir, VISITS_FILE))[:visits]
+    write_lines(os.path.join(pack_dir, VISITS_FILE), packed)
+    packed = set(packed)
+    vocabs = {name: read_lines(os.path.join(pack_dir, filename)) for name, filename in VOCAB_FILES.items()}
+    vocab_index = {name: {value: i for i, value in enumerate(vocab)} for name, vocab in vocabs.items()}
+
+    files = {name: open(os.path.join(pack_dir, filename), 'ab') for name, filename in COLUMN_FILES.items()}
+    files['traces'] = open(os.path.join(pack_dir, TRACES_FILE), 'ab')
+    files['offsets'] = open(os.path.join(pack_dir, OFFSETS_FILE), 'ab')
+    files['visits'] = open(os.path.join(pack_dir, VISITS_FILE), 'a')
+    files.update({'vocab_' + name: open(os.path.join(pack_dir, filename), 'a')
+                  for name, filename in VOCAB_FILES.items()})
+    ok_visits = get_ok_visits(crawl_dir)
+    added = 0
+    try:
+        for visit_dir in iter_visit_dirs(crawl_dir):
+            rel_path = os.path.relpath(visit_dir, crawl_dir)
+            visit_id = os.path.join(crawl_id, rel_path)
+            if visit_id in packed or not os.path.isfile(get_trace_path(visit_dir)):
+                continue
+            if rel_path not in ok_visits and not is_valid_visit(visit_dir):
+                continue  # failed, timed out or invalid
+            trace = np.load(get_trace_path(visit_dir))
+            values = {'label': read_visit_file(visit_dir, 'label'),
+                      'torrc': os.path.basename(read_visit_file(visit_dir, 'torrc_path'))}
+            for name, value in values.items():
+                if value not in vocab_index[name]:
+                    vocab_index[name][value] = len(vocab_index[name])
+                    files['vocab_' + name].write(value + '\n')
+            batch = int(os.path.basename(os.path.dirname(visit_dir)).split('-', 1)[1])
+
+            files['traces'].write(trace.astype(TRACE_DTYPE, copy=False).tobytes())
+            packets += len(trace)
+            files['offsets'].write(np.int64(packets).tobytes())
+            files['label'].write(np.int32(vocab_index['label'][values['label']]).tobytes())
+            files['torrc'].write(np.int32(vocab_index['torrc'][values['torrc']]).tobytes())
+            files['batch'].write(np.int32(batch).tobytes())
+            files['visits'].write(visit_id + '\n')
+            visits += 1
+            added += 1
+    finally:
+        for fp in files.values():
+            fp.flush()
+            os.fsync(fp.fileno())
+            fp.close()
+    write_meta(pack_dir, {'dtype': TRACE_DTYPE.descr, 'visits': visits, 'packets': packets})
+    return added
+
+
+class PackedDataset(object):
+    """Memory-mapped, read-only view of a packed dataset.
+
+    Traces are returned as views into the packed file, nothing is copied.
+    """
+
+    def __init__(self, pack_dir):
+        meta = read_meta(pack_dir)
+        self.visits, self.packets = meta['visits'], meta['packets']
+        self.dtype = np.dtype([tuple(field) for field in meta['dtype']])
+        self.traces = self.memmap(os.path.join(pack_dir, TRACES_FILE), self.dtype, self.packets)
+        self.offsets = self.memmap(os.path.join(pack_dir, OFFSETS_FILE), np.int64, self.visits)
+        self.columns = {name: self.memmap(os.path.join(pack_dir, filename), np.int32, self.visits)
+                        for name, filename in COLUMN_FILES.items()}
+        self.label_names = read_lines(os.path.join(pack_dir, VOCAB_FILES['label']))
+        self.torrc_names = read_lines(os.path.join(pack_dir, VOCAB_FILES['torrc']))
+
+    @staticmethod
+    def memmap(path, dtype, count):
+        if not count:
+            return np.empty(0, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode='r', shape=(count,))
+
+    @property
+    def labels(self):
+        return self.columns['label']
+
+    @property
+    def batches(self):
+        return self.columns['batch']
+
+    @property
+    def torrcs(self):
+        return self.columns['torrc']
+
+    def __len__(self):
+        return self.visits
+
+    def __getitem__(self, i):
+        """Return the trace of visit i."""
+        if i < 0:
+            i += self.visits
+        start = self.offsets[i - 1] if i else 0
+        return self.traces[start:self.offsets[i]]
+
+    def select(self, label=None, torrc=None, batch=None):
+        """Return the indices of the visits matching all the given filters (names or ids)."""
+        mask = np.ones(self.visits, dtype=bool)
+        if label is not None:
+            mask &= self.labels == (self.label_names.index(label) if isinstance(label, str) else label)
+        if torrc is not None:
+            mask &= self.torrcs == (self.torrc_names.index(torrc) if isinstance(torrc, str) else torrc)
+        if batch is not None:
+            mask &= self.batches == batch
+        return np.flatnonzero(mask)
+
+    def iter_batches(self, batch_size, indices=None, shuffle=False, seed=None):
+        """Yield (traces, labels) in batches of `batch_size` visits."""
+        indices = np.arange(self.visits) if indices is None else np.asarray(indices)
+        if shuffle:
+            indices = np.random.default_rng(seed).permutation(indices)
+        for start in range(0, len(indices), batch_size):
+            chunk = indices[start:start + batch_size]
+            yield [self[i] for i in chunk], self.labels[chunk]
@@ -0,0 +1,143 @@
+import gzip
+import os
+import shutil
+import struct
+
+# libpcap file format, see https://wiki.wireshark.org/Development/LibpcapFileFormat
+PCAP_MAGIC = 0xa1b2c3d4
+PCAP_MAGIC_NSEC = 0xa1b23c4d
+PCAP_VERSION = (2, 4)
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_VLAN = 0x8100
+PCAP_GLOBAL_HEADER = struct.Struct('<IHHiIII')
+PCAP_RECORD_HEADER = struct.Struct('<IIII')
+PCAP_MAX_SNAPLEN = 262144
+PCAP_GZ_SUFFIX = '.gz'
+
+
+class PcapWriter(object):
+    """Write packets to a pcap file with microsecond timestamps."""
+
+    def __init__(self, path, snaplen=PCAP_MAX_SNAPLEN, linktype=LINKTYPE_ETHERNET):
+        self.path = path
+        self.snaplen = snaplen or PCAP_MAX_SNAPLEN
+        self.fp = open(path, 'wb')
+        self.fp.write(PCAP_GLOBAL_HEADER.pack(PCAP_MAGIC, PCAP_VERSION[0], PCAP_VERSION[1],
+                                              0, 0, self.snaplen, linktype))
+        self.packets = 0
+
+    def write(self, ts_sec, ts_nsec, wirelen, data):
+        data = data[:self.snaplen]
+        self.fp.write(PCAP_RECORD_HEADER.pack(ts_sec, ts_nsec // 1000, len(data), wirelen))
+        self.fp.write(data)
+        self.packets += 1
+
+    def flush(self):
+        self.fp.flush()
+
+    def close(self):
+        self.fp.close()
+
+
+def find_pcap(path):
+    """Return the path of a pcap, or of its compressed copy, None if there is neither."""
+    for candidate in (path, path + PCAP_GZ_SUFFIX):
+        if os.path.isfile(candidate):
+            return candidate
+    return None
+
+
+def open_pcap(path):
+    """Open a pcap for reading, transparently reading its compressed copy once it was compressed."""
+    found = find_pcap(path)
+    if found is None:
+        raise FileNotFoundError(path)
+    return gzip.open(found, 'rb') if found.endswith(PCAP_GZ_SUFFIX) else open(found, 'rb')
+
+
+def compress_pcap(path, level=6):
+    """Replace a pcap by <path>.gz; readers see one or the other complete file at any time."""
+    tmp_path = path + PCAP_GZ_SUFFIX + '.tmp'
+    with open(path, 'rb') as src, gzip.open(tmp_path, 'wb', compresslevel=level) as dst:
+        shutil.copyfileobj(src, dst, 1 << 20)
+    os.replace(tmp_path, path + PCAP_GZ_SUFFIX)
+    os.unlink(path)
+    return os.path.getsize(path + PCAP_GZ_SUFFIX)
+
+
+class PcapReader(object):
+    """Stream the records of a pcap file object without loading it."""
+
+    def __init__(self, fp):
+        self.fp = fp
+        header = self.read_exactly(PCAP_GLOBAL_HEADER.size)
+        if header is None:
+            raise ValueError('Empty pcap')
+        for endian in '<>':
+            magic = struct.unpack(endian + 'I', header[:4])[0]
+            if magic in (PCAP_MAGIC, PCAP_MAGIC_NSEC):
+                break
+        else:
+            raise ValueError('Not a pcap file')
+        self.ts_scale = 1 if magic == PCAP_MAGIC_NSEC else 1000  # to nanoseconds
+        _, _, _, _, _, self.snaplen, self.linktype = struct.unpack(endian + PCAP_GLOBAL_HEADER.format[1:], header)
+        self.record_header = struct.Struct(endian + PCAP_RECORD_HEADER.format[1:])
+
+    def read_exactly(self, size):
+        data = self.fp.read(size)
+        while data and len(data) < size:  # pipes may return short reads
+            more = self.fp.read(size - len(data))
+            if not more:
+                break
+            data += more
+        return data if len(data) == size else None
+
+    def __iter__(self):
+        """Yield (sec, nsec, wirelen, data); a truncated last record ends the stream."""
+        while True:
+            header = self.read_exactly(self.record_header.size)
+            if header is None:
+                return
+            sec, frac, caplen, wirelen = self.record_header.unpack(header)
+            data = self.read_exactly(caplen) if caplen else b''
+            if data is None:
+                return
+            yield sec, frac * self.ts_scale, wirelen, data
+
+
+def parse_tcp_packet(data, linktype=LINKTYPE_ETHERNET):
+    """Return (src, dst, sport, dport, ip_len, tcp_payload) of an IPv4/TCP packet, or None.
+
+    Addresses are returned as 4-byte strings; the payload is cut to the captured bytes.
+    """
+    segment = parse_tcp_segment(data, linktype)
+    return segment[:6] if segment else None
+
+
+def parse_tcp_segment(data, linktype=LINKTYPE_ETHERNET):
+    """Like parse_tcp_packet, with the length of the TCP payload on the wire appended."""
+    if linktype == LINKTYPE_ETHERNET:
+        offset, ethertype = 14, struct.unpack_from('!H', data, 12)[0] if len(data) >= 14 else 0
+        if ethertype == ETHERTYPE_VLAN and len(data) >= 18:
+            offset, ethertype = 18, struct.unpack_from('!H', data, 16)[0]
+    elif linktype == LINKTYPE_LINUX_SLL:
+        offset, ethertype = 16, struct.unpack_from('!H', data, 14)[0] if len(data) >= 16 else 0
+    elif linktype == LINKTYPE_RAW:
+        offset, ethertype = 0, ETHERTYPE_IPV4
+    else:
+        return None
+    if ethertype != ETHERTYPE_IPV4 or len(data) < offset + 20:
+        return None
+    ihl = (data[offset] & 0x0f) * 4
+    ip_len = struct.unpack_from('!H', data, offset + 2)[0]
+    if data[offset + 9] != 6 or len(data) < offset + ihl + 14:  # not TCP, or no room for the ports and data offset
+        return None
+    src, dst = data[offset + 12:offset + 16], data[offset + 16:offset + 20]
+    tcp = offset + ihl
+    sport, dport = struct.unpack_from('!HH', data, tcp)
+    payload_start = tcp + (data[tcp + 12] >> 4) * 4
+    payload_end = min(len(data), offset + ip_len)
+    return src, dst, sport, dport, ip_len, data[payload_start:payload_end], max(offset + ip_len - payload_start, 0)
@@ -0,0 +1,53 @@
+import json
+import os
+
+from PIL import Image
+
+from helper import utils
+
+SCREEN_FILENAME = 'screenshot.json'
+
+
+def dhash(png_path, hash_size=utils.SCREENSHOT_HASH_SIZE):
+    """Difference hash of an image: whether each pixel of the image, downscaled and grey, is brighter than the next."""
+    with Image.open(png_path) as image:
+        small = image.convert('L').resize((hash_size + 1, hash_size), Image.BILINEAR, reducing_gap=2.0)
+    pixels = small.tobytes()
+    bits = 0
+    for row in range(hash_size):
+        line = pixels[row * (hash_size + 1):(row + 1) * (hash_size + 1)]
+        for col in range(hash_size):
+            bits = (bits << 1) | (line[col] > line[col + 1])
+    return bits
+
+
+def hamming(hash_a, hash_b):
+    return bin(hash_a ^ hash_b).count('1')
+
+
+def format_hash(image_hash, hash_size=utils.SCREENSHOT_HASH_SIZE):
+    return '{:0{}x}'.format(image_hash, hash_size * hash_size // 4)
+
+
+def load_signatures(path):
+    """Return the label -> hash of the bad pages, from a dir of sample screenshots or a JSON file of hex hashes."""
+    if os.path.isdir(path):
+        return {os.path.splitext(name)[0]: dhash(os.path.join(path, name))
+                for name in sorted(os.listdir(path)) if name.lower().endswith('.png')}
+    with open(path, 'r') as fp:
+        return {label: int(value, 16) for label, value in json.load(fp).items()}
+
+
+def nearest(image_hash, hashes):
+    """Return the (key, distance) of the hash closest to image_hash, (None, None) if there are none."""
+    best = None, None
+    for key, other in hashes:
+        distance = hamming(image_hash, other)
+        if best[1] is None or distance < best[1]:
+            best = key, distance
+    return best
+
+
+def write_screen_verdict(visit_dir, verdict):
+    with open(os.path.join(visit_dir, SCREEN_FILENAME), 'w') as fp:
+        json.dump(verdict, fp)
@@ -0,0 +1,97 @@
+import array
+import os
+import socket
+from collections import Counter
+
+import numpy as np
+
+from helper.pcaputils import PcapReader, find_pcap, open_pcap, parse_tcp_packet
+
+# One row per packet: time since the first packet (s), direction (+1 out, -1 in) and IP length
+TRACE_DTYPE = np.dtype([('time', '<f4'), ('direction', 'i1'), ('size', '<u4')])
+TRACE_FILENAME = 'trace.npy'
+PCAP_FILENAME = 'tcp.pcap'
+
+
+def get_trace_path(visit_dir):
+    return os.path.join(visit_dir, TRACE_FILENAME)
+
+
+def iter_visit_dirs(crawl_dir):
+    """Yield the batch-*/url-* directories of a crawl."""
+    for batch in sorted(os.scandir(crawl_dir), key=lambda entry: entry.name):
+        if not (batch.is_dir() and batch.name.startswith('batch-')):
+            continue
+        for visit in sorted(os.scandir(batch.path), key=lambda entry: entry.name):
+            if visit.is_dir() and visit.name.startswith('url-'):
+                yield visit.path
+
+
+def is_up_to_date(visit_dir):
+    """Whether the visit's trace exists and is newer than its pcap."""
+    pcap_path = find_pcap(os.path.join(visit_dir, PCAP_FILENAME))
+    try:
+        return pcap_path is not None and os.path.getmtime(get_trace_path(visit_dir)) >= os.path.getmtime(pcap_path)
+    except OSError:
+        return False
+
+
+def get_local_address(my_ip):
+    """Return my_ip as a 4-byte string, None if it is not an IPv4 address (the crawler's default is a placeholder)."""
+    try:
+        return socket.inet_aton(my_ip) if my_ip else None
+    except OSError:
+        return None
+
+
+def pcap_to_trace(pcap_path, my_ip=None):
+    """Stream a pcap (or its .gz copy) into a trace array, keeping only IPv4/TCP packets to or from my_ip.
+
+    Without a valid my_ip, the local address is taken from the capture: the
+    end of the connections with the ephemeral ports, relays listen on low ports.
+    """
+    local = get_local_address(my_ip)
+    times, sizes = array.array('d'), array.array('I')
+    srcs, dsts = array.array('I'), array.array('I')
+    clients = Counter()
+    with open_pcap(pcap_path) as fp:
+        reader = PcapReader(fp)
+        for sec, nsec, _, data in reader:
+            packet = parse_tcp_packet(data, reader.linktype)
+            if packet is None:
+                continue
+            src, dst, sport, dport, ip_len, _ = packet
+            times.append(sec + nsec / 1e9)
+            sizes.append(ip_len)
+            srcs.append(int.from_bytes(src, 'big'))
+            dsts.append(int.from_bytes(dst, 'big'))
+            if local is None:
+                clients[src if sport > dport else dst] += 1
+    if local is None and clients:
+        local = clients.most_common(1)[0][0]
+
+    outgoing = incoming = np.zeros(len(times), dtype=bool)
+    if local is not None:
+        local = int.from_bytes(local, 'big')
+        outgoing = np.frombuffer(srcs, dtype=np.uint32) == local
+        incoming = np.frombuffer(dsts, dtype=np.uint32) == local
+    keep = outgoing | incoming
+    trace = np.empty(int(keep.sum()), dtype=TRACE_DTYPE)
+    if len(trace):
+        timestamps = np.frombuffer(times, dtype=np.float64)[keep]
+        trace['time'] = timestamps - timestamps[0]
+        trace['direction'] = np.where(outgoing[keep], 1, -1)
+        trace['size'] = np.frombuffer(sizes, dtype=np.uint32)[keep]
+    return trace
+
+
+def save_trace(trace, trace_path):
+    """Write a trace atomically."""
+    tmp_path = trace_path + '.tmp'
+    with open(tmp_path, 'wb') as fp:
+        np.save(fp, trace)
+    os.replace(tmp_path, trace_path)
+
+
+def load_trace(visit_dir, mmap_mode=None):
+    return np.load(get_trace_path(visit_dir), mmap_mode=mmap_mode)
@@ -0,0 +1,72 @@
+import array
+import bisect
+import hashlib
+import random
+
+from helper import utils
+
+
+def hash_key(key):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+
+class HashRing(object):
+    """Consistent hashing of URLs onto servers.
+
+    Each server owns `replicas` points of the ring, so adding or removing a
+    server only moves the URLs of the arcs next to its points.
+    """
+
+    def __init__(self, servers, replicas=utils.URL_SHARD_REPLICAS):
+        points = sorted((hash_key('{}#{}'.format(server, i)), server) for server in servers for i in range(replicas))
+        self.hashes = [point for point, _ in points]
+        self.servers = [server for _, server in points]
+
+    def get_server(self, key):
+        return self.servers[bisect.bisect(self.hashes, hash_key(key)) % len(self.hashes)]
+
+
+class UrlSource(object):
+    """Read-only URL list backed by a file and an index of line offsets.
+
+    The file is scanned once to index the URLs that are not excluded and,
+    given a ring, belong to `shard`; URLs are only read back on access.
+    """
+
+    def __init__(self, path, exclude=(), limit=0, ring=None, shard=None):
+        self.path = path
+        self.offsets = array.array('q')
+        exclude = set(exclude)
+        accepted = offset = 0
+        with open(path, 'rb') as fp:
+            for line in fp:
+                url = line.strip().decode()
+                if url and url not in exclude:
+                    if ring is None or ring.get_server(url) == shard:
+                        self.offsets.append(offset)
+                    accepted += 1
+                    if accepted == limit:  # the first `limit` URLs are shared among the shards
+                        break
+                offset += len(line)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __iter__(self):
+        return self.iter_urls(self.offsets)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return list(self.iter_urls(self.offsets[key]))
+        return next(self.iter_urls([self.offsets[key]]))
+
+    def iter_urls(self, offsets):
+        with open(self.path, 'rb') as fp:
+            for offset in offsets:
+                fp.seek(offset)
+                yield fp.readline().strip().decode()
+
+    def sample(self, k, seed=None):
+        """Return k random URLs of the source."""
+        indices = random.Random(seed).sample(range(len(self.offsets)), k)
+        return list(self.iter_urls(self.offsets[i] for i in indices))
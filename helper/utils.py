@@ -1,12 +1,14 @@
+import ctypes
 import os
 import re
 from time import strftime
-import distutils.dir_util as du
 import sys
 import signal
 import shutil
 import psutil
+import threading
 import time
+from contextlib import contextmanager
 from pyvirtualdisplay.display import Display
 
 # Need modify for different server
@@ -23,15 +25,84 @@ WAIT_AFTER_DUMP = 5          # Waiting time after opening dumpcap
 
 INTERVAL_WAIT_FOR_LAUNCH = 30
 INTERVAL_WAIT_AFTER_RESTART = 20
+TOR_READY_TIMEOUT = 60        # deadline for Tor to bootstrap and build a circuit after a restart
+TOR_READY_POLL_INTERVAL = 0.1
 INTERVAL_WHEN_TOR_LAUNCH_ERROR = 1
+TORRC_BLOCK_SIZE = 1          # consecutive visits with a torrc served by one Tor process, with a new identity each
 
 # BOTH < INTERVAL_DUMP - INTERVAL_WAIT_FOR_RESTART - INTERVAL_BETWEEN_VISIT
 # BOTH < SOFT_VISIT_TIMEOUT
 WAIT_FOR_VISIT = 120          # Waiting time for each url
 WAIT_FOR_VISIT_ONION = 240    # Waiting time for each onion url (onion sites are slower)
 
+# Adaptive dwell: end a visit once the traffic is quiet (WAIT_FOR_VISIT* stay the upper bound)
+ADAPTIVE_MIN_DWELL = 10       # never end a visit before this
+ADAPTIVE_QUIET_PERIOD = 5     # seconds without traffic that mark the page as loaded
+DWELL_POLL_INTERVAL = 0.5
+
+# Per-URL budgets learned from previous visits (dwell = margin * quantile of the load times)
+BUDGET_QUANTILE = 0.9         # share of the previous loads the budget covers
+BUDGET_MARGIN = 1.5
+BUDGET_MIN_SAMPLES = 3        # fewer loads of a URL and torrc fall back to the URL, then to WAIT_FOR_VISIT*
+BUDGET_MAX_SAMPLES = 20       # last load times kept per URL and torrc
+BUDGET_MAX_DWELL = WAIT_FOR_VISIT_ONION
+BUDGET_TIMEOUT_SLACK = 60     # soft timeout = WAIT_AFTER_DUMP + dwell + slack
+BUDGET_LOAD_FRACTION = 0.99   # a page is loaded once this share of its bytes was received
+
+CAPTURE_INTERFACE = 'eth0'    # interface the traffic is captured on
+HEADER_SNAPLEN = 128          # link, IP and TCP headers and the start of the payload (TLS record headers)
+CAPTURE_BACKEND = 'tcpdump'   # tcpdump subprocess (tcpdump) or in-process AF_PACKET ring (native)
+DEMUX_GRACE = 0.5             # wait for late packets before closing a visit cut from a continuous capture
+
+# Inline validation of the capture of each visit
+VALIDATE_MIN_PACKETS = 50
+VALIDATE_MIN_BYTES_IN = 20000   # a page load brings at least this many bytes
+VALIDATE_MIN_CELL_RECORDS = 10  # TLS records sized as a whole number of Tor cells
+VALIDATE_RETRIES = 1            # immediate visits again of an invalid visit
+
+# Perceptual hash (dhash) of the screenshot of each visit
+SCREENSHOT_HASH_SIZE = 8          # difference hash of (size + 1) x size grey pixels, size ** 2 bits
+SCREENSHOT_BAD_DISTANCE = 10      # bits from a bad-page signature that still match it
+SCREENSHOT_OUTLIER_DISTANCE = 20  # bits from every earlier screenshot of the URL that flag a visit
+SCREENSHOT_MIN_HISTORY = 3        # earlier screenshots of a URL needed to flag an outlier
+SCREENSHOT_MAX_HISTORY = 20       # last screenshot hashes kept per URL
+SCREENSHOT_WORKERS = 1            # processes hashing the screenshots
+SCREENSHOT_NICE = 19              # hashing must not slow down the visits
+SCREENSHOT_TIMEOUT = 10           # wait for the hash of a visit's screenshot before recording it unchecked
+SCREENSHOT_RETRIES = 1            # visits again of a URL whose screenshot is a bad page
+
+# Storage of the captures
+COMPRESS_WORKERS = 1          # processes gzipping finished captures
+COMPRESS_LEVEL = 6
+COMPRESS_NICE = 19            # the compression must not slow down the visits
+DISK_MIN_FREE_MB = 2048       # pause the crawl below this much free space on the output volume
+DISK_RESUME_FREE_MB = 4096    # and resume above this
+DISK_POLL_INTERVAL = 30
+
+URL_SHARD_REPLICAS = 100      # points per server on the consistent-hashing ring of the open-world URLs
+
+COORDINATOR_PORT = 8700
+COORDINATOR_LEASE_TIMEOUT = 120  # a job leased to a node is re-issued if the lease is not renewed in time
+COORDINATOR_MAX_ATTEMPTS = 3     # leases of a job before it is given up
+COORDINATOR_POLL_INTERVAL = 5    # wait before asking again when all remaining jobs are leased
+
+QUOTA_MAX_FAILURES = 5        # failed visits of a URL (or URL and torrc) before it is given up
+QUOTA_BACKOFF = 60            # wait before retrying a failed visit, doubled with each failure
+QUOTA_MAX_BACKOFF = 1800
+QUOTA_POLL_INTERVAL = 1       # wait for the outcome of the visits in flight
+QUOTA_LOST_VISIT_TIMEOUT = 1800  # a visit never recorded after this is assumed lost
+
+METRICS_PORT = 9700
+METRICS_WINDOW = 50           # visits over which the throughput, ETA and failure ratio are computed
+
 SOFT_VISIT_TIMEOUT = 200     # timeout used by selenium and dumpcap
-HARD_VISIT_TIMEOUT = SOFT_VISIT_TIMEOUT + 10  # signal based hard timeout in case soft timeout fails
+HARD_VISIT_TIMEOUT = SOFT_VISIT_TIMEOUT + 10  # watchdog based hard timeout in case soft timeout fails
+
+WATCHDOG_INTERVAL = 0.1       # resolution of the deadlines
+WATCHDOG_REFIRE = 2           # raise again in a thread that swallowed the error and is still past its deadline
+BROWSER_QUIT_TIMEOUT = 60     # deadline of a browser quit before it is killed
+VISIT_CLEANUP_TIMEOUT = 30    # overall deadline of the concurrent teardown of a visit
+CLEANUP_KILL_GRACE = 5        # wait for the killed teardown tasks to return
 
 
 # Constant
@@ -43,16 +114,37 @@ STEM_SOCKS_PORT = 9250  # STEM port
 STEM_CONTROL_PORT = 9251
 USED_SOCKS_PORT = DEFAULT_SOCKS_PORT
 USED_CONTROL_PORT = DEFAULT_CONTROL_PORT
+# Each worker owns WORKER_PORT_STRIDE ports from USED_*_PORT on: one socks/control pair
+# for its own Tor process (slot 0) and one pair per pre-warmed pool instance (slot 1..)
+WORKER_PORT_STRIDE = 20
+TOR_POOL_MAX_SIZE = WORKER_PORT_STRIDE // 2 - 1
+TOR_POOL_MAX_MEMORY_MB = 2048  # RSS limit of all the pre-warmed Tor processes of a worker
+
+TOR_DATA_DIR = '/root/.tor'  # DataDirectory of the Tor process (suffixed with the worker id)
+TMPFS_DIR = '/dev/shm'  # scratch space for per-visit state, falls back to the default tmp dir
+TOR_CACHE_DIR = os.path.join(TMPFS_DIR, 'tor-cache')  # shared consensus cache of the 'warm' Tor state
+TOR_CACHE_REFRESH = 3600  # refresh the shared consensus cache when older than this (s)
+
+PROFILE_POOL_SIZE = 2  # browser profiles kept ready by the profile provisioner
+PROFILE_ACQUIRE_TIMEOUT = 30
+PROFILE_FILL_BACKOFF = 5  # wait before preparing a profile again after an error, doubled with each error
+PROFILE_FILL_MAX_BACKOFF = 300
+
+BROWSER_RESTART_EVERY = 50  # visits before a persistent browser session is restarted
 
 DEFAULT_XVFB_WIN_W = 1280  # Default dimensions for the virtual display
 DEFAULT_XVFB_WIN_H = 800
+DISPLAY_POOL_SIZE = 3  # Xvfb displays kept per worker: the visit, the one prepared next and the one torn down
 
 
 def start_xvfb(win_width=DEFAULT_XVFB_WIN_W,
-               win_height=DEFAULT_XVFB_WIN_H):
-    """Start and return virtual display using XVFB."""
+               win_height=DEFAULT_XVFB_WIN_H, manage_global_env=True):
+    """Start and return virtual display using XVFB.
+
+    With manage_global_env=False the DISPLAY of the process is left alone.
+    """
     print("INFO\tStarting XVFB: {} x {}".format(win_width, win_height))
-    xvfb_display = Display(visible=False, size=(win_width, win_height))
+    xvfb_display = Display(visible=False, size=(win_width, win_height), manage_global_env=manage_global_env)
     xvfb_display.start()
     return xvfb_display
 
@@ -63,6 +155,22 @@ def stop_xvfb(xvfb_display):
         xvfb_display.stop()
 
 
+def get_worker_ports(worker_id=0, slot=0):
+    """Return the (socks, control) port pair of a Tor slot of a crawl worker."""
+    offset = WORKER_PORT_STRIDE * worker_id + 2 * slot
+    return USED_SOCKS_PORT + offset, USED_CONTROL_PORT + offset
+
+
+def get_worker_tor_data_dir(worker_id=0, slot=0):
+    """Return the Tor DataDirectory of a Tor slot of a crawl worker."""
+    data_dir = TOR_DATA_DIR
+    if worker_id:
+        data_dir = '{}-{}'.format(data_dir, worker_id)
+    if slot:
+        data_dir = '{}-pool{}'.format(data_dir, slot)
+    return data_dir
+
+
 class TimeExceededError(Exception):
     pass
 
@@ -93,7 +201,7 @@ def clone_dir_with_timestap(orig_dir_path):
     """Copy a folder into the same directory and append a timestamp."""
     new_dir = create_dir(append_timestamp(orig_dir_path))
     try:
-        du.copy_tree(orig_dir_path, new_dir)
+        shutil.copytree(orig_dir_path, new_dir, dirs_exist_ok=True)
     except Exception as e:
         print("ERROR\tError while cloning the dir with timestamp" + str(e))
     finally:
@@ -109,11 +217,6 @@ def get_filename_from_url(url, prefix):
     return '%s-%s' % (prefix, re.sub(r'-+', '-', dashed))
 
 
-def cancel_timeout():
-    """Cancel a running alarm."""
-    signal.alarm(0)
-
-
 def gen_all_children_procs(parent_pid):
     parent = psutil.Process(parent_pid)
     for child in parent.children(recursive=True):
@@ -121,13 +224,177 @@ def gen_all_children_procs(parent_pid):
 
 
 def raise_signal(signum, frame):
-    raise TimeExceededError
+    # a SIGALRM sent just before its deadline was cancelled is stale
+    if _watchdog is None or _watchdog.has_expired(threading.get_ident()):
+        raise TimeExceededError
+
+
+class Watchdog(object):
+    """Raise TimeExceededError in the threads that overrun a deadline.
+
+    Every thread has a stack of deadlines, so a nested deadline (closing the
+    streams, quitting the browser) no longer overwrites the one of the visit
+    around it: the innermost expired deadline fires, and the outer one still
+    fires later if the error was swallowed. The main thread gets SIGALRM,
+    which interrupts a blocking system call as the former alarm did. In other
+    threads the error is raised asynchronously once the thread returns to
+    Python code: a deadline does not interrupt a blocking call there (a Tor
+    launch in the pool, a task of run_concurrently), only killing the process
+    the call waits for does.
+    """
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.deadlines: dict[int, list[list]] = {}  # thread id -> stack of [deadline, last fired, active]
+        self.main_handler = False  # SIGALRM raises TimeExceededError in the main thread
+        self.thread = threading.Thread(target=self.run, name='watchdog', daemon=True)
+        self.thread.start()
+
+    def push(self, duration):
+        """Start a deadline of the current thread and return it."""
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGALRM, raise_signal)  # linux only !!! (again, a library may have replaced it)
+            self.main_handler = True
+        entry = [time.monotonic() + duration, 0.0, True]
+        with self.lock:
+            self.deadlines.setdefault(threading.get_ident(), []).append(entry)
+        return entry
+
+    def pop(self, entry=None):
+        """End the innermost deadline of the current thread, or `entry` and the deadlines inside it."""
+        ident = threading.get_ident()
+        stack = self.deadlines.get(ident, [])  # only this thread changes its stack
+        popped = []
+        if entry is None:
+            popped = stack[-1:]
+        elif any(item is entry for item in stack):
+            popped = stack[next(i for i, item in enumerate(stack) if item is entry):]
+        for item in popped:
+            item[2] = False  # no longer fired, even before the lock is taken
+        with self.lock:
+            del stack[len(stack) - len(popped):]
+            if not stack:
+                self.deadlines.pop(ident, None)
+            if any(item[1] for item in popped) and not self.is_signalled(ident):
+                # drop the error of a fired deadline the thread has not raised yet
+                ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(ident), None)
+
+    def is_signalled(self, ident):
+        return ident == threading.main_thread().ident and self.main_handler
+
+    def has_expired(self, ident):
+        """Whether a deadline of the thread has passed; does not lock, it runs in a signal handler."""
+        now = time.monotonic()
+        return any(entry[2] and entry[0] <= now for entry in list(self.deadlines.get(ident, ())))
+
+    def fire(self, ident):
+        """Raise TimeExceededError in a thread; return False if it is gone.
+
+        Called with the lock held, for deadlines still active under it.
+        """
+        if self.is_signalled(ident):
+            signal.pthread_kill(ident, signal.SIGALRM)
+            return True
+        return ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(ident),
+                                                          ctypes.py_object(TimeExceededError)) > 0
+
+    def run(self):
+        while True:
+            time.sleep(WATCHDOG_INTERVAL)
+            now = time.monotonic()
+            with self.lock:
+                for ident, stack in list(self.deadlines.items()):
+                    expired = [entry for entry in stack if entry[2] and entry[0] <= now]
+                    if not expired or now - max(entry[1] for entry in expired) < WATCHDOG_REFIRE:
+                        continue
+                    for entry in expired:
+                        entry[1] = now
+                    if not self.fire(ident):
+                        del self.deadlines[ident]
+
+
+_watchdog = None
+_watchdog_lock = threading.Lock()
+
+
+def get_watchdog():
+    """Return the watchdog of this process, started on first use (and again in a forked child)."""
+    global _watchdog
+    with _watchdog_lock:
+        if _watchdog is None or _watchdog.pid != os.getpid():
+            _watchdog = Watchdog()
+        return _watchdog
 
 
 def timeout(duration):
-    """Timeout after given duration."""
-    signal.signal(signal.SIGALRM, raise_signal)  # linux only !!!
-    signal.alarm(duration)  # alarm after X seconds
+    """Raise TimeExceededError in the current thread after given duration, unless cancelled before.
+
+    Deadlines nest: return the deadline, to be given to cancel_timeout().
+    """
+    return get_watchdog().push(duration)
+
+
+def cancel_timeout(deadline=None):
+    """Cancel the innermost deadline of the current thread, or the given one and those started inside it."""
+    get_watchdog().pop(deadline)
+
+
+def has_expired(deadline):
+    """Whether a deadline returned by timeout() has passed."""
+    return deadline[0] <= time.monotonic()
+
+
+@contextmanager
+def deadline(duration):
+    """Run the block under a deadline of the current thread."""
+    entry = timeout(duration)
+    try:
+        yield entry
+    finally:
+        cancel_timeout(entry)
+
+
+def run_concurrently(tasks, duration, grace=CLEANUP_KILL_GRACE):
+    """Run the (name, func, kill) tasks in parallel threads under an overall deadline.
+
+    A task still running after `duration` seconds gets TimeExceededError and
+    its `kill` callable, if any, is called to SIGKILL the processes it waits
+    for; the task is then given `grace` seconds to return. Return the names
+    of the tasks that overran.
+    """
+    def run_task(name, func):
+        try:
+            with deadline(duration):
+                func()
+        except TimeExceededError:
+            print("WARNING\t{} timed out".format(name))
+        except Exception as e:
+            print("ERROR\tException in {}: {}".format(name, e))
+
+    threads = []
+    for name, func, kill in tasks:
+        thread = threading.Thread(target=run_task, args=(name, func), name=name, daemon=True)
+        thread.start()
+        threads.append((name, thread, kill))
+    end = time.monotonic() + duration
+    for _, thread, _ in threads:
+        thread.join(max(end - time.monotonic(), 0))
+    overran = []
+    for name, thread, kill in threads:
+        if not thread.is_alive():
+            continue
+        overran.append(name)
+        print("WARNING\t{} still running after {}s, killing it".format(name, duration))
+        if kill:
+            try:
+                kill()
+            except Exception as e:
+                print("ERROR\tException killing {}: {}".format(name, e))
+    for name, thread, _ in threads:
+        if name in overran:
+            thread.join(grace)
+    return overran
 
 
 def kill_all_children(parent_pid):
@@ -0,0 +1,122 @@
+import json
+import os
+import socket
+from collections import Counter
+
+from helper import utils
+from helper.pcaputils import PcapReader, open_pcap, parse_tcp_segment
+
+VALIDATION_FILENAME = 'validation.json'
+TLS_HEADER_LEN = 5
+TLS_CONTENT_TYPES = range(20, 25)
+TOR_CELL_LEN = 514  # link protocol 4+
+TLS_RECORD_OVERHEADS = (17, 24)  # AEAD tag and content type (TLS 1.3), tag and explicit nonce (TLS 1.2 GCM)
+
+
+def count_cells(record_len):
+    """Tor cells carried by a TLS record of record_len bytes, 0 if it is not cell-sized."""
+    for overhead in TLS_RECORD_OVERHEADS:
+        if record_len > overhead and (record_len - overhead) % TOR_CELL_LEN == 0:
+            return (record_len - overhead) // TOR_CELL_LEN
+    return 0
+
+
+class TlsRecordCounter(object):
+    """Follow the TLS records of the TCP flows of a capture, one segment at a time.
+
+    A flow is tracked by the bytes left of its current record. Headers falling
+    beyond the captured bytes, retransmissions and reordering lose the track;
+    it is picked up again at the next segment starting with a valid header.
+    """
+
+    def __init__(self):
+        self.remaining: dict[tuple, int | None] = {}  # flow -> bytes of the current record still to come
+        self.records = 0
+        self.cell_records = 0
+        self.cells = 0
+
+    def add(self, flow, payload, payload_len):
+        pos = self.remaining.get(flow)
+        if pos is None:
+            pos = 0  # out of sync, try the start of this segment
+        elif pos >= payload_len:
+            self.remaining[flow] = pos - payload_len
+            return
+        while pos + TLS_HEADER_LEN <= payload_len:
+            header = payload[pos:pos + TLS_HEADER_LEN]
+            if len(header) < TLS_HEADER_LEN or header[0] not in TLS_CONTENT_TYPES or header[1] != 3:
+                self.remaining[flow] = None
+                return
+            record_len = (header[3] << 8) | header[4]
+            self.records += 1
+            cells = count_cells(record_len)
+            if cells:
+                self.cell_records += 1
+                self.cells += cells
+            pos += TLS_HEADER_LEN + record_len
+        # a header split over two segments loses the track
+        self.remaining[flow] = pos - payload_len if pos >= payload_len else None
+
+
+def get_pcap_stats(pcap_path, my_ip=None):
+    """Stream a pcap and return its packets, bytes in each direction, duration and Tor cell records."""
+    local = None
+    if my_ip:
+        try:
+            local = socket.inet_aton(my_ip)
+        except OSError:
+            pass  # a placeholder IP, guess it from the capture
+    sent, clients = Counter(), Counter()
+    tls = TlsRecordCounter()
+    packets = total = 0
+    first = last = None
+    with open_pcap(pcap_path) as fp:
+        reader = PcapReader(fp)
+        for sec, nsec, _, data in reader:
+            segment = parse_tcp_segment(data, reader.linktype)
+            if segment is None:
+                continue
+            src, dst, sport, dport, ip_len, payload, payload_len = segment
+            timestamp = sec + nsec / 1e9
+            first = timestamp if first is None else first
+            last = timestamp
+            packets += 1
+            total += ip_len
+            sent[src] += ip_len
+            clients[src if sport > dport else dst] += 1
+            if payload_len:
+                tls.add((src, dst, sport, dport), payload, payload_len)
+    if local is None and clients:
+        local = clients.most_common(1)[0][0]  # the end with the ephemeral port, relays listen on low ports
+    bytes_out = sent[local] if local else 0
+    return {
+        'packets': packets,
+        'bytes_out': bytes_out,
+        'bytes_in': total - bytes_out,
+        'duration': last - first if packets else 0.0,
+        'tls_records': tls.records,
+        'cell_records': tls.cell_records,
+        'cells': tls.cells,
+    }
+
+
+def validate_pcap(pcap_path, my_ip=None):
+    """Return the stats of a visit capture with 'valid' and the 'reason' it is not."""
+    try:
+        stats = get_pcap_stats(pcap_path, my_ip)
+    except (OSError, ValueError) as exc:
+        return {'valid': False, 'reason': 'unreadable: {}'.format(exc)}
+    if stats['packets'] < utils.VALIDATE_MIN_PACKETS:
+        reason = 'packets'
+    elif stats['bytes_in'] < utils.VALIDATE_MIN_BYTES_IN:
+        reason = 'bytes_in'
+    elif stats['cell_records'] < utils.VALIDATE_MIN_CELL_RECORDS:
+        reason = 'cell_records'
+    else:
+        reason = ''
+    return dict(stats, valid=not reason, reason=reason)
+
+
+def write_validation(visit_dir, validation):
+    with open(os.path.join(visit_dir, VALIDATION_FILENAME), 'w') as fp:
+        json.dump(validation, fp)
@@ -0,0 +1,183 @@
+from __future__ import annotations
+
+import json
+import os
+import sys
+from collections import namedtuple
+
+import numpy as np
+
+from helper import log, utils
+from helper.pcaputils import PcapReader, open_pcap
+from helper.traceutils import PCAP_FILENAME, iter_visit_dirs
+
+from .manifest import MANIFEST_FILENAME, STATUS_OK, Manifest
+from .metrics import PHASES_FILENAME
+
+sys.path.append('../..')
+
+# dwell, selenium timeout and hard timeout of one visit, and what they were derived from
+Budget = namedtuple('Budget', ['dwell', 'soft_timeout', 'hard_timeout', 'source'])
+
+
+def get_page_open_time(visit_dir):
+    """Wall clock time the visit opened the page, None if it did not finish."""
+    try:
+        with open(os.path.join(visit_dir, PHASES_FILENAME), 'r') as fp:
+            for line in fp:
+                span = json.loads(line)
+                if span['phase'] == 'page_open':
+                    return span['start']
+    except (OSError, ValueError):
+        pass
+    # crawls without phases: the page opens WAIT_AFTER_DUMP after the visit starts
+    try:
+        with open(os.path.join(visit_dir, 'time'), 'r') as fp:
+            start = fp.readline().strip()
+        return float(start) + utils.WAIT_AFTER_DUMP if start not in ('', 'None') else None
+    except (OSError, ValueError):
+        return None
+
+
+def get_load_time(visit_dir, page_open):
+    """Seconds from page_open until BUDGET_LOAD_FRACTION of the bytes captured since then were seen."""
+    times, sizes = [], []
+    with open_pcap(os.path.join(visit_dir, PCAP_FILENAME)) as fp:
+        for sec, nsec, wirelen, _ in PcapReader(fp):
+            timestamp = sec + nsec / 1e9
+            if timestamp >= page_open:
+                times.append(timestamp)
+                sizes.append(wirelen)
+    if not times:
+        return None
+    cumulative = np.cumsum(sizes)
+    last = np.searchsorted(cumulative, utils.BUDGET_LOAD_FRACTION * cumulative[-1])
+    return times[min(last, len(times) - 1)] - page_open
+
+
+class BudgetModel(object):
+    """Per-URL dwell and timeout budgets learned from the load times of previous visits.
+
+    The load time of every successful visit recorded in the manifests of the
+    crawl directories is kept per URL and torrc (the last BUDGET_MAX_SAMPLES
+    of them). A visit gets BUDGET_MARGIN times the BUDGET_QUANTILE of the load
+    times of its URL and torrc, or of its URL under any torrc when those are
+    too few. The samples and the manifest offset of every crawl are cached, so
+    refresh() only reads the pcaps of the visits recorded since the last call.
+    Crawls without a manifest are from before it existed and are walked once.
+    """
+
+    def __init__(self, crawl_dirs=(), cache_path=''):
+        self.crawl_dirs = list(crawl_dirs)
+        self.cache_path = cache_path
+        self.samples: dict[str, dict[str, list[float]]] = {}  # url -> torrc name -> load times
+        self.offsets: dict[str, int | None] = {}  # crawl dir -> manifest offset read, None once walked
+        self.load_cache()
+
+    def add_dir(self, crawl_dir):
+        if crawl_dir not in self.crawl_dirs:
+            self.crawl_dirs.append(crawl_dir)
+
+    def load_cache(self):
+        if not self.cache_path or not os.path.isfile(self.cache_path):
+            return
+        try:
+            with open(self.cache_path, 'r') as fp:
+                cache = json.load(fp)
+        except ValueError:
+            log.wl_log.warning("Ignoring the unreadable budget cache %s" % self.cache_path)
+            return
+        if 'offsets' not in cache:
+            log.wl_log.warning("Ignoring the budget cache %s of an older version" % self.cache_path)
+            return
+        self.samples = cache['samples']
+        self.offsets = cache['offsets']
+
+    def save_cache(self):
+        if not self.cache_path:
+            return
+        # concurrent workers refresh the same cache, each replaces it whole
+        os.makedirs(os.path.dirname(os.path.abspath(self.cache_path)), exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(self.cache_path, os.getpid())
+        with open(tmp_path, 'w') as fp:
+            json.dump({'samples': self.samples, 'offsets': self.offsets}, fp)
+        os.replace(tmp_path, self.cache_path)
+
+    def add_sample(self, url, torrc_path, load_time):
+        samples = self.samples.setdefault(url, {}).setdefault(os.path.basename(torrc_path), [])
+        samples.append(load_time)
+        del samples[:-utils.BUDGET_MAX_SAMPLES]
+
+    def read_visit(self, visit_dir):
+        """Add the load time of a finished visit; return whether the visit is done with."""
+        page_open = get_page_open_time(visit_dir)
+        if page_open is None:
+            return False  # failed, or still running
+        try:
+            with open(os.path.join(visit_dir, 'label'), 'r') as fp:
+                url = fp.readline().strip()
+            with open(os.path.join(visit_dir, 'torrc_path'), 'r') as fp:
+                torrc_path = fp.readline().strip()
+            load_time = get_load_time(visit_dir, page_open)
+        except (OSError, ValueError) as exc:
+            log.wl_log.warning("Cannot read the load time of %s: %s" % (visit_dir, exc))
+            return True
+        if load_time is not None:
+            self.add_sample(url, torrc_path, load_time)
+        return True
+
+    def refresh(self):
+        """Read the visits recorded since the last refresh; return how many were added."""
+        added = 0
+        for crawl_dir in self.crawl_dirs:
+            if not os.path.isdir(crawl_dir):
+                continue
+            key = os.path.abspath(crawl_dir)
+            if os.path.isfile(os.path.join(crawl_dir, MANIFEST_FILENAME)):
+                added += self.read_manifest(key)
+            elif key not in self.offsets:
+                added += self.walk_crawl(key)
+        if added:
+            self.save_cache()
+        return added
+
+    def read_manifest(self, crawl_dir):
+        """Read the successful visits recorded since the cached offset of a crawl."""
+        # a visit is recorded once its directory is complete, and only the unrecorded
+        # or failed ones are removed or moved aside afterwards
+        entries, self.offsets[crawl_dir] = Manifest(crawl_dir).read_from(self.offsets.get(crawl_dir) or 0)
+        added = 0
+        for entry in entries:
+            if entry['status'] != STATUS_OK:
+                continue
+            visit_dir = os.path.join(crawl_dir, 'batch-{}'.format(entry['batch']), 'url-{}'.format(entry['index']))
+            if self.read_visit(visit_dir):
+                added += 1
+        return added
+
+    def walk_crawl(self, crawl_dir):
+        """Read the visits of a finished crawl that has no manifest."""
+        added = 0
+        for visit_dir in iter_visit_dirs(crawl_dir):
+            if os.path.isfile(os.path.join(visit_dir, 'time')) and self.read_visit(visit_dir):
+                added += 1
+        self.offsets[crawl_dir] = None
+        return added
+
+    def get_budget(self, page_url, torrc_path=None, max_dwell=utils.BUDGET_MAX_DWELL):
+        """Return the Budget of a visit, None if the URL has too few samples."""
+        by_torrc = self.samples.get(page_url, {})
+        samples = by_torrc.get(os.path.basename(torrc_path), []) if torrc_path else []
+        source = 'url_torrc'
+        if len(samples) < utils.BUDGET_MIN_SAMPLES:
+            samples = [load_time for load_times in by_torrc.values() for load_time in load_times]
+            source = 'url'
+        if len(samples) < utils.BUDGET_MIN_SAMPLES:
+            return None
+        dwell = utils.BUDGET_MARGIN * float(np.quantile(samples, utils.BUDGET_QUANTILE))
+        dwell = min(max(dwell, utils.ADAPTIVE_MIN_DWELL), max_dwell)
+        soft_timeout = utils.WAIT_AFTER_DUMP + dwell + utils.BUDGET_TIMEOUT_SLACK
+        return Budget(dwell, soft_timeout, soft_timeout + utils.HARD_VISIT_TIMEOUT - utils.SOFT_VISIT_TIMEOUT, source)
+
+    def __len__(self):
+        return len(self.samples)
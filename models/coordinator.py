@@ -0,0 +1,244 @@
+from __future__ import annotations
+
+import json
+import sqlite3
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from helper import log, utils
+
+sys.path.append('../..')
+
+JOBS_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    batch INTEGER NOT NULL,
+    site INTEGER NOT NULL,
+    url TEXT NOT NULL,
+    torrc TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    UNIQUE (batch, site)
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, id);
+'''
+
+
+class JobStore(object):
+    """SQLite table of the (batch, site, url, torrc) jobs of a crawl and their leases.
+
+    A job is pending, leased to a node until its lease expires, done, or
+    failed once it has been leased COORDINATOR_MAX_ATTEMPTS times. Jobs are
+    planned in blocks of `torrc_block` visits sharing a torrc, and a node is
+    leased the rest of its block so that one Tor process serves it.
+    """
+
+    def __init__(self, db_path, lease_timeout=utils.COORDINATOR_LEASE_TIMEOUT,
+                 max_attempts=utils.COORDINATOR_MAX_ATTEMPTS, torrc_block=utils.TORRC_BLOCK_SIZE):
+        self.lease_timeout = lease_timeout
+        self.max_attempts = max_attempts
+        self.torrc_block = torrc_block
+        self.blocks: dict[str, tuple[int, int, str, int]] = {}  # worker -> (id, batch, torrc, run) of its last job
+        self.db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(JOBS_SCHEMA)
+        self.lock = threading.Lock()
+
+    def add_jobs(self, jobs):
+        """Add the jobs unless the store already has them (a restarted coordinator keeps its state)."""
+        with self.lock:
+            if self.db.execute('SELECT COUNT(*) FROM jobs').fetchone()[0]:
+                return False
+            with self.db:
+                self.db.execute('BEGIN')
+                self.db.executemany('INSERT INTO jobs (batch, site, url, torrc) VALUES (?, ?, ?, ?)', jobs)
+            return True
+
+    def lease(self, worker):
+        """Lease the next pending or expired job to the worker; return (job, done)."""
+        now = time.time()
+        with self.lock, self.db:
+            self.db.execute('BEGIN IMMEDIATE')
+            self.db.execute("UPDATE jobs SET state = 'failed' WHERE state = 'leased' AND lease_expires < ? "
+                            "AND attempts >= ?", (now, self.max_attempts))
+            row, run = self.next_in_block(worker, now), 1
+            if row is not None:
+                run = self.blocks[worker][3] + 1
+            else:
+                # leave the next job of the other nodes' blocks to them, unless nothing else is left
+                reserved = []
+                for other in self.blocks:
+                    other_row = self.next_in_block(other, now) if other != worker else None
+                    if other_row:
+                        reserved.append(other_row[0])
+                row = self.next_available(now, reserved) or self.next_available(now)
+            if row is None:
+                leased = self.db.execute("SELECT COUNT(*) FROM jobs WHERE state = 'leased'").fetchone()[0]
+                return None, not leased
+            self.blocks[worker] = (row[0], row[1], row[4], run)
+            self.db.execute("UPDATE jobs SET state = 'leased', worker = ?, lease_expires = ?, "
+                            "attempts = attempts + 1 WHERE id = ?", (worker, now + self.lease_timeout, row[0]))
+            return row[1:], False
+
+    def next_in_block(self, worker, now):
+        """Return the job after the worker's last one if it continues its block."""
+        if worker not in self.blocks:
+            return None
+        job_id, batch, torrc, run = self.blocks[worker]
+        if run >= self.torrc_block:
+            return None
+        return self.db.execute("SELECT id, batch, site, url, torrc FROM jobs WHERE id = ? AND batch = ? AND torrc = ? "
+                               "AND (state = 'pending' OR (state = 'leased' AND lease_expires < ?))",
+                               (job_id + 1, batch, torrc, now)).fetchone()
+
+    def next_available(self, now, excluded=()):
+        return self.db.execute("SELECT id, batch, site, url, torrc FROM jobs WHERE (state = 'pending' "
+                               "OR (state = 'leased' AND lease_expires < ?)) AND id NOT IN ({}) ORDER BY id LIMIT 1"
+                               .format(', '.join('?' * len(excluded))), (now, *excluded)).fetchone()
+
+    def renew(self, worker, jobs):
+        expires = time.time() + self.lease_timeout
+        with self.lock, self.db:
+            self.db.execute('BEGIN')
+            self.db.executemany("UPDATE jobs SET lease_expires = ? WHERE batch = ? AND site = ? AND worker = ? "
+                                "AND state = 'leased'", [(expires, batch, site, worker) for batch, site in jobs])
+
+    def complete(self, worker, batch, site, status):
+        """Close the worker's lease: done if the visit succeeded, else pending again until max_attempts."""
+        with self.lock, self.db:
+            self.db.execute('BEGIN')
+            cursor = self.db.execute(
+                "UPDATE jobs SET state = CASE WHEN ? THEN 'done' WHEN attempts >= ? THEN 'failed' "
+                "ELSE 'pending' END, lease_expires = NULL WHERE batch = ? AND site = ? AND worker = ? "
+                "AND state = 'leased'", (status == 'ok', self.max_attempts, batch, site, worker))
+            return cursor.rowcount == 1
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.db.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall())
+
+
+class CoordinatorHandler(BaseHTTPRequestHandler):
+    """JSON API of the coordinator: POST /lease, /renew and /complete, GET /status."""
+
+    store: JobStore
+
+    def do_GET(self):
+        if self.path == '/status':
+            self.reply(self.store.get_stats())
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        except ValueError:
+            self.send_error(400, 'Invalid JSON')
+            return
+        if not isinstance(request, dict):
+            self.send_error(400, 'Expected a JSON object')
+            return
+        worker = request.get('worker', self.client_address[0])
+        try:
+            if self.path == '/lease':
+                job, done = self.store.lease(worker)
+                self.reply({'job': job, 'done': done, 'torrc_block': self.store.torrc_block})
+            elif self.path == '/renew':
+                self.store.renew(worker, request['jobs'])
+                self.reply({})
+            elif self.path == '/complete':
+                self.reply({'accepted': self.store.complete(worker, request['batch'], request['site'],
+                                                            request['status'])})
+            else:
+                self.send_error(404)
+        except (KeyError, TypeError, ValueError) as exc:
+            self.send_error(400, 'Invalid request: {!r}'.format(exc))
+
+    def reply(self, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # one request per visit and lease renewal, too chatty for the crawl log
+
+
+def make_coordinator_server(store, host='127.0.0.1', port=utils.COORDINATOR_PORT):
+    handler = type('BoundCoordinatorHandler', (CoordinatorHandler,), {'store': store})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+class CoordinatorClient(object):
+    """Pull jobs from a coordinator, renewing the leases of the jobs held until they are completed."""
+
+    def __init__(self, url, worker, lease_timeout=utils.COORDINATOR_LEASE_TIMEOUT):
+        self.url = url.rstrip('/')
+        self.worker = worker
+        self.renew_interval = lease_timeout / 3
+        self.leases: set[tuple[int, int]] = set()
+        self.torrc_block = None  # visits per Tor process the jobs were planned for, sent with each lease
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.renew_thread = None
+
+    def request(self, path, payload):
+        payload = dict(payload, worker=self.worker)
+        request = urllib.request.Request(self.url + path, data=json.dumps(payload).encode(),
+                                         headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(request, timeout=30) as response:
+            return json.load(response)
+
+    def iter_jobs(self):
+        """Yield leased (batch, site, url, torrc) jobs until the coordinator has none left."""
+        if self.renew_thread is None:
+            self.renew_thread = threading.Thread(target=self.renew_leases, name='coordinator-renew', daemon=True)
+            self.renew_thread.start()
+        while not self.stopped.is_set():
+            try:
+                reply = self.request('/lease', {})
+            except (urllib.error.URLError, OSError) as exc:
+                log.wl_log.warning("Cannot reach the coordinator: %s" % exc)
+                self.stopped.wait(utils.COORDINATOR_POLL_INTERVAL)
+                continue
+            self.torrc_block = reply.get('torrc_block', self.torrc_block)
+            if reply['job']:
+                batch, site, url, torrc = reply['job']
+                with self.lock:
+                    self.leases.add((batch, site))
+                yield batch, site, url, torrc
+            elif reply['done']:
+                return
+            else:  # the remaining jobs are leased to other nodes, wait in case a lease expires
+                self.stopped.wait(utils.COORDINATOR_POLL_INTERVAL)
+
+    def complete(self, batch, site, status):
+        with self.lock:
+            self.leases.discard((batch, site))
+        try:
+            if not self.request('/complete', {'batch': batch, 'site': site, 'status': status})['accepted']:
+                log.wl_log.warning("Lease of batch %s site %s had expired" % (batch, site))
+        except (urllib.error.URLError, OSError) as exc:
+            log.wl_log.error("Cannot report batch %s site %s to the coordinator: %s" % (batch, site, exc))
+
+    def renew_leases(self):
+        while not self.stopped.wait(self.renew_interval):
+            with self.lock:
+                leases = list(self.leases)
+            if not leases:
+                continue
+            try:
+                self.request('/renew', {'jobs': leases})
+            except (urllib.error.URLError, OSError) as exc:
+                log.wl_log.warning("Cannot renew leases: %s" % exc)
+
+    def close(self):
+        self.stopped.set()
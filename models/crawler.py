@@ -1,16 +1,38 @@
 from __future__ import annotations
 
 import os
-import random
+import shutil
+import socket
 import sys
+import tempfile
 import time
+import traceback
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
 from shutil import copyfile
 
 from selenium.common.exceptions import TimeoutException
-from .torutils import TorController
+from .coordinator import CoordinatorClient
+from .demux import ContinuousCapture
+from .display import DISPLAY_MODES, DisplayPool
+from .dwell import DwellPolicy
+from .manifest import STATUS_BAD_PAGE, STATUS_INVALID, STATUS_OK, Manifest
+from .metrics import PHASES_FILENAME, CrawlMetrics, MetricsServer, PhaseTimer
+from .profiles import ProfileProvisioner
+from .quota import QuotaScheduler
+from .screens import ScreenshotAnalyzer
+from .session import BrowserSession
+from .storage import DiskGuard, PcapCompressor
+from .torpool import TorPool
+from .torstate import TorState
+from .torutils import TorController, TorNotReadyError, parse_torrc
 from .visit import Visit
+from .workers import WorkerPool, gen_jobs
 
-from helper import utils
+from helper import log, utils
+from helper.screenshots import write_screen_verdict
+from helper.urlsource import UrlSource
+from helper.validation import validate_pcap, write_validation
 
 sys.path.append('../..')
 
@@ -20,7 +42,7 @@ class Crawler():
     Provides methods to collect traffic traces.
     '''
 
-    def __init__(self, torrc_paths: list[str], urls_closeworld_list: list[str], urls_openworld_list: list[str], open_world: bool, tbb_path: str, output: str, xvfb: bool = False, screenshot: bool = False, open_world_start_index: int = 0, open_world_end_index: int = 0) -> None:
+    def __init__(self, torrc_paths: list[str], urls_closeworld_list: list[str], urls_openworld_list: list[str] | UrlSource, open_world: bool, tbb_path: str, output: str, xvfb: bool = False, screenshot: bool = False, open_world_start_index: int = 0, open_world_end_index: int = 0, workers: int = 1, worker_id: int | None = None, dwell_policy: DwellPolicy | None = None, tor_pool_size: int = 0, profile_pool_size: int = 0, tor_state_mode: str = 'persistent', browser_restart_every: int = 0, capture_backend: str = utils.CAPTURE_BACKEND, continuous_capture: bool = False, resume: bool = False, coordinator_url: str = '', pipeline: bool = False, metrics_port: int = 0, quota: int = 0, quota_per_torrc: bool = False, snaplen: int = 0, compress: bool = False, display_mode: str = '', screen_check: bool = False, bad_screens: str = '', torrc_block: int = utils.TORRC_BLOCK_SIZE) -> None:
         # Create instance of Tor controller and sniffer used for the crawler
         self.crawl_dir: str
         self.crawl_logs_dir: str
@@ -28,21 +50,111 @@ class Crawler():
         self.urls_closeworld = urls_closeworld_list
         self.urls_openworld = urls_openworld_list
         self.tbb_path = tbb_path
-        self.xvfb = xvfb
+        # --xvfb alone starts a display per visit
+        self.display_mode = display_mode or ('xvfb' if xvfb else '')
+        assert self.display_mode in DISPLAY_MODES, "Unknown display mode {}".format(display_mode)
+        self.xvfb = self.display_mode in ('xvfb', 'pool')
+        self.headless = self.display_mode == 'headless'
         self.screenshot = screenshot
         self.open_world = open_world
         self.open_world_start_index = open_world_start_index
         self.open_world_end_index = open_world_end_index
         self.torrc_paths = torrc_paths
+        self.torrcs = {torrc_path: parse_torrc(torrc_path) for torrc_path in torrc_paths}  # checked once
+        self.torrc_block = max(torrc_block, 1)
+        self.tor_torrc = None         # torrc of the running Tor process, None to restart it for the next visit
+        self.tor_visits = 0           # visits served by the running Tor process
+        self.announced = (None, 0)    # torrc and run length of the last job announced to the Tor pool
+        self.workers = workers
+        self.worker_id = worker_id
+        self.dwell_policy = dwell_policy or DwellPolicy()
+        self.capture_backend = capture_backend
+        self.resume = resume
+        self.coordinator_url = coordinator_url
+        self.pipeline = pipeline
+        self.metrics_port = metrics_port
+        self.metrics_server = None
+        self.quota = quota
+        self.quota_per_torrc = quota_per_torrc
+        self.snaplen = snaplen
+        self.compressor = None
+        self.display_pool = None
+        self.screen_analyzer = None
+        self.screen_check = screen_check
+        self.requeued = deque()        # jobs whose visit showed a bad page, to visit again
+        self.requeue_counts = Counter()
+        self.socks_port, self.control_port = utils.get_worker_ports(worker_id or 0)
+        self.tor_data_dir = utils.get_worker_tor_data_dir(worker_id or 0)
+        self.visit = None
+        self.worker_pool = None
+        self.tor_pool = None
+        self.profile_provisioner = None
+        self.browser_session = None
+        self.continuous_capture = None
+        self.coordinator = None
+        self.prepare_executor = None
+        self.teardown_executor = None
+        self.next_visit = None        # (job, future of prepare_visit) of the visit prepared in the background
+        self.teardown_future = None   # teardown of the previous visit
+        self.budget_batch = None      # batch of the last refresh of the budget model
+        # arguments to rebuild this crawler inside a worker process
+        self.crawler_kwargs = dict(torrc_paths=torrc_paths, urls_closeworld_list=urls_closeworld_list,
+                                   urls_openworld_list=urls_openworld_list, open_world=open_world,
+                                   tbb_path=tbb_path, output=output, xvfb=xvfb, screenshot=screenshot,
+                                   open_world_start_index=open_world_start_index,
+                                   open_world_end_index=open_world_end_index, workers=workers,
+                                   dwell_policy=self.dwell_policy, tor_pool_size=tor_pool_size,
+                                   profile_pool_size=profile_pool_size, tor_state_mode=tor_state_mode,
+                                   browser_restart_every=browser_restart_every, capture_backend=capture_backend,
+                                   continuous_capture=continuous_capture, resume=resume,
+                                   coordinator_url=coordinator_url, pipeline=pipeline,
+                                   metrics_port=metrics_port, quota=quota, quota_per_torrc=quota_per_torrc,
+                                   snaplen=snaplen, compress=compress, display_mode=display_mode,
+                                   screen_check=screen_check, bad_screens=bad_screens, torrc_block=torrc_block)
 
         # Initializes
         self.init_crawl_dirs(output)
-        self.tor_controller = TorController(tbb_path)
+        self.manifest = Manifest(self.crawl_dir)
+        self.disk_guard = DiskGuard(self.crawl_dir)
+        if self.dwell_policy.budgets is not None:
+            self.dwell_policy.budgets.add_dir(self.crawl_dir)  # learn from the batches of this crawl too
+        self.tor_state = TorState(tor_state_mode)
+        self.tor_controller = TorController(tbb_path, self.socks_port, self.control_port, self.tor_state)
+        self.main_tor_controller = self.tor_controller
+        # the coordinating process of a worker pool never runs Tor or a browser itself
+        if workers == 1 or worker_id is not None:
+            if compress:
+                self.compressor = PcapCompressor()
+            if screen_check:
+                assert screenshot, "Screenshot analysis needs the screenshots"
+                self.screen_analyzer = ScreenshotAnalyzer(bad_screens)
+            if self.display_mode == 'pool':
+                self.display_pool = DisplayPool()
+            if pipeline:
+                self.prepare_executor = ThreadPoolExecutor(1, thread_name_prefix='prepare-visit')
+                self.teardown_executor = ThreadPoolExecutor(1, thread_name_prefix='teardown-visit')
+            if coordinator_url:
+                self.coordinator = CoordinatorClient(coordinator_url,
+                                                     '{}-{}'.format(socket.gethostname(), worker_id or 0))
+            if tor_pool_size:
+                self.tor_pool = TorPool(tbb_path, worker_id or 0, tor_pool_size, tor_state=self.tor_state)
+            if profile_pool_size:
+                self.profile_provisioner = ProfileProvisioner(tbb_path, profile_pool_size)
+            if browser_restart_every:
+                self.browser_session = BrowserSession(
+                    tbb_path, os.path.join(self.crawl_logs_dir, 'firefox-{}.log'.format(worker_id or 0)), self.xvfb,
+                    self.profile_provisioner, browser_restart_every, self.display_pool, self.headless)
+            if continuous_capture:
+                self.continuous_capture = ContinuousCapture(
+                    capture_backend, f'tcp and host {utils.MY_IP}',
+                    os.path.join(self.crawl_logs_dir, 'markers-{}.jsonl'.format(worker_id or 0)), snaplen)
+                self.continuous_capture.start()
 
     def init_crawl_dirs(self, output):
         # Creates results and logs directories for this crawl.
         self.crawl_dir, self.crawl_logs_dir = self.create_crawl_dir(output)
-        self.log_env_variables()
+        if self.worker_id is None:  # workers share the directory of the main crawler
+            self.log_env_variables()
 
     def create_crawl_dir(self, output):
         # Create a timestamped crawl.
@@ -79,90 +191,518 @@ class Crawler():
             for torrc_path in self.torrc_paths:
                 f.write(torrc_path+"\n")
             f.write("open_world: "+str(self.open_world)+"\n")
+            f.write("torrc_block: "+str(self.torrc_block)+"\n")
+            f.write("tor_pool_size: "+str(self.crawler_kwargs['tor_pool_size'])+"\n")
+            f.write("profile_pool_size: "+str(self.crawler_kwargs['profile_pool_size'])+"\n")
+            f.write("tor_state: "+self.crawler_kwargs['tor_state_mode']+"\n")
+            f.write("browser_restart_every: "+str(self.crawler_kwargs['browser_restart_every'])+"\n")
+            f.write("capture: "+self.capture_backend+"\n")
+            f.write("continuous_capture: "+str(self.crawler_kwargs['continuous_capture'])+"\n")
+            f.write("resume: "+str(self.resume)+"\n")
+            f.write("coordinator: "+self.coordinator_url+"\n")
+            f.write("pipeline: "+str(self.pipeline)+"\n")
+            f.write("quota: {}{}\n".format(self.quota, ' per torrc' if self.quota_per_torrc else ''))
+            f.write("snaplen: "+str(self.snaplen)+"\n")
+            f.write("compress: "+str(self.crawler_kwargs['compress'])+"\n")
+            f.write("display: "+(self.display_mode or 'none')+"\n")
+            f.write("screen_check: {}{}\n".format(self.screen_check, ' ' + self.crawler_kwargs['bad_screens'] if self.crawler_kwargs['bad_screens'] else ''))
+            f.write("dwell: {} min {} max {} quiet {}\n".format(self.dwell_policy.mode, self.dwell_policy.min_dwell,
+                                                                 self.dwell_policy.max_dwell, self.dwell_policy.quiet_period))
+            if self.dwell_policy.budgets is not None:
+                f.write("budgets: {} urls from {}\n".format(len(self.dwell_policy.budgets),
+                                                            ' '.join(self.dwell_policy.budgets.crawl_dirs)))
 
         # Dump urllist
         with open(os.path.join(self.crawl_dir, "urls-crawled.csv"), 'w') as f:
-            if self.open_world:
-                [f.write(i+'\n') for i in self.urls_openworld[self.open_world_start_index:self.open_world_end_index]]
-            else:
-                [f.write(i+'\n') for i in self.urls_closeworld]
+            for url in self.get_url_list():
+                f.write(url+'\n')
+
+    def get_url_list(self):
+        return self.urls_openworld[self.open_world_start_index:
+                                   self.open_world_end_index] if self.open_world else self.urls_closeworld
+
+    def gen_jobs(self, num_batches):
+        """Return the (batch, site, url, torrc) jobs of the crawl, shuffled per batch."""
+        return gen_jobs(self.get_url_list(), self.torrc_paths, num_batches, self.torrc_block)
+
+    def plan_jobs(self, num_batches):
+        """Return the jobs to visit: a new schedule, or what is left of the saved one when resuming."""
+        schedule = self.manifest.read_schedule() if self.resume else None
+        if schedule is None:
+            schedule = self.gen_jobs(num_batches)
+            self.manifest.write_schedule(schedule)
+            return schedule
+        jobs = self.manifest.get_pending_jobs(schedule)
+        print("INFO\tResuming crawl: {} of {} visits left".format(len(jobs), len(schedule)))
+        return jobs
+
+    def get_quota_jobs(self):
+        """Return the jobs of a quota crawl, issued as the outcome of the previous visits is known."""
+        if self.workers > 1:
+            max_in_flight = 2 * self.workers  # a queued job for each busy worker
+        else:
+            # the pending jobs of run_jobs(), and the visit torn down in the background when pipelining
+            max_in_flight = (self.tor_pool.size if self.tor_pool else 0) + (3 if self.pipeline else 1)
+        scheduler = QuotaScheduler(self.get_url_list(), self.torrc_paths, self.quota, self.manifest,
+                                   self.quota_per_torrc, max_in_flight)
+        return scheduler.iter_jobs()
 
     def crawl(self, num_batches=10):
-        activate_torrc_path = None
-        url_list = self.urls_openworld[self.open_world_start_index:
-                                       self.open_world_end_index] if self.open_world else self.urls_closeworld
+        url_list = self.get_url_list()
         # for each batch
-        print("INFO\tCrawl configuration: batches: {0}, number: {1}, crawl dir: {2}".format
-              (num_batches, len(url_list), self.crawl_dir))
+        if self.quota:
+            print("INFO\tCrawl configuration: quota: {0}{1}, number: {2}, workers: {3}, crawl dir: {4}".format
+                  (self.quota, ' per torrc' if self.quota_per_torrc else '', len(url_list), self.workers,
+                   self.crawl_dir))
+        else:
+            print("INFO\tCrawl configuration: batches: {0}, number: {1}, workers: {2}, crawl dir: {3}".format
+                  (num_batches, len(url_list), self.workers, self.crawl_dir))
+
+        # with a coordinator, every worker leases its own jobs
+        if self.coordinator_url:
+            jobs = []
+        elif self.quota:
+            jobs = self.get_quota_jobs()
+        else:
+            jobs = self.plan_jobs(num_batches)
+        if self.metrics_port:
+            # the coordinator knows the remaining jobs of the whole crawl, a node doesn't
+            metrics = CrawlMetrics(self.manifest, None if self.coordinator_url or self.quota else len(jobs))
+            self.metrics_server = MetricsServer(metrics, self.metrics_port)
+            self.metrics_server.start()
+        if self.workers > 1:
+            self.worker_pool = WorkerPool(self.workers, run_crawl_worker, (self.crawler_kwargs,))
+            self.worker_pool.run(jobs)
+            return
+        self.run_jobs(self.coordinator.iter_jobs() if self.coordinator else jobs)
+
+    def crawl_queue(self, job_queue):
+        """Visit the jobs of a shared queue until the sentinel is reached, or those of the coordinator."""
+        self.run_jobs(self.coordinator.iter_jobs() if self.coordinator else iter(job_queue.get, None))
+
+    def run_jobs(self, jobs):
+        """Visit the jobs in order, announcing the torrcs of the next ones to the Tor pool."""
+        lookahead = (self.tor_pool.size if self.tor_pool else 0) + (1 if self.pipeline else 0)
+        pending = deque()
+        for job in jobs:
+            if job is None:  # a quota scheduler waits for the outcome of the visits in flight
+                if pending:
+                    self.visit_next(pending)
+                elif self.teardown_future:
+                    self.wait_teardown()
+                else:
+                    time.sleep(utils.QUOTA_POLL_INTERVAL)
+                continue
+            if self.coordinator and self.coordinator.torrc_block:
+                self.torrc_block = self.coordinator.torrc_block  # the coordinator planned the blocks
+            pending.append(job)
+            self.announce(job[3])
+            self.requeue(pending)
+            if len(pending) > lookahead:
+                self.visit_next(pending)
+        while True:
+            while pending:
+                self.visit_next(pending)
+            self.wait_teardown()
+            if not self.requeue(pending):
+                break
+
+    def requeue(self, pending):
+        """Move the jobs to visit again to the pending ones; return whether there were any."""
+        requeued = False
+        while self.requeued:
+            job = self.requeued.popleft()
+            pending.append(job)
+            self.announce(job[3])
+            requeued = True
+        return requeued
 
-        for batch_num in range(num_batches):
+    def announce(self, torrc_path):
+        """Tell the Tor pool about an upcoming visit that starts a block, and so a Tor process, of its torrc."""
+        if not self.tor_pool:
+            return
+        torrc, run = self.announced
+        if torrc_path == torrc and run < self.torrc_block:
+            self.announced = torrc, run + 1
+            return
+        self.announced = torrc_path, 1
+        self.tor_pool.schedule(torrc_path, self.load_torrc(torrc_path))
+
+    def visit_next(self, pending):
+        """Visit the first pending job; when pipelining, prepare the one after it meanwhile."""
+        self.disk_guard.wait()
+        job = pending.popleft()
+        prepared = None
+        if self.next_visit and self.next_visit[0] == job:
+            prepared = self.next_visit[1]
+        self.next_visit = None
+        if self.pipeline and pending:
+            self.next_visit = (pending[0], self.prepare_executor.submit(self.prepare_visit, *pending[0]))
+        status = self.crawl_url(*job, prepared=prepared, retry=utils.VALIDATE_RETRIES > 0)
+        for attempt in range(1, utils.VALIDATE_RETRIES + 1):
+            if status != STATUS_INVALID:
+                break
+            print("WARNING\tInvalid capture of {}, visiting it again".format(job[2]))
+            time.sleep(utils.INTERVAL_BETWEEN_VISIT)
+            status = self.crawl_url(*job, retry=attempt < utils.VALIDATE_RETRIES)
+        time.sleep(utils.INTERVAL_BETWEEN_VISIT)
+
+    def get_capture_filter(self):
+        """Return the capture filter for the next visit.
+
+        Concurrent workers and pre-warmed Tor processes share the network
+        interface, so only the relay connections of the visit's own Tor
+        process are recorded. The filter is a snapshot of the connections
+        open when the visit starts: a relay connection Tor opens during the
+        visit is not captured; the continuous capture follows new connections,
+        so data_collector.py requires it with workers or a Tor pool.
+        """
+        capture_filter = f'tcp and host {utils.MY_IP}'
+        if self.workers > 1 or self.tor_pool:
+            connections = ['(host {} and port {} and port {})'.format(*conn)
+                           for conn in self.tor_controller.get_or_connections()]
+            if not connections:
+                connections = ['(host {} and port {})'.format(*endpoint)
+                               for endpoint in self.tor_controller.get_guard_endpoints()]
+            if connections:
+                capture_filter += ' and ({})'.format(' or '.join(connections))
+        return capture_filter
+
+    def get_sniffer(self):
+        """Return the sniffer of the next visit, None to let the visit start its own."""
+        if not self.continuous_capture:
+            return None
+        # the continuous capture sees every Tor process, keep the visit's own connections;
+        # the visit adds those Tor opens later
+        connections = None
+        if self.workers > 1 or self.tor_pool:
+            connections = self.tor_controller.get_or_connections() or None
+        return self.continuous_capture.new_sniffer(connections)
+
+    def load_torrc(self, torrc_path):
+        """Return a copy of the stem config dict of a torrc."""
+        if torrc_path not in self.torrcs:
+            self.torrcs[torrc_path] = parse_torrc(torrc_path)
+        return {key: list(values) for key, values in self.torrcs[torrc_path].items()}
+
+    def can_reuse_tor(self, torrc_path):
+        """Whether the running Tor process can serve the next visit of the torrc."""
+        tor_process = self.tor_controller.tor_process
+        return (torrc_path == self.tor_torrc and self.tor_visits < self.torrc_block and
+                tor_process is not None and tor_process.poll() is None)
+
+    def restart_tor(self, torrc_path, phase_timer=None):
+        """Switch to a ready Tor process for the torrc, from the pool if it has one.
+
+        Consecutive visits with the same torrc keep the running process, up
+        to torrc_block visits, and get a new identity instead.
+        """
+        phase_timer = phase_timer or PhaseTimer()
+        if self.can_reuse_tor(torrc_path):
+            print("INFO\tReusing Tor for visit {} of its block".format(self.tor_visits + 1))
+            try:
+                with phase_timer.phase('tor_reset'):
+                    # a fresh DataDirectory per process means fresh guards per visit; the browser session sends NEWNYM
+                    self.tor_controller.reset_identity(drop_guards=self.tor_state.mode != 'persistent',
+                                                       newnym=not self.browser_session)
+                self.tor_visits += 1
+                return
+            except Exception as exc:
+                log.wl_log.warning("Cannot reset the identity of Tor, restarting it: %s" % exc)
+        self.tor_torrc, self.tor_visits = None, 0
+        with phase_timer.phase('tor_kill'):
+            if self.tor_controller is not self.main_tor_controller:
+                self.tor_pool.release(self.tor_controller)  # used pool processes are never reused
+                self.tor_controller = self.main_tor_controller
+            else:
+                self.tor_controller.kill_tor_proc()
+
+        if self.tor_pool:
+            with phase_timer.phase('tor_acquire'):
+                tor_controller = self.tor_pool.acquire(torrc_path)
+            if tor_controller:
+                print("INFO\tUsing pre-warmed Tor on port {}".format(tor_controller.socks_port))
+                self.tor_controller = tor_controller
+                self.tor_torrc, self.tor_visits = torrc_path, 1
+                return
+
+        conf = self.load_torrc(torrc_path)
+        conf['SOCKSPort'] = [str(self.socks_port)]
+        conf['ControlPort'] = [str(self.control_port)]
+        conf['DataDirectory'] = [self.tor_data_dir]
+        self.tor_controller.restart_tor(conf, phase_timer=phase_timer)
+        self.tor_torrc, self.tor_visits = torrc_path, 1
+
+    def get_url_dir(self, batch_num, site_num):
+        return os.path.join(self.crawl_dir, 'batch-'+str(batch_num), 'url-'+str(site_num))
+
+    def prepare_visit(self, batch_num, site_num, page_url, torrc_path):
+        """Create the visit dir and the display of its browser; nothing here touches Tor or the network."""
+        url_dir = self.get_url_dir(batch_num, site_num)
+        utils.create_dir(os.path.dirname(url_dir))
+        if self.resume:
+            shutil.rmtree(url_dir, ignore_errors=True)  # leftovers of the interrupted visit
+        utils.create_dir(url_dir)
+        with open(os.path.join(url_dir, 'label'), 'w') as fp:
+            fp.write(page_url+'\n')
+        with open(os.path.join(url_dir, 'torrc_path'), 'w') as fp:
+            fp.write(torrc_path+'\n')
+        # a persistent browser session keeps its own display
+        xvfb_display = None
+        if self.xvfb and not self.browser_session:
+            xvfb_display = self.display_pool.acquire() if self.display_pool else utils.start_xvfb()
+        return url_dir, xvfb_display
+
+    def release_display(self, xvfb_display):
+        """Stop a display prepared for a visit, or return it to the pool."""
+        if self.display_pool:
+            self.display_pool.release(xvfb_display)
+        else:
+            utils.stop_xvfb(xvfb_display)
+
+    def crawl_url(self, batch_num, site_num, page_url, activate_torrc_path, prepared=None, retry=False):
+        """Visit a single url and store its traces in batch-<batch_num>/url-<site_num>.
+
+        `prepared` is the future of prepare_visit() run in the background while
+        the previous visit dwelled. With `retry`, an invalid visit is visited
+        again right away, so its record does not close the job. Return the
+        status of the visit.
+        """
+        if site_num == 0:
             print("INFO\tStarting batch {} in {}".format(batch_num, utils.cal_now_time()))
-            site_num = 0
-            batch_dir = utils.create_dir(os.path.join(self.crawl_dir, 'batch-'+str(batch_num)))
-
-            # sites_crawled_with_same_proc = 0
-            random.shuffle(url_list)
-            for page_url in url_list:
-                print('INFO\tCrawling {} url: {} in {}'.format(site_num, page_url, utils.cal_now_time()))
-                url_dir = utils.create_dir(os.path.join(batch_dir, 'url-'+str(site_num)))
-                print("INFO\tRestarting Tor in {}".format(utils.cal_now_time()))
-                activate_torrc_path = random.choice(self.torrc_paths)
-                # analyse torrc
-                assert os.path.isfile(activate_torrc_path), "Invalid torrc path{}".format(activate_torrc_path)
-                with open(activate_torrc_path, 'r') as f:
-                    lines = f.readlines()
-                    lines = [line.strip().split(' ', 1) for line in lines]
-                    lines = [line for line in lines if len(line) == 2]
-                    conf = {}
-                    conf = {line[0]: line[1] for line in conf if line[0]}
-                    for line in lines:
-                        if line[0] not in conf:
-                            conf[line[0]] = []
-                        conf[line[0]].append(line[1])
-                conf['DataDirectory'] = ['/root/.tor']
-                self.tor_controller.restart_tor(conf)
-
-                with open(os.path.join(url_dir, 'label'), 'w') as fp:
-                    fp.write(page_url+'\n')
-                with open(os.path.join(url_dir, 'torrc_path'), 'w') as fp:
-                    fp.write(activate_torrc_path+'\n')
-
-                self.visit = None
-                try:
-                    print("INFO\tInit visit in {}".format(utils.cal_now_time()))
-                    self.visit = Visit(page_url, url_dir,
-                                       self.tor_controller, self.tbb_path, self.xvfb, self.screenshot)
-                    print("INFO\tStart visit in {}".format(utils.cal_now_time()))
-                    start_time = time.time()
-                    self.visit.get()
-                    end_time = time.time()
-                    with open(os.path.join(url_dir, 'time'), 'w') as fp:
-                        fp.write(f'{start_time}\n')
-                        fp.write(f'{end_time}\n')
-                    # delete chched files
-                    for filename in os.listdir(os.path.join(url_dir, "torlog")):
-                        if "cached" in filename:
-                            os.remove(os.path.join(url_dir, "torlog", filename))
-                except KeyboardInterrupt:  # CTRL + C
-                    raise KeyboardInterrupt
-                except TimeoutException as exc:
-                    print("CRITICAL\tVisit timed out! %s %s" % (exc, type(exc)))
-                    if self.visit:
-                        self.visit.cleanup_visit()
-                except Exception as exc:
-                    print("CRITICAL\tException crawling: %s" % exc)
-                    if self.visit:
-                        self.visit.cleanup_visit()
-                # END - for each visit
-                site_num += 1
-                time.sleep(utils.INTERVAL_BETWEEN_VISIT)
+        print('INFO\tCrawling {} url: {} in {}'.format(site_num, page_url, utils.cal_now_time()))
+        if self.dwell_policy.budgets is not None and (self.budget_batch is None or batch_num > self.budget_batch):
+            added = self.dwell_policy.budgets.refresh()
+            print("INFO\tBudget model updated with {} visits".format(added))
+            self.budget_batch = batch_num
+        budget = self.dwell_policy.get_budget(page_url, activate_torrc_path)
+        print("INFO\tBudget ({}): dwell {:.1f}s, timeout {:.0f}s".format(budget.source, budget.dwell,
+                                                                      budget.soft_timeout))
+        visit_start = time.time()
+        phase_timer = PhaseTimer()
+        url_dir, xvfb_display = self.get_url_dir(batch_num, site_num), None
+        try:
+            with phase_timer.phase('prepare'):
+                if prepared:
+                    url_dir, xvfb_display = prepared.result()
+                else:
+                    url_dir, xvfb_display = self.prepare_visit(batch_num, site_num, page_url, activate_torrc_path)
+        except KeyboardInterrupt:
+            raise
+        except Exception as exc:
+            # e.g. Xvfb did not start: only this visit fails
+            print("CRITICAL\tCannot prepare the visit, skipping it: %s" % exc)
+            self.release_display(xvfb_display)
+            os.makedirs(url_dir, exist_ok=True)
+            self.record_visit(batch_num, site_num, page_url, activate_torrc_path, 'failed', visit_start,
+                              url_dir, phase_timer)
+            return 'failed'
+        print("INFO\tRestarting Tor in {}".format(utils.cal_now_time()))
+        try:
+            self.restart_tor(activate_torrc_path, phase_timer)
+        except TorNotReadyError as exc:
+            print("CRITICAL\tTor is not ready, skipping visit: %s" % exc)
+            self.tor_torrc = None
+            self.release_display(xvfb_display)
+            self.record_visit(batch_num, site_num, page_url, activate_torrc_path, 'tor_not_ready', visit_start,
+                              url_dir, phase_timer)
+            return 'tor_not_ready'
+        with open(os.path.join(url_dir, 'bootstrap'), 'w') as fp:
+            for tag, duration in self.tor_controller.bootstrap_phases:
+                fp.write(f'{tag} {duration}\n')
+
+        self.visit = None
+        start_time = end_time = None
+        try:
+            print("INFO\tInit visit in {}".format(utils.cal_now_time()))
+            with phase_timer.phase('browser_start'):
+                tb_driver = self.browser_session.get_driver(self.tor_controller) if self.browser_session else None
+                self.visit = Visit(page_url, url_dir,
+                                   self.tor_controller, self.tbb_path, self.xvfb, self.screenshot,
+                                   capture_filter=self.get_capture_filter(), dwell_policy=self.dwell_policy,
+                                   profile_provisioner=self.profile_provisioner, tb_driver=tb_driver,
+                                   capture_backend=self.capture_backend, sniffer=self.get_sniffer(),
+                                   xvfb_display=xvfb_display, phase_timer=phase_timer, budget=budget,
+                                   snaplen=self.snaplen, display_pool=self.display_pool, headless=self.headless)
+            xvfb_display = None  # stopped by the visit from now on
+            # the previous visit must be fully torn down before this capture starts
+            with phase_timer.phase('teardown_wait'):
+                self.wait_teardown()
+            print("INFO\tStart visit in {}".format(utils.cal_now_time()))
+            start_time = time.time()
+            self.visit.get(teardown=False)
+            end_time = time.time()
+            screen = None
+            if self.screen_analyzer and self.visit.screenshot_path:
+                screen = self.screen_analyzer.submit(self.visit.screenshot_path)
+        except KeyboardInterrupt:  # CTRL + C
+            raise KeyboardInterrupt
+        except Exception as exc:
+            if isinstance(exc, (TimeoutException, utils.TimeExceededError)):
+                print("CRITICAL\tVisit timed out! %s %s" % (exc, type(exc)))
+                status = 'timeout'
+            else:
+                print("CRITICAL\tException crawling: %s" % exc)
+                status = 'failed'
+            self.tor_torrc = None  # start the next visit on a new Tor process
+            with phase_timer.phase('cleanup'):
+                if self.visit:
+                    self.visit.cleanup_visit()
+                self.release_display(xvfb_display)
+            self.record_visit(batch_num, site_num, page_url, activate_torrc_path, status, visit_start,
+                              url_dir, phase_timer, load_start=start_time, load_end=end_time)
+            return status
+
+        visit, self.visit = self.visit, None
+        with phase_timer.phase('validate'):
+            validation = validate_pcap(visit.pcap_path, utils.MY_IP)
+            write_validation(url_dir, validation)
+        if not validation['valid']:
+            print("CRITICAL\tInvalid capture ({}): {} packets, {} bytes in".format(
+                validation['reason'], validation.get('packets'), validation.get('bytes_in')))
+            self.tor_torrc = None
+            # finished in the foreground, its directory is moved aside for the next attempt
+            self.finish_visit(visit, batch_num, site_num, activate_torrc_path, visit_start, start_time, end_time,
+                              STATUS_INVALID, invalid=validation['reason'], retried=retry)
+            self.move_invalid_visit(url_dir)
+            return STATUS_INVALID
+        if self.pipeline:
+            self.teardown_future = self.teardown_executor.submit(
+                self.finish_visit, visit, batch_num, site_num, activate_torrc_path, visit_start, start_time, end_time,
+                screen=screen)
+        else:
+            self.finish_visit(visit, batch_num, site_num, activate_torrc_path, visit_start, start_time, end_time,
+                              screen=screen)
+        return STATUS_OK
+
+    def move_invalid_visit(self, url_dir):
+        """Keep an invalid visit in <batch dir>/invalid, out of the way of the visits of the crawl."""
+        invalid_dir = os.path.join(os.path.dirname(url_dir), 'invalid')
+        os.makedirs(invalid_dir, exist_ok=True)
+        # a unique name: the teardown thread and the foreground may move visits aside at once
+        target = tempfile.mkdtemp(prefix=os.path.basename(url_dir) + '-', dir=invalid_dir)
+        os.replace(url_dir, target)  # onto the empty directory just made
+
+    def finish_visit(self, visit, batch_num, site_num, torrc_path, visit_start, start_time, end_time,
+                     status=STATUS_OK, screen=None, **extra):
+        """Tear down a visit whose capture is stopped and store its results.
+
+        `screen` is the future of the hash of the visit's screenshot, which
+        is checked once the browser has quit.
+        """
+        try:
+            with visit.phase_timer.phase('cleanup'):
+                visit.teardown()
+        except Exception:
+            log.wl_log.error("Error tearing down the visit of %s" % visit.page_url, exc_info=True)
+        with open(os.path.join(visit.url_dir, 'time'), 'w') as fp:
+            fp.write(f'{start_time}\n')
+            fp.write(f'{end_time}\n')
+        with open(os.path.join(visit.url_dir, 'dwell'), 'w') as fp:
+            fp.write(f'{visit.dwell_time}\n')
+            fp.write(f'{visit.dwell_reason}\n')
+        if visit.sniffer.stats:
+            with open(os.path.join(visit.url_dir, 'capture'), 'w') as fp:
+                for key, value in visit.sniffer.stats.items():
+                    fp.write(f'{key} {value}\n')
+        if screen:
+            with visit.phase_timer.phase('screen_check'):
+                verdict = self.screen_analyzer.get_verdict(visit.page_url, screen)
+            write_screen_verdict(visit.url_dir, verdict)
+            extra['screen'] = verdict['verdict']
+            if verdict['verdict'] == 'bad':
+                print("CRITICAL\tScreenshot of {} shows the bad page {}".format(visit.page_url, verdict['match']))
+                status = STATUS_BAD_PAGE
+            elif verdict['verdict'] == 'outlier':
+                print("WARNING\tScreenshot of {} differs from its earlier ones by {} bits".format(
+                    visit.page_url, verdict['distance']))
+        self.record_visit(batch_num, site_num, visit.page_url, torrc_path, status, visit_start,
+                          visit.url_dir, visit.phase_timer, load_start=start_time, load_end=end_time, **extra)
+        if self.compressor and status == STATUS_OK:
+            self.compressor.submit(visit.pcap_path)
+        if status == STATUS_BAD_PAGE:
+            self.move_invalid_visit(visit.url_dir)
+            job = (batch_num, site_num, visit.page_url, torrc_path)
+            # a quota or a coordinator schedules the failed visits again itself
+            if not (self.quota or self.coordinator) and self.requeue_counts[job] < utils.SCREENSHOT_RETRIES:
+                self.requeue_counts[job] += 1
+                self.requeued.append(job)
+
+    def wait_teardown(self):
+        """Wait for the background teardown of the previous visit."""
+        if self.teardown_future:
+            try:
+                self.teardown_future.result()
+            except Exception:
+                log.wl_log.error("Error finishing the previous visit", exc_info=True)
+            self.teardown_future = None
+
+    def record_visit(self, batch_num, site_num, page_url, torrc_path, status, visit_start, url_dir, phase_timer,
+                     **extra):
+        """Store the phases and outcome of a visit, and report it to the coordinator."""
+        phase_timer.write(os.path.join(url_dir, PHASES_FILENAME))
+        self.manifest.record(batch_num, site_num, page_url, torrc_path, status, visit_start, time.time(),
+                             worker=self.worker_id or 0, phases=phase_timer.get_durations(), **extra)
+        if self.coordinator and not extra.get('retried'):  # the lease is kept for the next attempt
+            self.coordinator.complete(batch_num, site_num, status)
 
     def stop_crawl(self, pack_results=True):
         """ Cleans up crawl and kills tor process in case it's running."""
         print("Stopping crawl...")
+        if self.worker_pool:
+            self.worker_pool.terminate()
         if self.visit:
             self.visit.cleanup_visit()
-        self.tor_controller.kill_tor_proc()
+        self.wait_teardown()
+        if self.next_visit:
+            try:
+                self.release_display(self.next_visit[1].result()[1])
+            except Exception:
+                pass
+            self.next_visit = None
+        for executor in (self.prepare_executor, self.teardown_executor):
+            if executor:
+                executor.shutdown()
+        if self.browser_session:
+            self.browser_session.stop()
+        if self.display_pool:
+            self.display_pool.close()
+        if self.tor_pool:
+            if self.tor_controller is not self.main_tor_controller:
+                self.tor_pool.release(self.tor_controller)
+            self.tor_pool.close()
+        self.main_tor_controller.kill_tor_proc()
+        if self.profile_provisioner:
+            self.profile_provisioner.close()
+        if self.continuous_capture:
+            self.continuous_capture.stop()
+        if self.compressor:
+            self.compressor.close()
+        if self.screen_analyzer:
+            self.screen_analyzer.close()
+        if self.coordinator:
+            self.coordinator.close()
+        if self.metrics_server:
+            self.metrics_server.stop()
+        if self.worker_id is None:
+            spread = self.manifest.write_torrc_balance(self.torrc_paths)
+            print("INFO\tTorrc balance written, successful visits of a URL differ by up to {} over the torrcs".format(
+                spread))
+
+
+def run_crawl_worker(worker_id, job_queue, crawler_kwargs):
+    """Entry point of a crawl worker process."""
+    crawler = Crawler(worker_id=worker_id, **crawler_kwargs)
+    print("INFO\tWorker {} uses socks port {} and control port {}".format(
+        worker_id, crawler.socks_port, crawler.control_port))
+    try:
+        crawler.crawl_queue(job_queue)
+    except KeyboardInterrupt:
+        log.wl_log.warning("WARNING\tWorker {} interrupted in {}".format(worker_id, utils.cal_now_time()))
+    except Exception:
+        log.wl_log.error("ERROR\tException in worker {}: \n {}".format(worker_id, traceback.format_exc()))
+    finally:
+        crawler.stop_crawl()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,195 @@
+from __future__ import annotations
+
+import json
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+from .dumputils import RingCapture, Sniffer, get_capture_engine
+
+from helper import log, utils
+from helper.pcaputils import LINKTYPE_ETHERNET, PCAP_MAX_SNAPLEN, PcapReader, PcapWriter, parse_tcp_packet
+
+sys.path.append('../..')
+
+
+class VisitSegment(object):
+    """The part of the continuous stream that belongs to one visit."""
+
+    def __init__(self, writer, start_ns, connections=None):
+        self.writer = writer
+        self.start_ns = start_ns
+        self.end_ns = None
+        # (remote address, remote port, local port) of the visit's Tor process, None for all packets
+        self.connections = None
+        if connections:
+            self.connections = set()
+            self.add_connections(connections)
+        self.closed = threading.Event()
+
+    def add_connections(self, connections):
+        self.connections.update((socket.inet_aton(raddr), rport, lport) for raddr, rport, lport in connections)
+
+    def matches(self, data, linktype):
+        if self.connections is None:
+            return True
+        packet = parse_tcp_packet(data, linktype)
+        if packet is None:
+            return False
+        src, dst, sport, dport = packet[:4]
+        return (src, sport, dport) in self.connections or (dst, dport, sport) in self.connections
+
+
+class VisitDemuxer(object):
+    """Cut one continuous packet stream into per-visit pcap files."""
+
+    def __init__(self, snaplen=PCAP_MAX_SNAPLEN, linktype=LINKTYPE_ETHERNET):
+        self.snaplen = snaplen
+        self.linktype = linktype
+        self.segments: list[VisitSegment] = []
+        self.lock = threading.Lock()
+
+    def open_visit(self, pcap_path, start_ns, connections=None):
+        segment = VisitSegment(PcapWriter(pcap_path, self.snaplen, self.linktype), start_ns, connections)
+        with self.lock:
+            self.segments.append(segment)
+        return segment
+
+    def add_connections(self, segment, connections):
+        """Also keep the packets of these connections in a visit that filters on its Tor's connections."""
+        with self.lock:
+            if segment.connections is not None:
+                segment.add_connections(connections)
+
+    def close_visit(self, segment, end_ns, grace=utils.DEMUX_GRACE):
+        """Close the visit's pcap once the stream has gone past `end_ns`, or after `grace` seconds."""
+        with self.lock:
+            segment.end_ns = end_ns
+        if not segment.closed.wait(grace):
+            with self.lock:
+                self.finish(segment)
+
+    def finish(self, segment):
+        if segment in self.segments:
+            self.segments.remove(segment)
+            segment.writer.close()
+            segment.closed.set()
+
+    def feed(self, sec, nsec, wirelen, data):
+        ts_ns = sec * 10 ** 9 + nsec
+        with self.lock:
+            for segment in list(self.segments):
+                if segment.end_ns is not None and ts_ns > segment.end_ns:
+                    self.finish(segment)
+                elif ts_ns >= segment.start_ns and segment.matches(data, self.linktype):
+                    segment.writer.write(sec, nsec, wirelen, data)
+
+
+class ContinuousCapture(object):
+    """Run a single capture for the whole crawl of a worker.
+
+    Each visit writes start/end markers taken from the monotonic clock
+    (mapped onto the wall clock of the packet timestamps when the visit
+    starts), and the demultiplexer streams the packets between them into the
+    visit's pcap.
+    """
+
+    def __init__(self, backend, pcap_filter, markers_path, snaplen=0):
+        self.backend = backend
+        self.pcap_filter = '({}) and not port 22'.format(pcap_filter)
+        self.snaplen = snaplen or PCAP_MAX_SNAPLEN
+        self.markers_path = markers_path
+        self.demuxer = VisitDemuxer(self.snaplen)
+        self.capture = None
+        self.proc = None
+        self.reader_thread = None
+
+    def start(self):
+        if self.backend == 'native':
+            self.capture = RingCapture(utils.CAPTURE_INTERFACE, self.pcap_filter, self.snaplen, self.demuxer.feed)
+            get_capture_engine().add(self.capture)
+        else:
+            self.start_tcpdump()
+        print("INFO\tContinuous {} capture started in {}".format(self.backend, utils.cal_now_time()))
+
+    def start_tcpdump(self):
+        command = ['sudo', 'tcpdump', '-p', '-U', '-s', str(self.snaplen), '-i', utils.CAPTURE_INTERFACE,
+                   '-w', '-', self.pcap_filter]
+        self.proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        # tcpdump reports on stderr once the interface is open
+        for line in self.proc.stderr:
+            if b'listening on' in line:
+                break
+        else:
+            raise RuntimeError('tcpdump exited with code {}'.format(self.proc.wait()))
+        reader = PcapReader(self.proc.stdout)
+        self.demuxer.linktype = reader.linktype
+        self.reader_thread = threading.Thread(target=self.read_stream, args=(reader,), name='tcpdump-reader',
+                                              daemon=True)
+        self.reader_thread.start()
+
+    def read_stream(self, reader):
+        for sec, nsec, wirelen, data in reader:
+            self.demuxer.feed(sec, nsec, wirelen, data)
+        log.wl_log.warning("Continuous tcpdump stream ended")
+
+    def mark(self, event, pcap_path, ts_ns, wall_offset_ns):
+        with open(self.markers_path, 'a') as fp:
+            fp.write(json.dumps({'event': event, 'path': pcap_path, 'wall_ns': ts_ns,
+                                 'monotonic_ns': ts_ns - wall_offset_ns}) + '\n')
+
+    def new_sniffer(self, connections=None):
+        """Return a sniffer recording the next visit from this capture."""
+        return DemuxSniffer(self, connections)
+
+    def stop(self):
+        if self.capture:
+            get_capture_engine().remove(self.capture)
+            self.capture = None
+        if self.proc:
+            utils.kill_all_children(self.proc.pid)
+            self.proc.kill()
+            self.proc = None
+
+
+class DemuxSniffer(Sniffer):
+    """Sniffer interface over a ContinuousCapture: start/stop only write markers."""
+
+    confirms_start = True
+    follows_connections = True
+
+    def __init__(self, continuous_capture, connections=None):
+        super(DemuxSniffer, self).__init__()
+        self.continuous_capture = continuous_capture
+        self.connections = connections
+        self.wall_offset_ns = 0
+        self.segment: VisitSegment
+
+    def now_ns(self):
+        return time.monotonic_ns() + self.wall_offset_ns
+
+    def add_connections(self, connections):
+        self.continuous_capture.demuxer.add_connections(self.segment, connections)
+
+    def start_capture(self, pcap_path=None, pcap_filter=""):
+        if pcap_filter:
+            self.set_capture_filter(pcap_filter)
+        if pcap_path:
+            self.set_pcap_path(pcap_path)
+        # the system clock may have been adjusted since the previous visit
+        self.wall_offset_ns = time.time_ns() - time.monotonic_ns()
+        start_ns = self.now_ns()
+        self.continuous_capture.mark('start', self.pcap_file, start_ns, self.wall_offset_ns)
+        self.segment = self.continuous_capture.demuxer.open_visit(self.pcap_file, start_ns, self.connections)
+        self.is_recording = True
+
+    def stop_capture(self):
+        end_ns = self.now_ns()
+        self.continuous_capture.mark('end', self.pcap_file, end_ns, self.wall_offset_ns)
+        self.continuous_capture.demuxer.close_visit(self.segment, end_ns)
+        self.is_recording = False
+        self.stats = {'packets': self.segment.writer.packets}
+        log.wl_log.info('Visit cut from the continuous capture: %s packets %s' %
+                        (self.segment.writer.packets, self.pcap_file))
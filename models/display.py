@@ -0,0 +1,114 @@
+from __future__ import annotations
+
+import os
+import sys
+import threading
+
+from helper import log, utils
+
+sys.path.append('../..')
+
+DISPLAY_MODES = ('', 'xvfb', 'pool', 'headless')  # none, Xvfb per visit, shared Xvfb pool, headless browser
+
+
+def get_display_var(display):
+    """Return the DISPLAY value of a virtual display."""
+    return ':{}'.format(display.display)
+
+
+class DisplayPool(object):
+    """Lease long-lived Xvfb displays to the browsers instead of starting one per visit.
+
+    A display is leased to one browser at a time and returned when the
+    browser quits. Displays are checked when they are leased and returned:
+    a dead one is stopped and replaced, so that `size` displays are kept.
+    The displays leave the DISPLAY of the process alone; each browser is
+    pointed at its own display.
+    """
+
+    def __init__(self, size=utils.DISPLAY_POOL_SIZE, win_width=utils.DEFAULT_XVFB_WIN_W,
+                 win_height=utils.DEFAULT_XVFB_WIN_H):
+        self.size = size
+        self.win_width = win_width
+        self.win_height = win_height
+        self.lock = threading.Lock()
+        self.idle = []
+        self.leased = 0
+        self.closed = False
+        self.fill()
+
+    def start_display(self):
+        return utils.start_xvfb(self.win_width, self.win_height, manage_global_env=False)
+
+    def is_healthy(self, display):
+        try:
+            return display.is_alive() and os.path.exists('/tmp/.X11-unix/X{}'.format(display.display))
+        except Exception:
+            return False
+
+    def fill(self):
+        """Start displays until the pool holds `size` of them."""
+        while True:
+            with self.lock:
+                if self.closed or len(self.idle) + self.leased >= self.size:
+                    return
+            try:
+                display = self.start_display()
+            except Exception:
+                log.wl_log.error("Error starting a pooled display", exc_info=True)
+                return
+            with self.lock:
+                self.idle.append(display)
+
+    def acquire(self):
+        """Return a healthy display for a browser."""
+        dead = []
+        display = None
+        with self.lock:
+            while self.idle and display is None:
+                display = self.idle.pop()
+                if not self.is_healthy(display):
+                    dead.append(display)
+                    display = None
+            self.leased += 1
+        for dead_display in dead:
+            log.wl_log.warning("Replacing dead display %s" % get_display_var(dead_display))
+            self.stop_display(dead_display)
+        if display is None:
+            try:
+                display = self.start_display()
+            except Exception:
+                with self.lock:
+                    self.leased -= 1
+                raise
+        return display
+
+    def release(self, display):
+        """Take back the display of a browser that quit."""
+        if display is None:
+            return
+        healthy = self.is_healthy(display)
+        with self.lock:
+            self.leased -= 1
+            keep = healthy and not self.closed and len(self.idle) + self.leased < self.size
+            if keep:
+                self.idle.append(display)
+        if not keep:
+            if not healthy:
+                log.wl_log.warning("Display %s died, replacing it" % get_display_var(display))
+            self.stop_display(display)
+            self.fill()
+
+    def stop_display(self, display):
+        try:
+            utils.stop_xvfb(display)
+        except Exception:
+            log.wl_log.error("Error stopping display %s" % get_display_var(display), exc_info=True)
+
+    def close(self):
+        """Stop the idle displays; those still leased are stopped when released."""
+        with self.lock:
+            self.closed = True
+            idle, self.idle = self.idle, []
+        for display in idle:
+            self.stop_display(display)
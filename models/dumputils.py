@@ -1,26 +1,41 @@
 from __future__ import annotations
 
+import ctypes
+import ctypes.util
+import mmap
 import os
+import select
+import socket
+import struct
 import subprocess
 import sys
+import threading
 import time
 
+import psutil
+
 from helper import log, utils
+from helper.pcaputils import PCAP_MAX_SNAPLEN, PcapWriter
 
 sys.path.append('../..')
 
-
+CAPTURE_BACKENDS = ('tcpdump', 'native')  # tcpdump subprocess, in-process AF_PACKET ring
 TCPDUMP_START_TIMEOUT = 10.0
 
 
 class Sniffer(object):
     """Capture network traffic using tcpdump."""
 
-    def __init__(self):
+    confirms_start = False  # whether capture is known to be running when start_capture returns
+    follows_connections = False  # whether add_connections extends a running capture
+
+    def __init__(self, snaplen=0):
         self.pcap_file = '/dev/null'  # uggh, make sure we set a path
         self.pcap_filter = ''
+        self.snaplen = snaplen  # bytes kept of each packet, 0 for whole packets
         self.p0: subprocess.Popen
         self.is_recording = False
+        self.stats = {}  # packets/drops reported by the capture backend
 
     def set_pcap_path(self, pcap_filename):
         """Set filename and filter options for capture."""
@@ -37,6 +52,10 @@ class Sniffer(object):
         """Return capture filter."""
         return self.pcap_filter
 
+    def add_connections(self, connections):
+        """Record relay connections opened during the capture; a running BPF filter cannot change."""
+        pass
+
     def start_capture(self, pcap_path=None, pcap_filter=""):
         """Start capture. Configure sniffer if arguments are given."""
         if pcap_filter:
@@ -44,8 +63,8 @@ class Sniffer(object):
         if pcap_path:
             self.set_pcap_path(pcap_path)
 
-        command = 'sudo tcpdump -p -s 0 -i eth0 -w {} -f {} and not port 22'\
-            .format(self.pcap_file, self.pcap_filter)
+        command = 'sudo tcpdump -p -s {} -i {} -w {} -f "({}) and not port 22"'\
+            .format(self.snaplen, utils.CAPTURE_INTERFACE, self.pcap_file, self.pcap_filter)
 
         self.p0 = subprocess.Popen(command, stdout=subprocess.PIPE,
                                    stderr=subprocess.PIPE, shell=True)
@@ -63,6 +82,18 @@ class Sniffer(object):
                 return True
         return False
 
+    def kill(self):
+        """Kill the tcpdump process at once, when stop_capture does not return in time."""
+        p0 = getattr(self, 'p0', None)
+        if p0 is None:
+            return
+        try:
+            utils.kill_all_children(p0.pid)
+        except psutil.NoSuchProcess:
+            pass
+        p0.kill()
+        self.is_recording = False
+
     def stop_capture(self):
         """Kill the tcpdump process."""
         utils.kill_all_children(self.p0.pid)  # self.p0.pid is the shell pid
@@ -76,5 +107,231 @@ class Sniffer(object):
                                % self.pcap_file)
 
 
+# AF_PACKET constants from <linux/if_packet.h> and <linux/if_ether.h>
+SOL_PACKET = 263
+PACKET_RX_RING = 5
+PACKET_STATISTICS = 6
+PACKET_VERSION = 10
+TPACKET_V3 = 2
+ETH_P_ALL = 0x0003
+SO_ATTACH_FILTER = 26
+TP_STATUS_KERNEL = 0
+TP_STATUS_USER = 1
+DLT_EN10MB = 1
+
+TPACKET_REQ3 = struct.Struct('IIIIIII')
+TPACKET_STATS_V3 = struct.Struct('III')
+TPACKET3_HDR = struct.Struct('IIIIIIHH')  # next_offset, sec, nsec, snaplen, len, status, mac, net
+BLOCK_STATUS_OFFSET = 8  # tpacket_block_desc.hdr.bh1.block_status
+BLOCK_PKTS_OFFSET = 12   # num_pkts, offset_to_first_pkt
+
+RING_BLOCK_SIZE = 1 << 20
+RING_BLOCK_NR = 64
+RING_FRAME_SIZE = 2048
+RING_RETIRE_BLOCK_MS = 10
+CAPTURE_POLL_MS = 100
+
+
+class BpfInsn(ctypes.Structure):
+    _fields_ = [('code', ctypes.c_ushort), ('jt', ctypes.c_ubyte), ('jf', ctypes.c_ubyte), ('k', ctypes.c_uint32)]
+
+
+class BpfProgram(ctypes.Structure):
+    _fields_ = [('bf_len', ctypes.c_uint), ('bf_insns', ctypes.POINTER(BpfInsn))]
+
+
+class SockFprog(ctypes.Structure):
+    _fields_ = [('len', ctypes.c_ushort), ('filter', ctypes.POINTER(BpfInsn))]
+
+
+def attach_bpf_filter(sock, pcap_filter, snaplen):
+    """Compile a pcap filter with libpcap and attach it to the socket in the kernel."""
+    libpcap = ctypes.CDLL(ctypes.util.find_library('pcap'))
+    libpcap.pcap_open_dead.restype = ctypes.c_void_p
+    libpcap.pcap_geterr.restype = ctypes.c_char_p
+    handle = ctypes.c_void_p(libpcap.pcap_open_dead(DLT_EN10MB, snaplen))
+    program = BpfProgram()
+    try:
+        if libpcap.pcap_compile(handle, ctypes.byref(program), pcap_filter.encode(), 1, 0xffffffff) != 0:
+            raise ValueError('Invalid capture filter {}: {}'.format(pcap_filter, libpcap.pcap_geterr(handle).decode()))
+        fprog = SockFprog(program.bf_len, program.bf_insns)
+        sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, bytes(fprog))  # the kernel copies the program
+        libpcap.pcap_freecode(ctypes.byref(program))
+    finally:
+        libpcap.pcap_close(handle)
+
+
+class RingCapture(object):
+    """An AF_PACKET socket with a TPACKET_V3 mmap ring and a kernel BPF filter."""
+
+    def __init__(self, interface, pcap_filter, snaplen, sink):
+        self.sink = sink  # called as sink(sec, nsec, wirelen, data) for each packet
+        self.block_idx = 0
+        self.packets = 0
+        self.drops = 0
+        # protocol 0: nothing is received before the filter is attached and the socket bound
+        self.sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, 0)
+        try:
+            attach_bpf_filter(self.sock, pcap_filter, snaplen)
+            self.sock.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V3)
+            self.sock.setsockopt(SOL_PACKET, PACKET_RX_RING, TPACKET_REQ3.pack(
+                RING_BLOCK_SIZE, RING_BLOCK_NR, RING_FRAME_SIZE, RING_BLOCK_SIZE * RING_BLOCK_NR // RING_FRAME_SIZE,
+                RING_RETIRE_BLOCK_MS, 0, 0))
+            self.ring = mmap.mmap(self.sock.fileno(), RING_BLOCK_SIZE * RING_BLOCK_NR,
+                                  mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+            self.sock.bind((interface, ETH_P_ALL))  # capture is live from here on
+        except Exception:
+            self.sock.close()
+            raise
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def read_blocks(self):
+        """Hand the packets of all the blocks the kernel released to the sink."""
+        while True:
+            offset = self.block_idx * RING_BLOCK_SIZE
+            if not struct.unpack_from('I', self.ring, offset + BLOCK_STATUS_OFFSET)[0] & TP_STATUS_USER:
+                return
+            num_pkts, pkt = struct.unpack_from('II', self.ring, offset + BLOCK_PKTS_OFFSET)
+            pkt += offset
+            for _ in range(num_pkts):
+                next_offset, sec, nsec, snaplen, wirelen, _, mac, _ = TPACKET3_HDR.unpack_from(self.ring, pkt)
+                self.sink(sec, nsec, wirelen, self.ring[pkt + mac:pkt + mac + snaplen])
+                pkt += next_offset
+            self.packets += num_pkts
+            struct.pack_into('I', self.ring, offset + BLOCK_STATUS_OFFSET, TP_STATUS_KERNEL)
+            self.block_idx = (self.block_idx + 1) % RING_BLOCK_NR
+
+    def update_stats(self):
+        # the kernel resets its counters on every read
+        _, drops, _ = TPACKET_STATS_V3.unpack(self.sock.getsockopt(SOL_PACKET, PACKET_STATISTICS,
+                                                                   TPACKET_STATS_V3.size))
+        self.drops += drops
+
+    def close(self):
+        self.update_stats()
+        self.ring.close()
+        self.sock.close()
+
+
+class CaptureEngine(object):
+    """Serve all the ring captures of the process from a single thread."""
+
+    def __init__(self):
+        self.captures: dict[int, RingCapture] = {}
+        self.lock = threading.Lock()
+        self.poller = select.poll()
+        self.thread = threading.Thread(target=self.run, name='capture-engine', daemon=True)
+        self.thread.start()
+
+    def add(self, capture):
+        with self.lock:
+            self.captures[capture.fileno()] = capture
+            self.poller.register(capture.fileno(), select.POLLIN | select.POLLERR)
+
+    def remove(self, capture):
+        """Stop serving a capture once the kernel retired its last block."""
+        time.sleep(2 * RING_RETIRE_BLOCK_MS / 1000)
+        with self.lock:
+            if self.captures.get(capture.fileno()) is not capture:
+                return  # discarded meanwhile
+            self.poller.unregister(capture.fileno())
+            del self.captures[capture.fileno()]
+            capture.read_blocks()
+            capture.close()
+
+    def discard(self, capture):
+        """Stop serving a capture at once, dropping the packets left in its ring."""
+        with self.lock:
+            if self.captures.get(capture.fileno()) is not capture:
+                return
+            self.poller.unregister(capture.fileno())
+            del self.captures[capture.fileno()]
+            capture.close()
+
+    def run(self):
+        while True:
+            events = self.poller.poll(CAPTURE_POLL_MS)
+            with self.lock:
+                for fd, _ in events:
+                    capture = self.captures.get(fd)
+                    if capture:
+                        try:
+                            capture.read_blocks()
+                        except Exception:
+                            log.wl_log.error("Error reading capture ring", exc_info=True)
+
+
+capture_engine = None
+
+
+def get_capture_engine():
+    global capture_engine
+    if capture_engine is None:
+        capture_engine = CaptureEngine()
+    return capture_engine
+
+
+class NativeSniffer(Sniffer):
+    """Capture network traffic in-process with an AF_PACKET TPACKET_V3 ring.
+
+    Needs CAP_NET_RAW and libpcap (to compile the filter). The capture is
+    running when start_capture returns, and kernel drops are reported.
+    """
+
+    confirms_start = True
+
+    def __init__(self, snaplen=0):
+        super(NativeSniffer, self).__init__(snaplen)
+        self.snaplen = snaplen or PCAP_MAX_SNAPLEN
+        self.capture: RingCapture
+        self.writer: PcapWriter
+
+    def start_capture(self, pcap_path=None, pcap_filter=""):
+        """Start capture. Configure sniffer if arguments are given."""
+        if pcap_filter:
+            self.set_capture_filter(pcap_filter)
+        if pcap_path:
+            self.set_pcap_path(pcap_path)
+
+        self.writer = PcapWriter(self.pcap_file, self.snaplen)
+        self.capture = RingCapture(utils.CAPTURE_INTERFACE, '({}) and not port 22'.format(self.pcap_filter),
+                                   self.snaplen, self.writer.write)
+        get_capture_engine().add(self.capture)
+        print("INFO\tnative capture started in {} on {}, filter {}".format(
+            utils.cal_now_time(), utils.CAPTURE_INTERFACE, self.pcap_filter))
+        self.is_recording = True
+
+    def kill(self):
+        """Drop the ring capture and close the capture file at once, when stop_capture does not return in time."""
+        capture = getattr(self, 'capture', None)
+        if capture is not None:
+            get_capture_engine().discard(capture)
+        writer = getattr(self, 'writer', None)
+        if writer is not None:
+            writer.close()
+        self.is_recording = False
+
+    def stop_capture(self):
+        """Drain the ring and close the capture file."""
+        get_capture_engine().remove(self.capture)
+        self.writer.close()
+        self.is_recording = False
+        self.stats = {'packets': self.capture.packets, 'drops': self.capture.drops}
+        log.wl_log.info('Native capture stopped. %s packets, %s dropped, %s Bytes %s' %
+                        (self.capture.packets, self.capture.drops, os.path.getsize(self.pcap_file), self.pcap_file))
+        if self.capture.drops:
+            log.wl_log.warning('Capture dropped %s packets: %s' % (self.capture.drops, self.pcap_file))
+
+
+def get_sniffer(backend='tcpdump', **kwargs):
+    """Return a sniffer of the given capture backend."""
+    assert backend in CAPTURE_BACKENDS, "Unknown capture backend {}".format(backend)
+    if backend == 'native':
+        return NativeSniffer(**kwargs)
+    return Sniffer(**kwargs)
+
+
 if __name__ == "__main__":
     print('test ok!')
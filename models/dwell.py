@@ -0,0 +1,107 @@
+from __future__ import annotations
+
+import os
+import sys
+import time
+
+from stem.control import EventType
+
+from helper import log, utils
+
+from .budget import Budget, BudgetModel
+
+sys.path.append('../..')
+
+DWELL_MODES = ('fixed', 'adaptive')
+
+
+class DwellPolicy(object):
+    """Decide how long a visit stays on the page.
+
+    In 'fixed' mode every visit sleeps WAIT_FOR_VISIT (WAIT_FOR_VISIT_ONION for
+    onions). In 'adaptive' mode the visit ends once the traffic has been quiet
+    for `quiet_period` seconds, but never before `min_dwell` nor after
+    `max_dwell` seconds.
+
+    With a BudgetModel, the URLs it has enough history for get their own
+    dwell and timeouts instead of WAIT_FOR_VISIT and the *_VISIT_TIMEOUT constants.
+    """
+
+    def __init__(self, mode='fixed', min_dwell=utils.ADAPTIVE_MIN_DWELL, max_dwell=None,
+                 quiet_period=utils.ADAPTIVE_QUIET_PERIOD, budgets: BudgetModel | None = None):
+        assert mode in DWELL_MODES, "Unknown dwell mode {}".format(mode)
+        self.mode = mode
+        self.min_dwell = min_dwell
+        self.max_dwell = max_dwell
+        self.quiet_period = quiet_period
+        self.budgets = budgets
+
+    def get_max_dwell(self, page_url):
+        if self.max_dwell:
+            return self.max_dwell
+        return utils.WAIT_FOR_VISIT_ONION if '.onion' in page_url else utils.WAIT_FOR_VISIT
+
+    def get_budget(self, page_url, torrc_path=None):
+        """Return the Budget of a visit to page_url through torrc_path."""
+        if self.budgets:
+            budget = self.budgets.get_budget(page_url, torrc_path, self.max_dwell or utils.BUDGET_MAX_DWELL)
+            if budget:
+                return budget
+        return Budget(self.get_max_dwell(page_url), utils.SOFT_VISIT_TIMEOUT, utils.HARD_VISIT_TIMEOUT, 'default')
+
+
+class DwellMonitor(object):
+    """Track the last time the visit produced traffic.
+
+    Activity is taken from the controller's STREAM and CIRC_BW events and from
+    the growth of the live capture file.
+    """
+
+    def __init__(self, controller, pcap_path):
+        self.controller = controller
+        self.pcap_path = pcap_path
+        self.last_activity = time.monotonic()
+        self.last_capture_size = 0
+        self.listening = False
+
+    def on_event(self, event):
+        if event.type == 'CIRC_BW' and not (event.read or event.written):
+            return
+        self.last_activity = time.monotonic()
+
+    def start(self):
+        self.last_activity = time.monotonic()
+        try:
+            self.controller.add_event_listener(self.on_event, EventType.STREAM, EventType.CIRC_BW)
+            self.listening = True
+        except Exception:
+            log.wl_log.warning("Cannot listen to Tor events, using the capture size only", exc_info=True)
+
+    def stop(self):
+        if self.listening:
+            try:
+                self.controller.remove_event_listener(self.on_event)
+            except Exception:
+                log.wl_log.debug("Exception removing the dwell event listener")
+            self.listening = False
+
+    def poll_capture(self):
+        try:
+            size = os.path.getsize(self.pcap_path)
+        except OSError:
+            return
+        if size != self.last_capture_size:
+            self.last_capture_size = size
+            self.last_activity = time.monotonic()
+
+    def wait(self, min_dwell, max_dwell, quiet_period):
+        """Block until the page is quiet; return the dwell time and the stop reason."""
+        start = time.monotonic()
+        while True:
+            time.sleep(utils.DWELL_POLL_INTERVAL)
+            self.poll_capture()
+            now = time.monotonic()
+            if now - start >= max_dwell:
+                return now - start, 'max_dwell'
+            if now - start >= min_dwell and now - self.last_activity >= quiet_period:
+                return now - start, 'quiet'
@@ -0,0 +1,152 @@
+from __future__ import annotations
+
+import json
+import os
+import sys
+from collections import Counter
+
+sys.path.append('../..')
+
+MANIFEST_FILENAME = 'manifest.jsonl'
+SCHEDULE_FILENAME = 'schedule.json'
+TORRC_BALANCE_FILENAME = 'torrc_balance.json'
+STATUS_OK = 'ok'
+STATUS_INVALID = 'invalid'  # the visit ran but its capture failed validation
+STATUS_BAD_PAGE = 'bad_page'  # the screenshot shows a known error page (captcha, challenge, Tor error)
+
+
+class Manifest(object):
+    """Append-only record of the visits of a crawl.
+
+    Every visit appends one JSON line with a single O_APPEND write followed by
+    fsync, so records of concurrent workers never interleave and a crash loses
+    at most the line being written, which is ignored when reading back. The
+    planned jobs are stored next to it in schedule.json, replaced atomically.
+    """
+
+    def __init__(self, crawl_dir):
+        self.path = os.path.join(crawl_dir, MANIFEST_FILENAME)
+        self.schedule_path = os.path.join(crawl_dir, SCHEDULE_FILENAME)
+        self.done: set[tuple[int, int]] | None = None  # (batch, index) of the successful visits
+        self.samples: Counter | None = None            # successful visits per URL
+
+    def write_schedule(self, jobs):
+        tmp_path = self.schedule_path + '.tmp'
+        with open(tmp_path, 'w') as fp:
+            json.dump([list(job) for job in jobs], fp)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp_path, self.schedule_path)
+
+    def read_schedule(self):
+        """Return the planned (batch, index, url, torrc) jobs, None if the crawl has no schedule."""
+        try:
+            with open(self.schedule_path, 'r') as fp:
+                return [tuple(job) for job in json.load(fp)]
+        except FileNotFoundError:
+            return None
+
+    def record(self, batch, index, url, torrc, status, start, end, **extra):
+        entry = dict(batch=batch, index=index, url=url, torrc=torrc, status=status, start=start, end=end, **extra)
+        line = (json.dumps(entry) + '\n').encode()
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        if self.done is not None:
+            self.index(entry)
+
+    def read(self):
+        """Yield the complete records of the manifest."""
+        try:
+            with open(self.path, 'r') as fp:
+                for line in fp:
+                    if not line.endswith('\n'):
+                        break  # torn by a crash
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        continue
+        except FileNotFoundError:
+            return
+
+    def read_from(self, offset):
+        """Return the complete records after byte `offset` and the offset following them."""
+        entries = []
+        try:
+            with open(self.path, 'rb') as fp:
+                fp.seek(offset)
+                for line in fp:
+                    if not line.endswith(b'\n'):
+                        break  # being written, read it next time
+                    offset += len(line)
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        continue
+        except FileNotFoundError:
+            pass
+        return entries, offset
+
+    def repair(self):
+        """Drop a line torn by a crash, so that the next record starts on its own line."""
+        try:
+            with open(self.path, 'rb+') as fp:
+                data = fp.read()
+                if data and not data.endswith(b'\n'):
+                    fp.truncate(data.rfind(b'\n') + 1)
+        except FileNotFoundError:
+            return
+
+    def load(self):
+        self.repair()
+        self.done, self.samples = set(), Counter()
+        for entry in self.read():
+            self.index(entry)
+
+    def index(self, entry):
+        if entry['status'] == STATUS_OK and (entry['batch'], entry['index']) not in self.done:
+            self.done.add((entry['batch'], entry['index']))
+            self.samples[entry['url']] += 1
+
+    def get_samples(self):
+        """Return the number of successful visits per URL."""
+        if self.samples is None:
+            self.load()
+        return self.samples
+
+    def get_pending_jobs(self, jobs):
+        """Return the jobs without a successful visit, in schedule order."""
+        if self.done is None:
+            self.load()
+        return [job for job in jobs if (job[0], job[1]) not in self.done]
+
+    def get_torrc_balance(self, torrc_paths=()):
+        """Return url -> torrc name -> visits planned and successful with it."""
+        balance = {}
+
+        def get_counts(url, torrc):
+            counts = balance.setdefault(url, {os.path.basename(path): {'planned': 0, 'ok': 0} for path in torrc_paths})
+            return counts.setdefault(os.path.basename(torrc), {'planned': 0, 'ok': 0})
+
+        for _, _, url, torrc in self.read_schedule() or []:
+            get_counts(url, torrc)['planned'] += 1
+        for entry in self.read():
+            if entry['status'] == STATUS_OK:
+                get_counts(entry['url'], entry['torrc'])['ok'] += 1
+        return balance
+
+    def write_torrc_balance(self, torrc_paths=()):
+        """Store the torrc balance of every URL; return the largest spread of successful visits over the torrcs."""
+        balance = self.get_torrc_balance(torrc_paths)
+        with open(os.path.join(os.path.dirname(self.path), TORRC_BALANCE_FILENAME), 'w') as fp:
+            json.dump(balance, fp, indent=1, sort_keys=True)
+        return max((max(c['ok'] for c in counts.values()) - min(c['ok'] for c in counts.values())
+                    for counts in balance.values()), default=0)
+
+    def get_pending_urls(self, urls, num_samples):
+        """Return the URLs with fewer than num_samples successful visits."""
+        samples = self.get_samples()
+        return [url for url in urls if samples[url] < num_samples]
@@ -0,0 +1,164 @@
+from __future__ import annotations
+
+import json
+import sys
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from helper import utils
+
+sys.path.append('../..')
+
+PHASES_FILENAME = 'phases.jsonl'
+PHASE_BUCKETS = (0.1, 0.5, 1, 2, 5, 10, 20, 30, 60, 120, 240)
+
+
+class PhaseTimer(object):
+    """Record the spans of the phases of one visit."""
+
+    def __init__(self):
+        self.spans: list[tuple[str, float, float]] = []  # (phase, wall clock start, duration)
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        start, begin = time.time(), time.monotonic()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.spans.append((name, start, time.monotonic() - begin))
+
+    def get_durations(self):
+        """Return the total time spent in each phase."""
+        durations = Counter()
+        with self.lock:
+            for name, _, duration in self.spans:
+                durations[name] += duration
+        return dict(durations)
+
+    def write(self, path):
+        with self.lock, open(path, 'w') as fp:
+            for name, start, duration in self.spans:
+                fp.write(json.dumps({'phase': name, 'start': start, 'duration': duration}) + '\n')
+
+
+class Histogram(object):
+
+    def __init__(self, buckets=PHASE_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+
+class CrawlMetrics(object):
+    """Crawl metrics computed from the visit records of the manifest.
+
+    The manifest is shared by all the workers of a crawl, so the exporter of
+    the main process sees every visit; it reads the new records on each scrape.
+    """
+
+    def __init__(self, manifest, total_jobs=None, window=utils.METRICS_WINDOW):
+        self.manifest = manifest
+        self.total_jobs = total_jobs
+        self.started = time.time()
+        self.offset = 0
+        self.statuses = Counter()
+        self.recent: deque[tuple[float, bool]] = deque(maxlen=window)  # (end, ok) of the last visits
+        self.phases: dict[str, Histogram] = {}
+        self.lock = threading.Lock()
+
+    def collect(self):
+        entries, self.offset = self.manifest.read_from(self.offset)
+        for entry in entries:
+            self.observe(entry)
+
+    def observe(self, entry):
+        if entry['start'] < self.started:
+            return  # visits of a previous run of a resumed crawl
+        self.statuses[entry['status']] += 1
+        self.recent.append((entry['end'], entry['status'] == 'ok'))
+        for name, duration in entry.get('phases', {}).items():
+            self.phases.setdefault(name, Histogram()).observe(duration)
+
+    def get_rate(self):
+        """Visits per second over the moving window."""
+        if len(self.recent) < 2:
+            return 0.0
+        elapsed = self.recent[-1][0] - self.recent[0][0]
+        return (len(self.recent) - 1) / elapsed if elapsed > 0 else 0.0
+
+    def render(self):
+        """Return the metrics in the Prometheus text format."""
+        with self.lock:
+            self.collect()
+            lines = ['# TYPE crawler_visits_total counter']
+            lines += ['crawler_visits_total{status="%s"} %d' % item for item in sorted(self.statuses.items())]
+            done = sum(self.statuses.values())
+            rate = self.get_rate()
+            failures = sum(1 for _, ok in self.recent if not ok)
+            lines += ['# TYPE crawler_visits_per_hour gauge', 'crawler_visits_per_hour %.3f' % (rate * 3600),
+                      '# TYPE crawler_failure_ratio gauge',
+                      'crawler_failure_ratio %.4f' % (failures / len(self.recent) if self.recent else 0),
+                      '# TYPE crawler_uptime_seconds gauge', 'crawler_uptime_seconds %.1f' % (time.time() - self.started)]
+            if self.total_jobs is not None:
+                lines += ['# TYPE crawler_jobs_remaining gauge',
+                          'crawler_jobs_remaining %d' % max(self.total_jobs - done, 0)]
+                if rate:
+                    lines += ['# TYPE crawler_eta_seconds gauge',
+                              'crawler_eta_seconds %.0f' % (max(self.total_jobs - done, 0) / rate)]
+            lines.append('# TYPE crawler_phase_seconds histogram')
+            for name, histogram in sorted(self.phases.items()):
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    lines.append('crawler_phase_seconds_bucket{phase="%s",le="%s"} %d' % (name, bound, count))
+                lines += ['crawler_phase_seconds_bucket{phase="%s",le="+Inf"} %d' % (name, histogram.count),
+                          'crawler_phase_seconds_sum{phase="%s"} %.3f' % (name, histogram.sum),
+                          'crawler_phase_seconds_count{phase="%s"} %d' % (name, histogram.count)]
+            return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    metrics: CrawlMetrics
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = self.metrics.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer(object):
+    """Serve /metrics on a background thread."""
+
+    def __init__(self, metrics, port=utils.METRICS_PORT, host='127.0.0.1'):
+        handler = type('BoundMetricsHandler', (MetricsHandler,), {'metrics': metrics})
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, name='metrics', daemon=True)
+
+    def start(self):
+        self.thread.start()
+        print("INFO\tMetrics on http://{}:{}/metrics".format(*self.server.server_address[:2]))
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
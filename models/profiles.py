@@ -0,0 +1,106 @@
+from __future__ import annotations
+
+import itertools
+import json
+import os
+import queue
+import shutil
+import sys
+import tempfile
+import threading
+
+from .torutils import CRAWLER_PREFS, get_tbb_profile_path
+
+from helper import log, utils
+
+sys.path.append('../..')
+
+
+def format_user_pref(name, value):
+    return 'user_pref({}, {});\n'.format(json.dumps(name), json.dumps(value))
+
+
+class ProfileProvisioner(object):
+    """Hand out fresh Tor Browser profiles without copying on the visit's path.
+
+    The TBB profile is copied once into a template with the crawler
+    preferences baked into its user.js. A background thread keeps `pool_size`
+    copies of the template ready on tmpfs, and released profiles are removed
+    by another background thread.
+    """
+
+    def __init__(self, tbb_path, pool_size=utils.PROFILE_POOL_SIZE, base_dir=utils.TMPFS_DIR):
+        self.base_dir = tempfile.mkdtemp(prefix='tbb-profiles-', dir=base_dir if os.path.isdir(base_dir) else None)
+        self.template_dir = os.path.join(self.base_dir, 'template')
+        self.bake_template(get_tbb_profile_path(tbb_path))
+        self.ready = queue.Queue(maxsize=pool_size)
+        self.released = queue.Queue()
+        self.counter = itertools.count(1)
+        self.running = True
+        self.stopped = threading.Event()
+        self.filler = threading.Thread(target=self.fill, name='profile-filler', daemon=True)
+        self.cleaner = threading.Thread(target=self.clean, name='profile-cleaner', daemon=True)
+        self.filler.start()
+        self.cleaner.start()
+
+    def bake_template(self, profile_directory):
+        shutil.copytree(profile_directory, self.template_dir)
+        with open(os.path.join(self.template_dir, 'user.js'), 'a') as fp:
+            for name, value in CRAWLER_PREFS:
+                fp.write(format_user_pref(name, value))
+        print("INFO\tBaked profile template in {}".format(self.template_dir))
+
+    def new_profile(self):
+        profile_dir = os.path.join(self.base_dir, 'profile-{}'.format(next(self.counter)))
+        shutil.copytree(self.template_dir, profile_dir)
+        return profile_dir
+
+    def fill(self):
+        backoff = utils.PROFILE_FILL_BACKOFF
+        while self.running:
+            try:
+                profile_dir = self.new_profile()
+            except Exception:
+                log.wl_log.error("Error preparing a browser profile, retrying in %ss" % backoff, exc_info=True)
+                self.stopped.wait(backoff)
+                backoff = min(backoff * 2, utils.PROFILE_FILL_MAX_BACKOFF)
+                continue
+            backoff = utils.PROFILE_FILL_BACKOFF
+            self.ready.put(profile_dir)  # blocks while the pool is full
+
+    def clean(self):
+        while True:
+            profile_dir = self.released.get()
+            if profile_dir is None:
+                break
+            shutil.rmtree(profile_dir, ignore_errors=True)
+
+    def acquire(self, socks_port):
+        """Return the path of a fresh profile using the given SOCKS port."""
+        try:
+            profile_dir = self.ready.get(timeout=utils.PROFILE_ACQUIRE_TIMEOUT)
+        except queue.Empty:
+            log.wl_log.warning("No browser profile ready, preparing one on the visit's path")
+            profile_dir = self.new_profile()
+        with open(os.path.join(profile_dir, 'user.js'), 'a') as fp:
+            fp.write(format_user_pref('network.proxy.socks_port', socks_port))
+        return profile_dir
+
+    def release(self, profile_dir):
+        """Schedule the removal of a used profile."""
+        self.released.put(profile_dir)
+
+    def close(self):
+        self.running = False
+        self.stopped.set()
+        try:  # unblock the filler
+            while True:
+                self.release(self.ready.get_nowait())
+        except queue.Empty:
+            pass
+        self.filler.join(utils.PROFILE_ACQUIRE_TIMEOUT)
+        while not self.ready.empty():
+            self.release(self.ready.get_nowait())
+        self.released.put(None)
+        self.cleaner.join()
+        shutil.rmtree(self.base_dir, ignore_errors=True)
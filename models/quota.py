@@ -0,0 +1,139 @@
+from __future__ import annotations
+
+import random
+import sys
+import time
+from collections import Counter
+
+from helper import log, utils
+
+from .manifest import STATUS_OK, Manifest
+
+sys.path.append('../..')
+
+
+class QuotaScheduler(object):
+    """Schedule visits until every URL (or URL and torrc) has `num_samples` successful visits.
+
+    The outcome of every visit is read back from the manifest, which the
+    workers of a crawl share, so visits recorded by a previous run of the
+    crawl count as well. A failed visit is retried after a backoff doubling
+    with each failure, and a URL is given up after QUOTA_MAX_FAILURES failures.
+    Each visit of a URL gets the next batch number, so its directory is
+    batch-<attempt>/url-<index of the URL>.
+    """
+
+    def __init__(self, urls, torrc_paths, num_samples, manifest: Manifest, per_torrc=False, max_in_flight=1,
+                 max_failures=utils.QUOTA_MAX_FAILURES):
+        self.urls = list(urls)
+        self.torrc_paths = list(torrc_paths)
+        self.num_samples = num_samples
+        self.manifest = manifest
+        self.per_torrc = per_torrc
+        self.max_in_flight = max_in_flight
+        self.max_failures = max_failures
+        self.sites = {url: site_num for site_num, url in enumerate(self.urls)}
+        self.keys = [(url, torrc) for url in self.urls for torrc in (self.torrc_paths if per_torrc else [None])]
+        self.ok = Counter()
+        self.failures = Counter()
+        self.attempts = Counter()  # visits of each URL, numbering its batches
+        self.torrc_visits = Counter()  # visits of each URL and torrc, to balance the torrcs of a URL
+        self.last_torrc = None
+        self.not_before: dict[tuple[str, str | None], float] = {}
+        self.in_flight: dict[tuple[str, str | None], list[float]] = {}  # issue times of the unrecorded visits
+        self.issued: dict[str, int] = {}  # batches of each URL issued by this scheduler
+        self.offset = 0
+
+    def get_key(self, url, torrc):
+        return url, torrc if self.per_torrc else None
+
+    def collect(self):
+        """Account for the visits recorded since the last call."""
+        entries, self.offset = self.manifest.read_from(self.offset)
+        for entry in entries:
+            url = entry['url']
+            if url not in self.sites:
+                continue
+            self.attempts[url] = max(self.attempts[url], entry['batch'] + 1)
+            if entry.get('retried'):
+                continue  # superseded by the next attempt of the same job, still in flight
+            if entry['batch'] >= self.issued.get(url, 0):
+                self.torrc_visits[url, entry['torrc']] += 1  # recorded by a previous run of the crawl
+            key = self.get_key(url, entry['torrc'])
+            if self.per_torrc and entry['torrc'] not in self.torrc_paths:
+                continue
+            if self.in_flight.get(key):
+                self.in_flight[key].pop(0)
+            if entry['status'] == STATUS_OK:
+                self.ok[key] += 1
+                continue
+            self.failures[key] += 1
+            if self.failures[key] == self.max_failures:
+                log.wl_log.warning("Giving up %s after %d failed visits" % (' '.join(filter(None, key)),
+                                                                         self.failures[key]))
+            backoff = min(utils.QUOTA_BACKOFF * 2 ** (self.failures[key] - 1), utils.QUOTA_MAX_BACKOFF)
+            self.not_before[key] = entry['end'] + backoff
+
+    def expire(self, now):
+        """Forget visits that were never recorded, e.g. those of a crashed worker."""
+        for issued in self.in_flight.values():
+            while issued and now - issued[0] > utils.QUOTA_LOST_VISIT_TIMEOUT:
+                issued.pop(0)
+
+    def get_missing(self, key):
+        return self.num_samples - self.ok[key] - len(self.in_flight.get(key, ()))
+
+    def is_open(self, key):
+        return self.ok[key] < self.num_samples and self.failures[key] < self.max_failures
+
+    def next_job(self, now):
+        """Return the next job, None if none can be issued now."""
+        if sum(len(issued) for issued in self.in_flight.values()) >= self.max_in_flight:
+            return None
+        ready = [key for key in self.keys if self.is_open(key) and self.get_missing(key) > 0
+                 and self.not_before.get(key, 0) <= now]
+        if not ready:
+            return None
+        # the furthest from its quota first, so that URLs fill up evenly
+        url, torrc = max(ready, key=lambda key: (self.get_missing(key), random.random()))
+        torrc = torrc or self.get_torrc(url)
+        batch_num = self.attempts[url]
+        self.attempts[url] += 1
+        self.issued[url] = self.attempts[url]
+        self.torrc_visits[url, torrc] += 1
+        self.last_torrc = torrc
+        self.in_flight.setdefault(self.get_key(url, torrc), []).append(now)
+        return batch_num, self.sites[url], url, torrc
+
+    def get_torrc(self, url):
+        """Return the torrc the URL was visited the least with, the one of the previous job if it is one of those."""
+        fewest = min(self.torrc_visits[url, torrc] for torrc in self.torrc_paths)
+        torrcs = [torrc for torrc in self.torrc_paths if self.torrc_visits[url, torrc] == fewest]
+        # consecutive jobs with the same torrc share a Tor process
+        return self.last_torrc if self.last_torrc in torrcs else random.choice(torrcs)
+
+    def iter_jobs(self):
+        """Yield (batch, site, url, torrc) jobs until every quota is met or given up.
+
+        None is yielded while the next job depends on the outcome of the
+        visits in flight; the caller should run or wait for them meanwhile.
+        """
+        while True:
+            now = time.time()
+            self.collect()
+            self.expire(now)
+            job = self.next_job(now)
+            if job:
+                yield job
+                continue
+            if not any(self.is_open(key) for key in self.keys):
+                break
+            if any(self.in_flight.values()):
+                yield None
+                continue
+            # only failed URLs are left, wait for the end of their backoff
+            wait = min(self.not_before.get(key, now) for key in self.keys if self.is_open(key)) - now
+            time.sleep(min(max(wait, utils.QUOTA_POLL_INTERVAL), utils.QUOTA_MAX_BACKOFF))
+        met = sum(1 for key in self.keys if self.ok[key] >= self.num_samples)
+        print("INFO\tQuotas met for {} of {} {}, {} visits".format(
+            met, len(self.keys), 'URL/torrc pairs' if self.per_torrc else 'URLs', sum(self.attempts.values())))
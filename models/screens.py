@@ -0,0 +1,65 @@
+from __future__ import annotations
+
+import multiprocessing
+import os
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+
+from helper import log, utils
+from helper.screenshots import dhash, format_hash, load_signatures, nearest
+
+sys.path.append('../..')
+
+
+class ScreenshotAnalyzer(object):
+    """Tell error pages apart by the perceptual hash of the visit screenshots.
+
+    The screenshots are hashed in a pool of low-priority processes while the
+    visit is torn down. A screenshot matching a bad-page signature (captcha
+    walls, challenges, Tor error pages) is 'bad'. One far from every earlier
+    screenshot of its URL is an 'outlier': it is flagged but kept, and joins
+    the history of the URL as sites do change.
+    """
+
+    def __init__(self, bad_screens='', workers=utils.SCREENSHOT_WORKERS):
+        self.signatures = load_signatures(bad_screens) if bad_screens else {}
+        # spawned, not forked: the crawler process runs capture, Tor and browser threads
+        self.executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'),
+                                            initializer=os.nice, initargs=(utils.SCREENSHOT_NICE,))
+        self.history: dict[str, list[int]] = {}  # url -> hashes of its last screenshots
+        self.lock = threading.Lock()
+        print("INFO\tScreenshot analysis with {} bad-page signatures".format(len(self.signatures)))
+
+    def submit(self, png_path):
+        """Start hashing a screenshot; return the future to give to get_verdict()."""
+        return self.executor.submit(dhash, png_path)
+
+    def classify(self, page_url, image_hash):
+        verdict = {'hash': format_hash(image_hash), 'verdict': 'ok'}
+        label, distance = nearest(image_hash, self.signatures.items())
+        if label is not None and distance <= utils.SCREENSHOT_BAD_DISTANCE:
+            return dict(verdict, verdict='bad', match=label, distance=distance)
+        with self.lock:
+            history = self.history.setdefault(page_url, [])
+            if len(history) >= utils.SCREENSHOT_MIN_HISTORY:
+                _, distance = nearest(image_hash, enumerate(history))
+                if distance > utils.SCREENSHOT_OUTLIER_DISTANCE:
+                    verdict.update(verdict='outlier', distance=distance)
+            history.append(image_hash)
+            del history[:-utils.SCREENSHOT_MAX_HISTORY]
+        return verdict
+
+    def get_verdict(self, page_url, future, timeout=utils.SCREENSHOT_TIMEOUT):
+        """Return the verdict on the screenshot of a visit, 'unchecked' if it could not be hashed in time."""
+        try:
+            image_hash = future.result(timeout)
+        except TimeoutError:
+            return {'verdict': 'unchecked', 'reason': 'timeout'}
+        except Exception as exc:
+            log.wl_log.warning("Cannot hash the screenshot of %s: %s" % (page_url, exc))
+            return {'verdict': 'unchecked', 'reason': str(exc)}
+        return self.classify(page_url, image_hash)
+
+    def close(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
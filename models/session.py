@@ -0,0 +1,71 @@
+from __future__ import annotations
+
+import sys
+
+from .display import DisplayPool
+from .torutils import TorBrowserDriver
+
+from helper import log, utils
+
+sys.path.append('../..')
+
+
+class BrowserSession(object):
+    """Keep one Tor Browser running across visits.
+
+    Between visits the browser state is reset instead of restarting it. The
+    browser is restarted every `restart_every` visits or when it fails its
+    health check.
+    """
+
+    def __init__(self, tbb_path, logfile_path, xvfb=False, profile_provisioner=None,
+                 restart_every=utils.BROWSER_RESTART_EVERY, display_pool: DisplayPool | None = None,
+                 headless=False):
+        self.tbb_path = tbb_path
+        self.logfile_path = logfile_path
+        self.xvfb = xvfb
+        self.profile_provisioner = profile_provisioner
+        self.display_pool = display_pool
+        self.headless = headless
+        self.restart_every = restart_every
+        self.tb_driver: TorBrowserDriver | None = None
+        self.xvfb_display = None
+        self.visits = 0
+
+    def start(self, socks_port):
+        print("INFO\tStarting persistent browser session")
+        if self.xvfb:
+            self.xvfb_display = self.display_pool.acquire() if self.display_pool else utils.start_xvfb()
+        self.tb_driver = TorBrowserDriver(tbb_logfile_path=self.logfile_path, tbb_path=self.tbb_path,
+                                          socks_port=socks_port, profile_provisioner=self.profile_provisioner,
+                                          display=self.xvfb_display, headless=self.headless)
+        self.visits = 0
+
+    def stop(self):
+        if self.tb_driver and self.tb_driver.is_running:
+            print("INFO\tQuitting persistent browser session")
+            utils.run_concurrently([('quit browser', self.tb_driver.quit, self.tb_driver.kill)],
+                                   utils.BROWSER_QUIT_TIMEOUT)
+        self.tb_driver = None
+        if self.xvfb_display:
+            if self.display_pool:
+                self.display_pool.release(self.xvfb_display)
+            else:
+                utils.stop_xvfb(self.xvfb_display)
+            self.xvfb_display = None
+
+    def get_driver(self, tor_controller):
+        """Return a clean driver using the given Tor process."""
+        if self.tb_driver and (self.visits >= self.restart_every or not self.tb_driver.is_healthy()):
+            self.stop()
+        if self.tb_driver:
+            try:
+                self.tb_driver.reset_state(tor_controller.socks_port)
+                tor_controller.new_identity()
+            except Exception:
+                log.wl_log.error("Error resetting the browser, restarting it", exc_info=True)
+                self.stop()
+        if not self.tb_driver:
+            self.start(tor_controller.socks_port)
+        self.visits += 1
+        return self.tb_driver
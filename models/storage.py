@@ -0,0 +1,73 @@
+from __future__ import annotations
+
+import multiprocessing
+import os
+import shutil
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from helper import log, utils
+from helper.pcaputils import compress_pcap
+
+sys.path.append('../..')
+
+
+class PcapCompressor(object):
+    """Gzip finished captures in a pool of low-priority processes."""
+
+    def __init__(self, workers=utils.COMPRESS_WORKERS, level=utils.COMPRESS_LEVEL):
+        self.level = level
+        # spawned, not forked: the crawler process runs capture, Tor and browser threads
+        self.executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'),
+                                            initializer=os.nice, initargs=(utils.COMPRESS_NICE,))
+        self.pending = set()
+
+    def submit(self, pcap_path):
+        if not os.path.isfile(pcap_path):
+            return
+        future = self.executor.submit(compress_pcap, pcap_path, self.level)
+        self.pending.add(future)
+        future.add_done_callback(self.done)
+
+    def done(self, future):
+        self.pending.discard(future)
+        if future.exception():
+            log.wl_log.error("Cannot compress a capture: %s" % future.exception())
+
+    def close(self):
+        """Finish the queued captures."""
+        if self.pending:
+            print("INFO\tWaiting for {} captures to be compressed".format(len(self.pending)))
+        self.executor.shutdown(wait=True)
+
+
+class DiskGuard(object):
+    """Hold the crawl while the output volume is short of space.
+
+    Crawling stops once less than `min_free_mb` is free and goes on when
+    `resume_free_mb` is free again, e.g. after the captures were compressed
+    or moved away.
+    """
+
+    def __init__(self, path, min_free_mb=utils.DISK_MIN_FREE_MB, resume_free_mb=utils.DISK_RESUME_FREE_MB):
+        self.path = path
+        self.min_free = min_free_mb << 20
+        self.resume_free = max(resume_free_mb, min_free_mb) << 20
+
+    def get_free(self):
+        return shutil.disk_usage(self.path).free
+
+    def wait(self):
+        """Block until there is room for the next visit; return the time waited."""
+        free = self.get_free()
+        if free >= self.min_free:
+            return 0.0
+        start = time.monotonic()
+        log.wl_log.warning("Only %d MB free on %s, pausing the crawl" % (free >> 20, self.path))
+        while free < self.resume_free:
+            time.sleep(utils.DISK_POLL_INTERVAL)
+            free = self.get_free()
+        waited = time.monotonic() - start
+        log.wl_log.warning("%d MB free on %s, crawl resumed after %.0fs" % (free >> 20, self.path, waited))
+        return waited
@@ -0,0 +1,142 @@
+from __future__ import annotations
+
+import shutil
+import sys
+import threading
+import time
+from collections import deque
+
+import psutil
+
+from .torutils import TorController, TorNotReadyError
+
+from helper import log, utils
+
+sys.path.append('../..')
+
+
+class TorPool(object):
+    """Keep the Tor processes of the next visits launched and bootstrapped.
+
+    The crawler announces the torrcs it will need with `schedule` and takes a
+    ready process with `acquire`. A process serves one block of visits with
+    its torrc (a single visit by default), with a new identity between them;
+    `release` then kills it and removes its DataDirectory so no circuit or
+    state leaks into the next block.
+    """
+
+    def __init__(self, tbb_path, worker_id=0, size=1, max_memory_mb=utils.TOR_POOL_MAX_MEMORY_MB, tor_state=None):
+        assert 0 < size <= utils.TOR_POOL_MAX_SIZE, "Tor pool size must be in 1..{}".format(utils.TOR_POOL_MAX_SIZE)
+        self.tbb_path = tbb_path
+        self.worker_id = worker_id
+        self.size = size
+        self.max_memory_mb = max_memory_mb
+        self.tor_state = tor_state
+        self.free_slots = deque(range(1, size + 1))  # slot 0 belongs to the worker's own Tor
+        self.wanted: deque[tuple[str, dict]] = deque()  # (torrc key, config) of the upcoming visits
+        self.ready: dict[str, deque[TorController]] = {}
+        self.launching: dict[str, int] = {}
+        self.live: set[TorController] = set()  # pooled and in-use processes
+        self.cond = threading.Condition()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='tor-pool', daemon=True)
+        self.thread.start()
+
+    def schedule(self, key, tor_config):
+        """Announce that a visit with this torrc is coming."""
+        with self.cond:
+            self.wanted.append((key, tor_config))
+            self.cond.notify_all()
+
+    def acquire(self, key, timeout=utils.TOR_READY_TIMEOUT):
+        """Return a ready Tor controller for the torrc, or None if there is none in time."""
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            # the visit is starting now, don't launch another process for it
+            for i, (wanted_key, _) in enumerate(self.wanted):
+                if wanted_key == key:
+                    del self.wanted[i]
+                    break
+            while not self.ready.get(key) and self.launching.get(key) and time.monotonic() < deadline:
+                self.cond.wait(deadline - time.monotonic())
+            if self.ready.get(key):
+                return self.ready[key].popleft()
+        return None
+
+    def release(self, tor_controller):
+        """Evict a used Tor process and free its slot."""
+        self.evict(tor_controller)
+        with self.cond:
+            self.live.discard(tor_controller)
+            self.free_slots.append(tor_controller.pool_slot)
+            self.cond.notify_all()
+
+    def evict(self, tor_controller):
+        data_dir = tor_controller.data_dir
+        tor_controller.kill_tor_proc()
+        if data_dir:  # even a persistent state must not outlive a pooled process
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    def get_memory_mb(self):
+        rss = 0
+        for tor_controller in list(self.live):
+            try:
+                rss += psutil.Process(tor_controller.tor_process.pid).memory_info().rss
+            except (AttributeError, psutil.Error):
+                pass
+        return rss / 2 ** 20
+
+    def can_launch(self):
+        return self.wanted and self.free_slots and self.get_memory_mb() < self.max_memory_mb
+
+    def run(self):
+        while True:
+            with self.cond:
+                while self.running and not self.can_launch():
+                    self.cond.wait(1)
+                if not self.running:
+                    return
+                key, tor_config = self.wanted.popleft()
+                slot = self.free_slots.popleft()
+                self.launching[key] = self.launching.get(key, 0) + 1
+            tor_controller = self.launch(slot, tor_config)
+            with self.cond:
+                self.launching[key] -= 1
+                if tor_controller:
+                    self.live.add(tor_controller)
+                    self.ready.setdefault(key, deque()).append(tor_controller)
+                else:
+                    self.free_slots.append(slot)
+                self.cond.notify_all()
+
+    def launch(self, slot, tor_config):
+        """Launch and bootstrap a Tor process in a pool slot."""
+        socks_port, control_port = utils.get_worker_ports(self.worker_id, slot)
+        tor_controller = TorController(self.tbb_path, socks_port, control_port, self.tor_state)
+        tor_controller.pool_slot = slot
+        tor_config = dict(tor_config, SOCKSPort=[str(socks_port)], ControlPort=[str(control_port)],
+                          DataDirectory=[utils.get_worker_tor_data_dir(self.worker_id, slot)])
+        try:
+            tor_controller.restart_tor(tor_config)
+        except TorNotReadyError:
+            log.wl_log.warning("Pre-warmed Tor in slot %s not ready" % slot, exc_info=True)
+            self.evict(tor_controller)
+            return None
+        except (Exception, SystemExit):
+            log.wl_log.error("Error pre-warming Tor in slot %s" % slot, exc_info=True)
+            self.evict(tor_controller)
+            return None
+        return tor_controller
+
+    def close(self):
+        """Stop pre-warming and kill all pooled Tor processes."""
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        self.thread.join(utils.TOR_READY_TIMEOUT + utils.INTERVAL_WAIT_FOR_LAUNCH)
+        with self.cond:
+            for tor_controllers in self.ready.values():
+                for tor_controller in tor_controllers:
+                    self.evict(tor_controller)
+            self.ready.clear()
+            self.live.clear()
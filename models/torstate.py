@@ -0,0 +1,112 @@
+from __future__ import annotations
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from helper import log, utils
+
+sys.path.append('../..')
+
+# Directory documents a bootstrapping Tor would otherwise download again
+TOR_CACHE_FILES = ['cached-certs', 'cached-microdesc-consensus', 'cached-microdescs']
+
+TOR_STATE_MODES = ('persistent', 'cold', 'warm')
+
+
+class TorState(object):
+    """Provide the DataDirectory of each new Tor process.
+
+    persistent: reuse the given directory, keeping guards and caches across
+                restarts (the historical behaviour).
+    cold:       start every process from a fresh empty directory on tmpfs.
+    warm:       like cold, but seed the directory with hardlinks to a shared
+                read-only consensus/microdescriptor cache, refreshed from the
+                processes that exit once it is older than `refresh` seconds.
+    """
+
+    def __init__(self, mode='persistent', cache_dir=utils.TOR_CACHE_DIR, refresh=utils.TOR_CACHE_REFRESH):
+        assert mode in TOR_STATE_MODES, "Unknown Tor state mode {}".format(mode)
+        self.mode = mode
+        self.cache_dir = cache_dir
+        self.refresh = refresh
+        self.lock = threading.Lock()
+        if self.mode == 'warm':
+            utils.create_dir(self.cache_dir)
+
+    def new_data_dir(self, data_dir):
+        """Return the DataDirectory to use instead of `data_dir`."""
+        if self.mode == 'persistent':
+            return data_dir
+        base_dir = utils.TMPFS_DIR if os.path.isdir(utils.TMPFS_DIR) else None
+        new_dir = tempfile.mkdtemp(prefix='tor-', dir=base_dir)
+        if self.mode == 'warm':
+            self.seed(new_dir)
+        return new_dir
+
+    def release(self, data_dir):
+        """Forget the DataDirectory of a Tor process that has exited."""
+        if self.mode == 'persistent':
+            return
+        if self.mode == 'warm' and self.is_stale():
+            self.update_cache(data_dir)
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    def get_current_cache(self):
+        return os.path.join(self.cache_dir, 'current')
+
+    def is_stale(self):
+        try:
+            return time.time() - os.lstat(self.get_current_cache()).st_mtime > self.refresh
+        except OSError:
+            return True
+
+    def seed(self, data_dir):
+        # resolve 'current' once: a refresh by another worker may swap it and remove the old generation
+        current = os.path.realpath(self.get_current_cache())
+        try:
+            for filename in TOR_CACHE_FILES:
+                src = os.path.join(current, filename)
+                if not os.path.isfile(src):
+                    continue
+                # Tor replaces these files by renaming, so the shared inodes are never written
+                link_or_copy(src, os.path.join(data_dir, filename))
+        except OSError:
+            log.wl_log.warning("Cannot seed %s from the Tor directory cache, starting cold" % data_dir,
+                               exc_info=True)
+            for filename in TOR_CACHE_FILES:
+                try:
+                    os.remove(os.path.join(data_dir, filename))
+                except FileNotFoundError:
+                    pass
+
+    def update_cache(self, data_dir):
+        """Make the directory documents of `data_dir` the new shared cache."""
+        if not all(os.path.isfile(os.path.join(data_dir, filename)) for filename in TOR_CACHE_FILES):
+            return
+        with self.lock:
+            if not self.is_stale():
+                return
+            generation = tempfile.mkdtemp(prefix='generation-', dir=self.cache_dir)
+            for filename in TOR_CACHE_FILES:
+                dst = os.path.join(generation, filename)
+                link_or_copy(os.path.join(data_dir, filename), dst)
+                os.chmod(dst, 0o444)
+            # swap the 'current' symlink atomically, seeded directories keep their own links
+            tmp_link = generation + '.link'
+            os.symlink(os.path.basename(generation), tmp_link)
+            old = os.path.realpath(self.get_current_cache()) if os.path.islink(self.get_current_cache()) else None
+            os.replace(tmp_link, self.get_current_cache())
+            if old and old != generation:
+                shutil.rmtree(old, ignore_errors=True)
+            log.wl_log.info("Refreshed the Tor directory cache in %s" % generation)
+
+
+def link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
@@ -1,21 +1,30 @@
 from __future__ import annotations
 
 import os
+import re
 import shutil
 import socket
 import sys
+import threading
 import time
 from http.client import CannotSendRequest
 
+import psutil
+import stem.connection
 import stem.process
 from selenium import webdriver
 from selenium.common.exceptions import WebDriverException
 from selenium.webdriver import DesiredCapabilities, firefox
 from selenium.webdriver.firefox.firefox_binary import FirefoxBinary
 from selenium.webdriver.remote.webdriver import WebDriver as RemoteWebDriver
-from stem.control import Controller
+from stem import Signal
+from stem.control import Controller, EventType
 from stem.util import term
 
+from .display import get_display_var
+from .metrics import PhaseTimer
+from .torstate import TorState
+
 from helper import log, utils
 
 sys.path.append('../..')
@@ -52,59 +61,180 @@ def prepend_to_env_var(env_var, new_value):
         os.environ[env_var] = new_value
 
 
+class TorNotReadyError(Exception):
+    pass
+
+
+TORRC_KEY_RE = re.compile(r'^[A-Za-z][A-Za-z0-9_]*$')
+TORRC_CRAWLER_KEYS = ('SOCKSPort', 'ControlPort', 'DataDirectory')  # set by the crawler for each Tor process
+
+
+def parse_torrc(torrc_path):
+    """Parse and check a torrc; return its stem config dict (option -> values).
+
+    Raise ValueError on a line that is not an option and its value.
+    """
+    assert os.path.isfile(torrc_path), "Invalid torrc path{}".format(torrc_path)
+    conf = {}
+    with open(torrc_path, 'r') as f:
+        for line_num, line in enumerate(f, 1):
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+            key, value = (line.split(None, 1) + [''])[:2]  # any whitespace separates them
+            if not TORRC_KEY_RE.match(key) or not value:
+                raise ValueError("{}:{}: expected an option and its value: {}".format(torrc_path, line_num, line))
+            conf.setdefault(key, []).append(value)
+    for key in TORRC_CRAWLER_KEYS:
+        if key in conf:
+            log.wl_log.warning("%s of %s is replaced by the crawler's" % (key, torrc_path))
+    return conf
+
+
+def parse_bootstrap_phase(status):
+    """Return (progress, tag) of a 'status/bootstrap-phase' or BOOTSTRAP event line."""
+    progress = re.search(r'PROGRESS=(\d+)', status)
+    tag = re.search(r'TAG=(\S+)', status)
+    return int(progress.group(1)) if progress else 0, tag.group(1) if tag else 'unknown'
+
+
 class TorController(object):
-    def __init__(self, tbb_path):
+    def __init__(self, tbb_path, socks_port=utils.USED_SOCKS_PORT, control_port=utils.USED_CONTROL_PORT,
+                 tor_state=None):
         self.controller: Controller
-        self.tmp_tor_data_dir = None
         self.tor_process = None
+        self.tor_state = tor_state or TorState()
         self.tbb_path = tbb_path
+        self.socks_port = socks_port
+        self.control_port = control_port
         self.circuit_id = None
+        self.bootstrap_phases = []
+        self.pool_slot = 0  # slot of the worker's port range, set by TorPool
+        self.data_dir = None
 
     def tor_log_handler(self, line):
         log.wl_log.info(term.format(line))
 
-    def restart_tor(self, tor_config, sleep_time=utils.INTERVAL_WAIT_AFTER_RESTART):
-        """Kill current Tor process and run a new one."""
-        self.kill_tor_proc()
-        self.launch_tor_service(tor_config)
-        print(f'INFO\tSleep {sleep_time}s to wait for Tor to be ready')
-        time.sleep(sleep_time)
+    def restart_tor(self, tor_config, sleep_time=None, phase_timer=None):
+        """Kill current Tor process and run a new one.
+
+        Return as soon as Tor is ready, or after `sleep_time` seconds if given.
+        """
+        phase_timer = phase_timer or PhaseTimer()
+        with phase_timer.phase('tor_kill'):
+            self.kill_tor_proc()
+        with phase_timer.phase('tor_launch'):
+            self.data_dir = self.tor_state.new_data_dir(tor_config.get('DataDirectory', [utils.TOR_DATA_DIR])[0])
+            self.launch_tor_service(dict(tor_config, DataDirectory=[self.data_dir]))
+        if sleep_time is not None:
+            print(f'INFO\tSleep {sleep_time}s to wait for Tor to be ready')
+            time.sleep(sleep_time)
+            return
+        with phase_timer.phase('tor_bootstrap'):
+            self.bootstrap_phases = self.wait_until_ready()
+        print('INFO\tTor ready in {:.1f}s: {}'.format(sum(d for _, d in self.bootstrap_phases),
+                                                     ', '.join('%s %.1fs' % p for p in self.bootstrap_phases)))
+
+    def is_ready(self):
+        """Tor is ready once bootstrapped, with a built circuit and a usable guard."""
+        progress, _ = parse_bootstrap_phase(self.controller.get_info('status/bootstrap-phase'))
+        if progress < 100 or self.controller.get_info('status/circuit-established') != '1':
+            return False
+        if not any(circ.status == 'BUILT' for circ in self.controller.get_circuits()):
+            return False
+        guards = self.controller.get_info('entry-guards', '').splitlines()
+        return any(line.split()[-1] == 'up' for line in guards if line.strip())
+
+    def wait_until_ready(self, timeout=utils.TOR_READY_TIMEOUT):
+        """Wait for Tor to be ready and return the time spent in each bootstrap phase.
+
+        Raise TorNotReadyError if the deadline passes or the Tor process dies.
+        """
+        start = time.monotonic()
+        phases = [('launch', start)]  # (tag, start time) of each phase
+        lock = threading.Lock()
+        wakeup = threading.Event()
+
+        def enter_phase(tag):
+            with lock:
+                if tag != phases[-1][0]:
+                    phases.append((tag, time.monotonic()))
+
+        def on_event(event):
+            if event.type == 'STATUS_CLIENT' and event.action == 'BOOTSTRAP':
+                enter_phase(event.keyword_args.get('TAG', 'unknown'))
+            wakeup.set()
+
+        self.controller.add_event_listener(on_event, EventType.STATUS_CLIENT, EventType.CIRC)
+        try:
+            while True:
+                enter_phase(parse_bootstrap_phase(self.controller.get_info('status/bootstrap-phase'))[1])
+                if self.is_ready():
+                    break
+                if self.tor_process and self.tor_process.poll() is not None:
+                    raise TorNotReadyError('Tor exited with code {}'.format(self.tor_process.returncode))
+                if time.monotonic() - start > timeout:
+                    raise TorNotReadyError('Tor not ready after {}s, stuck in phase {}'.format(timeout, phases[-1][0]))
+                wakeup.wait(utils.TOR_READY_POLL_INTERVAL)
+                wakeup.clear()
+        finally:
+            self.controller.remove_event_listener(on_event)
+
+        end = time.monotonic()
+        with lock:
+            bounds = [t for _, t in phases[1:]] + [end]
+            return [(tag, bound - t) for (tag, t), bound in zip(phases, bounds)]
 
     def kill_tor_proc(self):
         """Kill Tor process."""
+        if getattr(self, 'controller', None):
+            self.controller.close()
         if self.tor_process:
             self.tor_process.kill()
-        if self.tmp_tor_data_dir and os.path.isdir(self.tmp_tor_data_dir):
-            shutil.rmtree(self.tmp_tor_data_dir)
+            self.tor_process.wait()
+            self.tor_process = None
+        if self.data_dir:
+            self.tor_state.release(self.data_dir)
+            self.data_dir = None
 
     def launch_tor_service(self, tor_config):
         """Launch Tor service and return the process."""
 
-        self.tmp_tor_data_dir = utils.clone_dir_with_timestap(get_tor_data_path(self.tbb_path))
         tor_binary = get_tor_bin_path(self.tbb_path)
         prepend_to_env_var("LD_LIBRARY_PATH", os.path.dirname(tor_binary))
 
         assert os.path.isfile(tor_binary), "Tor binary not found"
 
         while True:
+            launch_deadline = None
             try:
                 print('INFO\tTry to launch tor with stem in {}'.format(utils.cal_now_time()))
-                self.tor_process = stem.process.launch_tor_with_config(
-                    config=tor_config,
-                    tor_cmd=tor_binary,
-                    timeout=utils.INTERVAL_WAIT_FOR_LAUNCH
-                )
+                # return at the first bootstrap line, readiness is tracked by the controller;
+                # stem's own timeout takes over SIGALRM, which the watchdog uses, so the launch
+                # runs under a deadline instead; it interrupts the blocking read in the main
+                # thread only, a pooled launch is left to the pool's acquire timeout
+                with utils.deadline(utils.INTERVAL_WAIT_FOR_LAUNCH) as launch_deadline:
+                    self.tor_process = stem.process.launch_tor_with_config(
+                        config=tor_config,
+                        tor_cmd=tor_binary,
+                        timeout=None,
+                        completion_percent=0
+                    )
                 print('INFO\tLaunch tor with stem finish in {}'.format(utils.cal_now_time()))
-                self.controller = Controller.from_port()
+                self.controller = Controller.from_port(port=self.control_port)
                 print('INFO\tFinish from_port at {}'.format(utils.cal_now_time()))
                 self.controller.authenticate()
                 print('INFO\tFinish authenticate at {}'.format(utils.cal_now_time()))
                 break
             except stem.SocketError as exc:
                 log.wl_log.critical("Unable to connect to tor on port %s: %s" %
-                                    (utils.USED_SOCKS_PORT, exc))
+                                    (self.control_port, exc))
                 sys.exit(1)
-            except:
+            except utils.TimeExceededError:
+                if launch_deadline is None or not utils.has_expired(launch_deadline):
+                    raise  # the deadline of a caller
+                log.wl_log.critical("Launching Tor timed out")
+            except (OSError, stem.ControllerError, stem.connection.AuthenticationFailure):
                 # most of the time this is due to another instance of
                 # tor running on the system
                 log.wl_log.critical(f"Error launching Tor", exc_info=True)
@@ -112,78 +242,183 @@ class TorController(object):
             time.sleep(utils.INTERVAL_WHEN_TOR_LAUNCH_ERROR)
 
         print("INFO\tTor running at port {0} & controller port {1}."
-              .format(utils.USED_SOCKS_PORT, utils.USED_CONTROL_PORT))
+              .format(self.socks_port, self.control_port))
         return self.tor_process
 
+    def get_or_connections(self):
+        """Return (remote address, remote port, local port) of Tor's relay connections."""
+        connections = []
+        try:
+            proc = psutil.Process(self.tor_process.pid)
+            net_connections = proc.net_connections if hasattr(proc, 'net_connections') else proc.connections
+            for conn in net_connections(kind='tcp'):
+                if conn.status == psutil.CONN_ESTABLISHED and conn.raddr and conn.raddr.ip != utils.LOCALHOST_IP:
+                    connections.append((conn.raddr.ip, conn.raddr.port, conn.laddr.port))
+        except (AttributeError, psutil.Error):
+            log.wl_log.warning("Cannot list the connections of the Tor process", exc_info=True)
+        return connections
+
+    def get_guard_endpoints(self):
+        """Return the (address, port) pairs of the relays Tor is connected to."""
+        endpoints = []
+        try:
+            for line in self.controller.get_info('orconn-status').splitlines():
+                relay = line.split()[0]
+                fingerprint = relay.lstrip('$').split('~')[0].split('=')[0]
+                desc = self.controller.get_network_status(fingerprint)
+                endpoints.append((desc.address, desc.or_port))
+        except Exception:
+            log.wl_log.warning("Cannot resolve the relays Tor is connected to", exc_info=True)
+        return endpoints
+
+    def watch_or_connections(self, callback):
+        """Call `callback` with Tor's relay connections whenever Tor opens one; return the listener."""
+        def on_orconn(event):
+            if event.status == 'CONNECTED':
+                callback(self.get_or_connections())
+
+        self.controller.add_event_listener(on_orconn, EventType.ORCONN)
+        return on_orconn
+
+    def unwatch_or_connections(self, listener):
+        try:
+            self.controller.remove_event_listener(listener)
+        except stem.ControllerError:
+            log.wl_log.warning("Cannot stop watching the relay connections of Tor", exc_info=True)
+
+    def new_identity(self):
+        """Ask Tor for clean circuits for the next visit (NEWNYM)."""
+        wait = self.controller.get_newnym_wait()
+        if wait > 0:
+            print("INFO\tWaiting {:.1f}s for NEWNYM to be available".format(wait))
+            time.sleep(wait)
+        self.controller.signal(Signal.NEWNYM)
+
+    def reset_identity(self, drop_guards=False, newnym=True):
+        """Prepare the running Tor for the next visit instead of restarting it.
+
+        NEWNYM gives the next visit new circuits; with drop_guards Tor also
+        picks new guards, as a fresh DataDirectory would, and the call waits
+        until it is ready again.
+        """
+        start = time.monotonic()
+        if drop_guards:
+            self.controller.drop_guards()
+        if newnym:
+            self.new_identity()
+        step = 'dropguards' if drop_guards else 'newnym' if newnym else 'reuse'
+        self.bootstrap_phases = [(step, time.monotonic() - start)]
+        if drop_guards:
+            self.bootstrap_phases += self.wait_until_ready()
+
     def close_all_streams(self):
         """Close all streams of a controller."""
         log.wl_log.debug("Closing all streams")
         try:
-            utils.timeout(utils.STREAM_CLOSE_TIMEOUT)
-            for stream in self.controller.get_streams():
-                log.wl_log.debug("Closing stream %s %s %s " %
-                                 (stream.id, stream.purpose,
-                                  stream.target_address))
-                self.controller.close_stream(stream.id)  # MISC reason
+            with utils.deadline(utils.STREAM_CLOSE_TIMEOUT):
+                for stream in self.controller.get_streams():
+                    log.wl_log.debug("Closing stream %s %s %s " %
+                                     (stream.id, stream.purpose,
+                                      stream.target_address))
+                    self.controller.close_stream(stream.id)  # MISC reason
         except utils.TimeExceededError:
             log.wl_log.critical("Closing streams timed out!")
         except:
             log.wl_log.debug("Exception closing stream")
-        finally:
-            utils.cancel_timeout()
+
+
+# Preferences of the crawler's Tor Browser profile (the SOCKS port is set per driver)
+CRAWLER_PREFS = [
+    # set homepage to a blank tab
+    ('browser.startup.page', "0"),
+    ('browser.startup.homepage', 'about:newtab'),
+    # Other
+    # ('extensions.torbutton.prompted_language', True),
+    # configure Firefox to use Tor SOCKS proxy
+    ('network.proxy.type', 1),
+    ('network.proxy.socks', '127.0.0.1'),
+    ('extensions.torlauncher.prompt_at_startup', 0),
+    # Disable cache - Wang & Goldberg's setting
+    ('network.http.use-cache', False),
+    # http://www.w3.org/TR/webdriver/#page-load-strategies-1
+    # wait for all frames to load and make sure there's no
+    # outstanding http requests (except AJAX)
+    # https://code.google.com/p/selenium/wiki/DesiredCapabilities
+    # Note that W3C doesn't mention "conservative", this may change in the
+    # upcoming versions of the Firefox Webdriver
+    # https://w3c.github.io/webdriver/webdriver-spec.html#the-page-load-strategy
+    ('webdriver.load.strategy', 'conservative'),
+    # prevent Tor Browser running it's own Tor process
+    ('extensions.torlauncher.start_tor', False),
+    ('extensions.torbutton.versioncheck_enabled', False),
+    ('permissions.memory_only', False),
+]
+
+# Clear all site data of a running browser and point it to the given SOCKS port (chrome context)
+RESET_STATE_SCRIPT = """
+const [socksPort, done] = arguments;
+Services.prefs.setIntPref('network.proxy.socks_port', socksPort);
+Services.clearData.deleteData(Ci.nsIClearDataService.CLEAR_ALL, () => done(true));
+"""
+
+RANDOMIZEDPIPELINENING_PREFS = [
+    ('network.http.pipelining.max-optimistic-requests', 5000),
+    ('network.http.pipelining.maxrequests', 15000),
+    ('network.http.pipelining', False),
+]
+
+
+class FirefoxOptions(firefox.options.Options):
+    """Firefox options with the environment variables geckodriver starts the browser with."""
+
+    def __init__(self):
+        super(FirefoxOptions, self).__init__()
+        self.env = {}
+
+    def to_capabilities(self):
+        caps = super(FirefoxOptions, self).to_capabilities()
+        if self.env:
+            caps.setdefault(self.KEY, {})['env'] = dict(self.env)
+        return caps
 
 
 class TorBrowserDriver(webdriver.Firefox, RemoteWebDriver):
     def __init__(self, tbb_binary_path=None, tbb_profile_dir=None,
                  tbb_logfile_path=None,
-                 tbb_path=None, DISABLE_RANDOMIZEDPIPELINENING=False):
+                 tbb_path=None, DISABLE_RANDOMIZEDPIPELINENING=False, socks_port=utils.USED_SOCKS_PORT,
+                 profile_provisioner=None, display=None, headless=False):
         self.is_running = False
         self.tbb_path = tbb_path
+        self.socks_port = socks_port
+        self.profile_provisioner = profile_provisioner
         prepend_to_env_var("LD_LIBRARY_PATH", os.path.dirname(get_tor_bin_path(tbb_path)))
 
-        # Initialize Tor Browser's profile
-        self.profile = self.init_tbb_profile()
-
-        # set homepage to a blank tab
-        self.profile.set_preference('browser.startup.page', "0")
-        self.profile.set_preference('browser.startup.homepage', 'about:newtab')
-
-        # Other
-        # self.profile.set_preference('extensions.torbutton.prompted_language', True)
-
-        # configure Firefox to use Tor SOCKS proxy
-        self.profile.set_preference('network.proxy.type', 1)
-        self.profile.set_preference('network.proxy.socks', '127.0.0.1')
-        self.profile.set_preference('network.proxy.socks_port', utils.USED_SOCKS_PORT)
-        if DISABLE_RANDOMIZEDPIPELINENING:
-            self.profile.set_preference(
-                'network.http.pipelining.max-optimistic-requests', 5000)
-            self.profile.set_preference(
-                'network.http.pipelining.maxrequests', 15000)
-            self.profile.set_preference('network.http.pipelining', False)
-
-        self.profile.set_preference(
-            'extensions.torlauncher.prompt_at_startup',
-            0)
-
-        # Disable cache - Wang & Goldberg's setting
-        self.profile.set_preference('network.http.use-cache', False)
-
-        # http://www.w3.org/TR/webdriver/#page-load-strategies-1
-        # wait for all frames to load and make sure there's no
-        # outstanding http requests (except AJAX)
-        # https://code.google.com/p/selenium/wiki/DesiredCapabilities
-        self.profile.set_preference('webdriver.load.strategy', 'conservative')
-        # Note that W3C doesn't mention "conservative", this may change in the
-        # upcoming versions of the Firefox Webdriver
-        # https://w3c.github.io/webdriver/webdriver-spec.html#the-page-load-strategy
-
-        # prevent Tor Browser running it's own Tor process
-        self.profile.set_preference('extensions.torlauncher.start_tor', False)
-        self.profile.set_preference(
-            'extensions.torbutton.versioncheck_enabled', False)
-        self.profile.set_preference('permissions.memory_only', False)
-        self.profile.update_preferences()
+        options = None
+        if self.profile_provisioner:
+            # the provisioned profile already has the crawler preferences, let
+            # Firefox run it in place instead of copying it through selenium
+            self.prof_dir_path = self.profile_provisioner.acquire(self.socks_port)
+            self.profile = None
+            options = FirefoxOptions()
+            options.add_argument('-profile')
+            options.add_argument(self.prof_dir_path)
+        else:
+            # Initialize Tor Browser's profile
+            self.profile = self.init_tbb_profile()
+            for name, value in CRAWLER_PREFS:
+                self.profile.set_preference(name, value)
+            self.profile.set_preference('network.proxy.socks_port', self.socks_port)
+            if DISABLE_RANDOMIZEDPIPELINENING:
+                for name, value in RANDOMIZEDPIPELINENING_PREFS:
+                    self.profile.set_preference(name, value)
+            self.profile.update_preferences()
+        if headless or display is not None:
+            options = options or FirefoxOptions()
+        if headless:
+            options.add_argument('-headless')
+        elif display is not None:
+            # only the browser gets the display, the DISPLAY of the process is left alone
+            options.env['DISPLAY'] = get_display_var(display)
         # Initialize Tor Browser's binary
         self.binary = self.get_tbb_binary(logfile=tbb_logfile_path)
 
@@ -198,7 +433,8 @@ class TorBrowserDriver(webdriver.Firefox, RemoteWebDriver):
             super(TorBrowserDriver, self)\
                 .__init__(firefox_profile=self.profile,
                           firefox_binary=self.binary,
-                          capabilities=self.mycapabilities)
+                          capabilities=self.mycapabilities,
+                          options=options)
             # executable_path=utils.geckodrive_path)
             self.is_running = True
         except WebDriverException as error:
@@ -211,6 +447,24 @@ class TorBrowserDriver(webdriver.Firefox, RemoteWebDriver):
             log.wl_log.error("Error connecting to Webdriver: %s" % e,
                              exc_info=True)
 
+    def reset_state(self, socks_port):
+        """Bring a running browser back to a clean state between two visits."""
+        handles = self.window_handles
+        for handle in handles[1:]:
+            self.switch_to.window(handle)
+            self.close()
+        self.switch_to.window(handles[0])
+        self.get('about:blank')
+        with self.context(self.CONTEXT_CHROME):
+            self.execute_async_script(RESET_STATE_SCRIPT, socks_port)
+        self.socks_port = socks_port
+
+    def is_healthy(self):
+        try:
+            return self.is_running and self.execute_script('return 1;') == 1
+        except Exception:
+            return False
+
     def get_tbb_binary(self, binary=None, logfile=None):
         """Return FirefoxBinary pointing to the TBB's firefox binary."""
         tbb_logfile = None
@@ -236,18 +490,22 @@ class TorBrowserDriver(webdriver.Firefox, RemoteWebDriver):
         else:
             return tbb_profile
 
-    def quit(self, _timeout=600):
+    def quit(self, _timeout=utils.BROWSER_QUIT_TIMEOUT):
         """
         Overrides the base class method cleaning the timestamped profile.
 
         """
-        utils.timeout(_timeout)
+        deadline = utils.timeout(_timeout)
         self.is_running = False
         try:
+            if self.profile_provisioner:
+                super(TorBrowserDriver, self).quit()
+                log.wl_log.info("Quit: Releasing profile dir")
+                self.profile_provisioner.release(self.prof_dir_path)
+                return
             log.wl_log.info("Quit: Removing profile dir")
             shutil.rmtree(self.prof_dir_path)
             super(TorBrowserDriver, self).quit()
-            utils.cancel_timeout()
         except CannotSendRequest:
             log.wl_log.error("CannotSendRequest while quitting TorBrowserDriver",
                              exc_info=False)
@@ -258,16 +516,36 @@ class TorBrowserDriver(webdriver.Firefox, RemoteWebDriver):
             self.binary.kill()
             # remove the profile folder
             try:
-                shutil.rmtree(str(self.profile.path))
-                if self.profile.tempfolder is not None:
-                    shutil.rmtree(self.profile.tempfolder)
-                utils.cancel_timeout()
+                if self.profile_provisioner:
+                    self.profile_provisioner.release(self.prof_dir_path)
+                else:
+                    shutil.rmtree(str(self.profile.path))
+                    if self.profile.tempfolder is not None:
+                        shutil.rmtree(self.profile.tempfolder)
             except Exception as e:
                 print(str(e))
         except Exception:
             log.wl_log.error("Exception while quitting TorBrowserDriver",
                              exc_info=True)
-            utils.cancel_timeout()
+            if self.profile_provisioner:
+                self.profile_provisioner.release(self.prof_dir_path)
+        finally:
+            utils.cancel_timeout(deadline)
+
+    def kill(self):
+        """SIGKILL geckodriver and the browser, e.g. when quit() hangs."""
+        self.is_running = False
+        service = getattr(self, 'service', None)
+        if service and service.process:
+            try:
+                utils.kill_all_children(service.process.pid)  # the browser started by geckodriver
+            except psutil.NoSuchProcess:
+                pass
+            service.process.kill()
+        try:
+            self.binary.kill()  # the browser of a legacy (non-marionette) session
+        except Exception:
+            pass
 
 
 if __name__ == "__main__":
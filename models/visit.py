@@ -1,10 +1,15 @@
 from __future__ import annotations
 
+import functools
 import os
 import sys
 import time
 
-from .dumputils import Sniffer
+from .dumputils import Sniffer, get_sniffer
+from .budget import Budget
+from .display import DisplayPool
+from .dwell import DwellMonitor, DwellPolicy
+from .metrics import PhaseTimer
 from .torutils import TorBrowserDriver, TorController
 
 from helper import utils
@@ -15,7 +20,7 @@ sys.path.append('../..')
 class Visit(object):
     """Hold info about a particular visit to a page."""
 
-    def __init__(self, page_url: str, url_dir: str, tor_controller: TorController, tbb_path, xvfb: bool, screenshot: bool):
+    def __init__(self, page_url: str, url_dir: str, tor_controller: TorController, tbb_path, xvfb: bool, screenshot: bool, capture_filter: str | None = None, dwell_policy: DwellPolicy | None = None, profile_provisioner=None, tb_driver: TorBrowserDriver | None = None, capture_backend: str = utils.CAPTURE_BACKEND, sniffer: Sniffer | None = None, xvfb_display=None, phase_timer: PhaseTimer | None = None, budget: Budget | None = None, snaplen: int = 0, display_pool: DisplayPool | None = None, headless: bool = False):
         # load
         self.visit_dir: str
         self.visit_log_dir: str
@@ -25,20 +30,41 @@ class Visit(object):
         self.tbb_path = tbb_path
         self.xvfb = xvfb
         self.screenshot = screenshot
+        self.capture_filter = capture_filter or f'tcp and host {utils.MY_IP}'
+        self.dwell_policy = dwell_policy or DwellPolicy()
+        self.dwell_time = None
+        self.dwell_reason = None
+        self.screenshot_path = None
+        self.budget = budget or self.dwell_policy.get_budget(page_url)
+        self.phase_timer = phase_timer or PhaseTimer()
+        self.deadline = None  # hard timeout of get(), cancelled once the capture is stopped
+        self.orconn_listener = None  # feeds the relay connections Tor opens during the capture to the sniffer
 
         # init visit dir
         self.init_visit_dir()
         self.pcap_path = os.path.join(self.visit_dir, "tcp.pcap")
 
-        # use xvfb
-        if self.xvfb:
-            self.xvfb_display = utils.start_xvfb()
-
-        # Create new instance of TorBrowser driver
-        self.tb_driver = TorBrowserDriver(
-            tbb_logfile_path=os.path.join(self.visit_dir, "logs", "firefox.log"), tbb_path=self.tbb_path)
+        self.display_pool = display_pool
+        self.xvfb_display = None
+
+        # a driver given by a persistent browser session outlives the visit
+        self.own_driver = tb_driver is None
+        if self.own_driver:
+            # use xvfb, unless the display was started (or leased) ahead of the visit
+            self.xvfb_display = xvfb_display
+            if self.xvfb and not self.xvfb_display:
+                self.xvfb_display = display_pool.acquire() if display_pool else utils.start_xvfb()
+
+            # Create new instance of TorBrowser driver
+            self.tb_driver = TorBrowserDriver(
+                tbb_logfile_path=os.path.join(self.visit_dir, "logs", "firefox.log"), tbb_path=self.tbb_path,
+                socks_port=self.tor_controller.socks_port, profile_provisioner=profile_provisioner,
+                display=self.xvfb_display, headless=headless)
+        else:
+            self.tb_driver = tb_driver
 
-        self.sniffer = Sniffer()  # sniffer to capture the network traffic
+        # sniffer to capture the network traffic
+        self.sniffer = sniffer or get_sniffer(capture_backend, snaplen=snaplen)
 
     def init_visit_dir(self):
         """Create results and logs directories for this visit."""
@@ -47,25 +73,61 @@ class Visit(object):
         utils.create_dir(self.visit_log_dir)
 
     def cleanup_visit(self):
-        """Kill sniffer and Tor browser if they're running."""
+        """Stop sniffer, streams, Tor browser and display concurrently, killing what overruns the deadline."""
         print("INFO\tCleaning up visit.")
+        if self.deadline is not None:
+            utils.cancel_timeout(self.deadline)
+            self.deadline = None
+        self.unwatch_connections()
+        tasks = [('close streams', self.tor_controller.close_all_streams, None)]
+        if self.sniffer and self.sniffer.is_recording:
+            tasks.append(('stop sniffer', self.sniffer.stop_capture, self.sniffer.kill))
+        utils.run_concurrently(tasks + self.get_teardown_tasks(), utils.VISIT_CLEANUP_TIMEOUT)
+        self.release_display()
+
+    def stop_capture(self):
+        """End the measured part of the visit: stop the sniffer and close the open streams."""
         print("INFO\tCancelling timeout")
-        utils.cancel_timeout()
+        if self.deadline is not None:
+            utils.cancel_timeout(self.deadline)
+            self.deadline = None
+        self.unwatch_connections()
 
         if self.sniffer and self.sniffer.is_recording:
             print("INFO\tStopping sniffer...")
             self.sniffer.stop_capture()
-        if self.tb_driver and self.tb_driver.is_running:
-            # shutil.rmtree(self.tb_driver.prof_dir_path)
-            print("INFO\tQuitting selenium driver...")
-            self.tb_driver.quit()
-
         # close all open streams to prevent pollution
         print("INFO\tClose all open streams")
         self.tor_controller.close_all_streams()
-        if self.xvfb:
-            print("INFO\tStop xvfb")
-            utils.stop_xvfb(self.xvfb_display)
+
+    def unwatch_connections(self):
+        if self.orconn_listener:
+            self.tor_controller.unwatch_or_connections(self.orconn_listener)
+            self.orconn_listener = None
+
+    def get_teardown_tasks(self):
+        """Return the (name, func, kill) tasks quitting the browser and its display."""
+        tasks = []
+        if self.own_driver and self.tb_driver and self.tb_driver.is_running:
+            # shutil.rmtree(self.tb_driver.prof_dir_path)
+            tasks.append(('quit browser', self.tb_driver.quit, self.tb_driver.kill))
+        if self.own_driver and self.xvfb_display and not self.display_pool:
+            tasks.append(('stop xvfb', functools.partial(utils.stop_xvfb, self.xvfb_display), None))
+        return tasks
+
+    def release_display(self):
+        """Give a pooled display back once its browser is gone."""
+        if self.own_driver and self.display_pool:
+            self.display_pool.release(self.xvfb_display)
+        self.xvfb_display = None
+
+    def teardown(self):
+        """Quit the browser and its display; nothing here is captured, so it may run after the next visit started."""
+        tasks = self.get_teardown_tasks()
+        if tasks:
+            print("INFO\tQuitting selenium driver and xvfb")
+            utils.run_concurrently(tasks, utils.VISIT_CLEANUP_TIMEOUT)
+        self.release_display()
 
     def take_screenshot(self, url):
         try:
@@ -74,27 +136,51 @@ class Visit(object):
             out_png = os.path.join(self.visit_dir, '{}.png'.format(url))
             print("INFO\tTaking screenshot of %s to %s" % (self.page_url, out_png))
             self.tb_driver.get_screenshot_as_file(out_png)
+            self.screenshot_path = out_png
         except:
             print("ERROE\tException while taking screenshot of: %s" % self.page_url)
             return False
         return True
 
-    def get(self):
-        """Call the specific visit function depending on the experiment."""
+    def dwell(self, page_url):
+        """Stay on the page according to the dwell policy, at most the visit's dwell budget."""
+        max_dwell = self.budget.dwell
+        if self.dwell_policy.mode == 'fixed':
+            time.sleep(max_dwell)
+            self.dwell_time, self.dwell_reason = max_dwell, 'fixed'
+            return
+        monitor = DwellMonitor(self.tor_controller.controller, self.pcap_path)
+        monitor.start()
+        try:
+            self.dwell_time, self.dwell_reason = monitor.wait(
+                min(self.dwell_policy.min_dwell, max_dwell), max_dwell, self.dwell_policy.quiet_period)
+        finally:
+            monitor.stop()
+
+    def get(self, teardown=True):
+        """Call the specific visit function depending on the experiment.
 
-        utils.timeout(utils.HARD_VISIT_TIMEOUT)
+        With teardown=False the visit returns once the capture is stopped and
+        the caller runs teardown().
+        """
+
+        self.deadline = utils.timeout(self.budget.hard_timeout)
 
         print('INFO\tcapture start in {} path {}'.format(utils.cal_now_time(), self.pcap_path))
-        self.sniffer.start_capture(
-            self.pcap_path,
-            f'tcp and host {utils.MY_IP}')
+        with self.phase_timer.phase('capture_start'):
+            self.sniffer.start_capture(
+                self.pcap_path,
+                self.capture_filter)
+            if self.sniffer.follows_connections:
+                self.orconn_listener = self.tor_controller.watch_or_connections(self.sniffer.add_connections)
 
-        try:
-            self.tb_driver.set_page_load_timeout(utils.SOFT_VISIT_TIMEOUT)
-        except:
-            print("INFO\tException setting a timeout {}".format(self.page_url))
+            try:
+                self.tb_driver.set_page_load_timeout(self.budget.soft_timeout)
+            except:
+                print("INFO\tException setting a timeout {}".format(self.page_url))
 
-        time.sleep(utils.WAIT_AFTER_DUMP)
+            if not self.sniffer.confirms_start:
+                time.sleep(utils.WAIT_AFTER_DUMP)
 
         page_url = self.page_url
         if 'http://' in page_url or 'https://' in page_url:
@@ -102,16 +188,24 @@ class Visit(object):
         else:
             newTab = 'window.open("https://%s");' % page_url
         print('INFO\tCrawling URL: {} in {}'. format(page_url, utils.cal_now_time()))
-        self.tb_driver.execute_script(newTab)
-        self.tb_driver.switch_to.window(self.tb_driver.window_handles[-1])
+        with self.phase_timer.phase('page_open'):
+            self.tb_driver.execute_script(newTab)
+            self.tb_driver.switch_to.window(self.tb_driver.window_handles[-1])
 
-        time.sleep(utils.WAIT_FOR_VISIT) if not '.onion' in page_url else time.sleep(utils.WAIT_FOR_VISIT_ONION)
-        print('INFO\tEnd crawling url in {}'.format(utils.cal_now_time()))
+        with self.phase_timer.phase('dwell'):
+            self.dwell(page_url)
+        print('INFO\tEnd crawling url in {} after {:.1f}s ({})'.format(
+            utils.cal_now_time(), self.dwell_time, self.dwell_reason))
 
         if self.screenshot:
-            self.tb_driver.switch_to.window(self.tb_driver.window_handles[1])
-            self.take_screenshot(page_url)
-        self.cleanup_visit()
+            with self.phase_timer.phase('screenshot'):
+                self.tb_driver.switch_to.window(self.tb_driver.window_handles[1])
+                self.take_screenshot(page_url)
+        with self.phase_timer.phase('capture_stop'):
+            self.stop_capture()
+        if teardown:
+            with self.phase_timer.phase('cleanup'):
+                self.teardown()
 
 
 if __name__ == "__main__":
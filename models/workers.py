@@ -0,0 +1,88 @@
+from __future__ import annotations
+
+import itertools
+import multiprocessing
+import random
+import sys
+import time
+
+from helper import log, utils
+
+sys.path.append('../..')
+
+
+def gen_jobs(url_list, torrc_paths, num_batches, block_size=utils.TORRC_BLOCK_SIZE):
+    """Return the (batch, site, url, torrc) jobs of a crawl, shuffled per batch.
+
+    Every len(torrc_paths) batches, each URL is visited once with each torrc,
+    in a random order, and each batch uses every torrc for as many URLs (to
+    one). A batch is visited in blocks of at most `block_size` URLs sharing a
+    torrc, in random order, so that a Tor process serves a whole block.
+    """
+    jobs = []
+    url_list = list(url_list)
+    for batch_num in range(num_batches):
+        step = batch_num % len(torrc_paths)
+        if step == 0:
+            order = random.sample(torrc_paths, len(torrc_paths))
+            offsets = dict(zip(random.sample(url_list, len(url_list)), itertools.cycle(range(len(torrc_paths)))))
+        random.shuffle(url_list)
+        groups = {}
+        for site_num, page_url in enumerate(url_list):
+            torrc = order[(offsets[page_url] + step) % len(order)]
+            groups.setdefault(torrc, []).append((site_num, page_url))
+        blocks = []
+        for torrc, sites in groups.items():
+            random.shuffle(sites)
+            blocks.extend((torrc, sites[i:i + block_size]) for i in range(0, len(sites), block_size))
+        random.shuffle(blocks)
+        jobs.extend((batch_num, site_num, page_url, torrc) for torrc, sites in blocks for site_num, page_url in sites)
+    return jobs
+
+
+class WorkerPool(object):
+    """Run several crawl workers that pull jobs from a shared queue."""
+
+    def __init__(self, num_workers: int, target, args=()):
+        self.num_workers = num_workers
+        self.target = target  # called as target(worker_id, job_queue, *args)
+        self.args = args
+        self.procs: list[multiprocessing.Process] = []
+
+    def run(self, jobs):
+        """Start the workers, queue the jobs and wait for all of them to finish.
+
+        `jobs` may be a generator yielding None while it waits for the workers,
+        as the jobs of a quota crawl depend on the outcome of the previous ones.
+        """
+        job_queue = multiprocessing.Queue()
+        for worker_id in range(self.num_workers):
+            proc = multiprocessing.Process(target=self.target, args=(worker_id, job_queue) + tuple(self.args),
+                                           name='crawl-worker-{}'.format(worker_id))
+            proc.start()
+            self.procs.append(proc)
+        print("INFO\tStarted {} crawl workers".format(self.num_workers))
+
+        for job in jobs:
+            if job is not None:
+                job_queue.put(job)
+                continue
+            if not any(proc.is_alive() for proc in self.procs):
+                log.wl_log.error("All crawl workers exited, stopping the crawl")
+                break
+            time.sleep(utils.QUOTA_POLL_INTERVAL)
+        for _ in range(self.num_workers):
+            job_queue.put(None)  # one sentinel per worker
+
+        for proc in self.procs:
+            proc.join()
+            if proc.exitcode:
+                log.wl_log.error("Worker %s exited with code %s" % (proc.name, proc.exitcode))
+
+    def terminate(self):
+        """Stop all workers that are still running."""
+        for proc in self.procs:
+            if proc.is_alive():
+                proc.terminate()
+        for proc in self.procs:
+            proc.join()
@@ -0,0 +1,64 @@
+from __future__ import annotations
+
+import argparse
+import os
+import sys
+import time
+from multiprocessing import Pool
+
+from helper import utils
+from helper.pcaputils import find_pcap
+from helper.traceutils import (PCAP_FILENAME, get_local_address, get_trace_path, is_up_to_date, iter_visit_dirs,
+                               pcap_to_trace, save_trace)
+
+
+def read_crawl_ip(crawl_dir):
+    """Return the host IP recorded by the crawler, or utils.MY_IP."""
+    try:
+        with open(os.path.join(crawl_dir, 'ip'), 'r') as fp:
+            return fp.readline().strip() or utils.MY_IP
+    except OSError:
+        return utils.MY_IP
+
+
+def convert_visit(job):
+    visit_dir, my_ip = job
+    try:
+        trace = pcap_to_trace(os.path.join(visit_dir, PCAP_FILENAME), my_ip)
+        save_trace(trace, get_trace_path(visit_dir))
+    except Exception as exc:
+        return visit_dir, None, str(exc)
+    return visit_dir, len(trace), None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert the pcaps of a crawl into compact per-visit traces.')
+    parser.add_argument('--crawl_dir', default='output/crawl', type=str, help='Crawl directory (with batch-*/url-*)')
+    parser.add_argument('--workers', default=os.cpu_count(), type=int, help='Number of converter processes')
+    parser.add_argument('--my_ip', default='', type=str, help='Crawler IP, read from <crawl_dir>/ip by default')
+    parser.add_argument('--force', action='store_true', help='Convert visits that are already up to date')
+    args = parser.parse_args()
+
+    assert os.path.isdir(args.crawl_dir), "Invalid crawl dir {}".format(args.crawl_dir)
+    if args.my_ip and get_local_address(args.my_ip) is None:
+        parser.error('--my_ip must be an IPv4 address, got {!r}'.format(args.my_ip))
+    my_ip = args.my_ip or read_crawl_ip(args.crawl_dir)
+    if get_local_address(my_ip) is None:
+        print('WARNING\tNo crawler IP recorded ({!r}), taking the local address of each capture'.format(my_ip))
+        my_ip = ''
+
+    jobs = [(visit_dir, my_ip) for visit_dir in iter_visit_dirs(args.crawl_dir)
+            if find_pcap(os.path.join(visit_dir, PCAP_FILENAME))
+            and (args.force or not is_up_to_date(visit_dir))]
+    print('INFO\tConverting {} visits of {} with {} workers, ip {}'.format(len(jobs), args.crawl_dir,
+                                                                          args.workers, my_ip or 'per capture'))
+
+    start = time.time()
+    failed = 0
+    with Pool(args.workers) as pool:
+        for visit_dir, packets, error in pool.imap_unordered(convert_visit, jobs, chunksize=8):
+            if error:
+                failed += 1
+                print('ERROR\tCannot convert {}: {}'.format(visit_dir, error))
+    print('INFO\tConverted {} visits ({} failed) in {:.1f}s'.format(len(jobs) - failed, failed, time.time() - start))
+    sys.exit(1 if failed else 0)
@@ -1,4 +1,4 @@
-echo "pipeline.sh <dataset_name> <open_world:cw/ow>"
+echo "pipeline.sh <dataset_name> <open_world:cw/ow> [resume]"
 
 # Parameter
 result_path='/root/wfpdata/dataset_'$1'_'$2/
@@ -22,9 +22,14 @@ echo "num_batch: " $num_batch
 # kill existing tor
 pkill tor
 
-# remove data
-rm -rf ${result_path}
+# remove data, unless continuing an interrupted crawl
+resume_flag=''
+if [ "$3" == 'resume' ]; then
+    resume_flag='--resume'
+else
+    rm -rf ${result_path}
+fi
 
 # Data collection
 # conda activate py36
-python data_collector.py --urls_closeworld ${urls_closeworld} --urls_openworld ${urls_openworld} --output ${result_path} --tbbpath ${tbbpath} --torrc_dir_path ${torrc_dir_path} --xvfb True --batch ${num_batch} --screenshot True --open_world $2 --open_world_num ${open_world_num} --open_world_server_conf_path ${open_world_server_conf_path} --myexip ${myexip}
+python data_collector.py --urls_closeworld ${urls_closeworld} --urls_openworld ${urls_openworld} --output ${result_path} --tbbpath ${tbbpath} --torrc_dir_path ${torrc_dir_path} --xvfb True --batch ${num_batch} --screenshot True --open_world $2 --open_world_num ${open_world_num} --open_world_server_conf_path ${open_world_server_conf_path} --myexip ${myexip} ${resume_flag}
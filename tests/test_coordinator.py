@@ -0,0 +1,125 @@
+import json
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+
+from models import coordinator
+from models.coordinator import JobStore, make_coordinator_server
+
+JOBS = [(0, 0, 'a.onion', 't0'), (0, 1, 'b.onion', 't0')]
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(coordinator, 'time', clock)
+    return clock
+
+
+@pytest.fixture
+def store(tmp_path, clock):
+    store = JobStore(str(tmp_path / 'jobs.db'), lease_timeout=60, max_attempts=2)
+    store.add_jobs(JOBS)
+    return store
+
+
+def test_jobs_are_added_once(store):
+    assert not store.add_jobs(JOBS)
+    assert store.get_stats() == {'pending': 2}
+
+
+def test_lease_in_order(store):
+    assert store.lease('w1') == ((0, 0, 'a.onion', 't0'), False)
+    assert store.lease('w2') == ((0, 1, 'b.onion', 't0'), False)
+    assert store.lease('w3') == (None, False)  # nothing to lease, but leases are still out
+
+
+def test_expired_lease_is_taken_over(store, clock):
+    store.lease('w1')
+    store.lease('w1')
+    clock.now += 61
+    assert store.lease('w2') == ((0, 0, 'a.onion', 't0'), False)
+    assert not store.complete('w1', 0, 0, 'ok')  # w1 lost the lease
+    assert store.complete('w2', 0, 0, 'ok')
+
+
+def test_renew_keeps_the_lease(store, clock):
+    store.lease('w1')
+    store.lease('w1')
+    clock.now += 50
+    store.renew('w1', [(0, 0)])
+    clock.now += 50
+    assert store.lease('w2') == ((0, 1, 'b.onion', 't0'), False)
+
+
+def test_job_fails_after_max_attempts(store, clock):
+    for _ in range(2):
+        store.lease('w1')
+        store.lease('w1')
+        clock.now += 61
+    store.complete('w1', 0, 1, 'timeout')
+    assert store.lease('w1') == (None, True)
+    assert store.get_stats() == {'failed': 2}
+
+
+def test_failed_visit_is_retried(store):
+    store.lease('w1')
+    assert store.complete('w1', 0, 0, 'timeout')
+    assert store.lease('w2') == ((0, 0, 'a.onion', 't0'), False)
+    assert store.complete('w2', 0, 0, 'ok')
+    assert store.get_stats() == {'done': 1, 'pending': 1}
+
+
+def test_worker_keeps_its_torrc_block(tmp_path, clock):
+    store = JobStore(str(tmp_path / 'jobs.db'), torrc_block=2)
+    store.add_jobs([(0, 0, 'a.onion', 't0'), (0, 1, 'b.onion', 't0'), (0, 2, 'c.onion', 't0'),
+                    (0, 3, 'd.onion', 't1'), (0, 4, 'e.onion', 't1')])
+    assert store.lease('w1')[0][1] == 0
+    assert store.lease('w2')[0][1] == 2   # site 1 continues the block of w1
+    assert store.complete('w1', 0, 0, 'ok')
+    assert store.lease('w1')[0][1] == 1
+    assert store.lease('w1')[0][1] == 3   # the block of w1 is full
+    assert store.lease('w2')[0][1] == 4   # t0 ended, a new block starts
+    assert store.lease('w3') == (None, False)
+
+
+def test_reserved_job_is_leased_when_nothing_else_is_left(tmp_path, clock):
+    store = JobStore(str(tmp_path / 'jobs.db'), torrc_block=5)
+    store.add_jobs(JOBS)
+    store.lease('w1')
+    assert store.lease('w2') == ((0, 1, 'b.onion', 't0'), False)
+
+
+def post(url, body):
+    request = urllib.request.Request(url, data=body, headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request, timeout=5) as response:
+        return json.load(response)
+
+
+def test_http_api(store):
+    server = make_coordinator_server(store, port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    try:
+        reply = post(url + '/lease', b'{"worker": "w1"}')
+        assert reply == {'job': [0, 0, 'a.onion', 't0'], 'done': False, 'torrc_block': store.torrc_block}
+        assert post(url + '/complete', b'{"worker": "w1", "batch": 0, "site": 0, "status": "ok"}') == \
+            {'accepted': True}
+        for path, body in (('/lease', b'{"worker": '), ('/lease', b'[1, 2]'), ('/complete', b'{"batch": 0}')):
+            with pytest.raises(urllib.error.HTTPError) as error:
+                post(url + path, body)
+            assert error.value.code == 400
+    finally:
+        server.shutdown()
+        server.server_close()
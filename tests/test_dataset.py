@@ -0,0 +1,99 @@
+import os
+
+import numpy as np
+
+from helper.dataset import TRACES_FILE, VISITS_FILE, PackedDataset, pack_crawl
+from helper.traceutils import TRACE_DTYPE, get_trace_path, save_trace
+from helper.validation import write_validation
+from models.manifest import STATUS_OK, Manifest
+
+
+def add_visit(crawl_dir, batch, index, label, num_packets, torrc='default.torrc', status=STATUS_OK):
+    visit_dir = os.path.join(str(crawl_dir), 'batch-{}'.format(batch), 'url-{}'.format(index))
+    os.makedirs(visit_dir)
+    trace = np.zeros(num_packets, dtype=TRACE_DTYPE)
+    trace['time'] = np.arange(num_packets)
+    trace['direction'] = 1
+    trace['size'] = index + 1
+    save_trace(trace, get_trace_path(visit_dir))
+    for filename, value in (('label', label), ('torrc_path', '/torrcs/' + torrc)):
+        with open(os.path.join(visit_dir, filename), 'w') as fp:
+            fp.write(value + '\n')
+    Manifest(str(crawl_dir)).record(batch, index, label, '/torrcs/' + torrc, status, 0.0, 1.0)
+    return trace
+
+
+def test_pack_and_read(tmp_path):
+    crawl_dir, pack_dir = tmp_path / 'crawl', str(tmp_path / 'pack')
+    first = add_visit(crawl_dir, 0, 0, 'a.onion', 3)
+    second = add_visit(crawl_dir, 0, 1, 'b.onion', 5, torrc='other.torrc')
+    assert pack_crawl(str(crawl_dir), pack_dir) == 2
+
+    dataset = PackedDataset(pack_dir)
+    assert len(dataset) == 2
+    assert dataset[0].tolist() == first.tolist()
+    assert dataset[-1].tolist() == second.tolist()
+    assert dataset.label_names == ['a.onion', 'b.onion']
+    assert dataset.select(label='b.onion').tolist() == [1]
+    assert dataset.select(torrc='default.torrc').tolist() == [0]
+    assert [labels.tolist() for _, labels in dataset.iter_batches(1)] == [[0], [1]]
+
+
+def test_append_skips_packed_visits(tmp_path):
+    crawl_dir, pack_dir = tmp_path / 'crawl', str(tmp_path / 'pack')
+    add_visit(crawl_dir, 0, 0, 'a.onion', 3)
+    assert pack_crawl(str(crawl_dir), pack_dir) == 1
+    add_visit(crawl_dir, 1, 0, 'a.onion', 2)
+    assert pack_crawl(str(crawl_dir), pack_dir) == 1
+    assert pack_crawl(str(crawl_dir), pack_dir) == 0
+
+    dataset = PackedDataset(pack_dir)
+    assert len(dataset) == 2
+    assert dataset.batches.tolist() == [0, 1]
+    assert dataset.label_names == ['a.onion']
+
+
+def test_pack_two_crawls(tmp_path):
+    pack_dir = str(tmp_path / 'pack')
+    add_visit(tmp_path / 'first', 0, 0, 'a.onion', 3)
+    add_visit(tmp_path / 'second', 0, 0, 'b.onion', 2)
+    assert pack_crawl(str(tmp_path / 'first'), pack_dir, 'first') == 1
+    assert pack_crawl(str(tmp_path / 'second'), pack_dir, 'second') == 1
+    assert pack_crawl(str(tmp_path / 'second'), pack_dir, 'second') == 0
+
+    dataset = PackedDataset(pack_dir)
+    assert len(dataset) == 2
+    assert dataset.label_names == ['a.onion', 'b.onion']
+    with open(os.path.join(pack_dir, VISITS_FILE), 'r') as fp:
+        assert fp.read().splitlines() == ['first/batch-0/url-0', 'second/batch-0/url-0']
+
+
+def test_only_successful_visits_are_packed(tmp_path):
+    crawl_dir, pack_dir = tmp_path / 'crawl', str(tmp_path / 'pack')
+    add_visit(crawl_dir, 0, 0, 'a.onion', 3)
+    add_visit(crawl_dir, 0, 1, 'b.onion', 3, status='timeout')
+    add_visit(crawl_dir, 0, 2, 'c.onion', 3, status='invalid')
+    write_validation(str(crawl_dir / 'batch-0' / 'url-2'), {'valid': False, 'reason': 'packets'})
+    add_visit(crawl_dir, 0, 3, 'd.onion', 3, status='timeout')
+    write_validation(str(crawl_dir / 'batch-0' / 'url-3'), {'valid': True, 'reason': ''})
+    assert pack_crawl(str(crawl_dir), pack_dir) == 2
+    assert PackedDataset(pack_dir).label_names == ['a.onion', 'd.onion']
+
+
+def test_interrupted_append_is_rolled_back(tmp_path):
+    crawl_dir, pack_dir = tmp_path / 'crawl', str(tmp_path / 'pack')
+    add_visit(crawl_dir, 0, 0, 'a.onion', 3)
+    pack_crawl(str(crawl_dir), pack_dir)
+    # an append that died before meta.json was replaced
+    with open(os.path.join(pack_dir, TRACES_FILE), 'ab') as fp:
+        fp.write(b'\0' * TRACE_DTYPE.itemsize * 7)
+    with open(os.path.join(pack_dir, VISITS_FILE), 'a') as fp:
+        fp.write('batch-0/url-1\n')
+
+    add_visit(crawl_dir, 0, 1, 'b.onion', 4)
+    assert pack_crawl(str(crawl_dir), pack_dir) == 1
+    dataset = PackedDataset(pack_dir)
+    assert len(dataset) == 2
+    assert dataset.packets == 7
+    assert os.path.getsize(os.path.join(pack_dir, TRACES_FILE)) == 7 * TRACE_DTYPE.itemsize
+    assert dataset[1]['size'].tolist() == [2] * 4
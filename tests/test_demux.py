@@ -0,0 +1,62 @@
+import socket
+import struct
+
+from helper.pcaputils import LINKTYPE_RAW, PcapReader
+from models.demux import VisitDemuxer
+
+RELAY, OTHER_RELAY = ('198.51.100.7', 9001), ('198.51.100.8', 443)
+
+
+def make_packet(src, dst, sport, dport):
+    tcp = struct.pack('!HHIIBBHHH', sport, dport, 0, 0, 5 << 4, 0x10, 0, 0, 0)
+    ip = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + len(tcp), 0, 0, 64, 6, 0,
+                     socket.inet_aton(src), socket.inet_aton(dst))
+    return ip + tcp
+
+
+def feed(demuxer, ts, relay, local_port, incoming=False):
+    src, dst, sport, dport = '10.0.0.2', relay[0], local_port, relay[1]
+    if incoming:
+        src, dst, sport, dport = dst, src, dport, sport
+    data = make_packet(src, dst, sport, dport)
+    demuxer.feed(ts, 0, len(data), data)
+
+
+def count_packets(path):
+    with open(path, 'rb') as fp:
+        return sum(1 for _ in PcapReader(fp))
+
+
+def test_visit_keeps_its_connections(tmp_path):
+    demuxer = VisitDemuxer(linktype=LINKTYPE_RAW)
+    pcap_path = str(tmp_path / 'tcp.pcap')
+    segment = demuxer.open_visit(pcap_path, 10 * 10 ** 9, [(RELAY[0], RELAY[1], 40000)])
+    feed(demuxer, 9, RELAY, 40000)                   # before the visit
+    feed(demuxer, 11, RELAY, 40000)
+    feed(demuxer, 12, RELAY, 40000, incoming=True)
+    feed(demuxer, 13, RELAY, 40001)                  # another Tor process, same relay
+    feed(demuxer, 14, OTHER_RELAY, 40002)
+    demuxer.close_visit(segment, 20 * 10 ** 9, grace=0)
+    assert count_packets(pcap_path) == 2
+
+
+def test_visit_follows_new_connections(tmp_path):
+    demuxer = VisitDemuxer(linktype=LINKTYPE_RAW)
+    pcap_path = str(tmp_path / 'tcp.pcap')
+    segment = demuxer.open_visit(pcap_path, 10 * 10 ** 9, [(RELAY[0], RELAY[1], 40000)])
+    feed(demuxer, 11, OTHER_RELAY, 40002)
+    demuxer.add_connections(segment, [(OTHER_RELAY[0], OTHER_RELAY[1], 40002)])
+    feed(demuxer, 12, OTHER_RELAY, 40002, incoming=True)
+    demuxer.close_visit(segment, 20 * 10 ** 9, grace=0)
+    assert count_packets(pcap_path) == 1
+
+
+def test_visit_without_connections_keeps_everything(tmp_path):
+    demuxer = VisitDemuxer(linktype=LINKTYPE_RAW)
+    pcap_path = str(tmp_path / 'tcp.pcap')
+    segment = demuxer.open_visit(pcap_path, 0)
+    demuxer.add_connections(segment, [(RELAY[0], RELAY[1], 40000)])
+    feed(demuxer, 1, RELAY, 40000)
+    feed(demuxer, 2, OTHER_RELAY, 40002)
+    demuxer.close_visit(segment, 10 * 10 ** 9, grace=0)
+    assert count_packets(pcap_path) == 2
@@ -0,0 +1,64 @@
+import os
+
+from models.manifest import MANIFEST_FILENAME, STATUS_OK, Manifest
+
+JOBS = [(0, 0, 'a.onion', 't0'), (0, 1, 'b.onion', 't0'), (1, 0, 'a.onion', 't1'), (1, 1, 'b.onion', 't1')]
+
+
+def record(manifest, job, status=STATUS_OK):
+    batch, index, url, torrc = job
+    manifest.record(batch, index, url, torrc, status, 0.0, 1.0)
+
+
+def test_schedule_roundtrip(tmp_path):
+    manifest = Manifest(str(tmp_path))
+    assert manifest.read_schedule() is None
+    manifest.write_schedule(JOBS)
+    assert manifest.read_schedule() == JOBS
+
+
+def test_pending_jobs(tmp_path):
+    manifest = Manifest(str(tmp_path))
+    record(manifest, JOBS[0])
+    record(manifest, JOBS[1], status='timeout')
+    record(manifest, JOBS[2])
+    assert Manifest(str(tmp_path)).get_pending_jobs(JOBS) == [JOBS[1], JOBS[3]]
+    assert Manifest(str(tmp_path)).get_samples() == {'a.onion': 2}
+
+
+def test_pending_jobs_follow_new_records(tmp_path):
+    manifest = Manifest(str(tmp_path))
+    assert manifest.get_pending_jobs(JOBS) == JOBS
+    record(manifest, JOBS[3])
+    assert manifest.get_pending_jobs(JOBS) == JOBS[:3]
+    assert manifest.get_pending_urls(['a.onion', 'b.onion'], 1) == ['a.onion']
+
+
+def test_repair_drops_torn_line(tmp_path):
+    manifest = Manifest(str(tmp_path))
+    record(manifest, JOBS[0])
+    with open(os.path.join(str(tmp_path), MANIFEST_FILENAME), 'a') as fp:
+        fp.write('{"batch": 0, "index": 1, "url"')  # crash in the middle of a write
+    assert [entry['index'] for entry in manifest.read()] == [0]
+
+    manifest.repair()
+    record(manifest, JOBS[1])
+    assert [entry['index'] for entry in Manifest(str(tmp_path)).read()] == [0, 1]
+    assert Manifest(str(tmp_path)).get_pending_jobs(JOBS) == JOBS[2:]
+
+
+def test_read_from_offset(tmp_path):
+    manifest = Manifest(str(tmp_path))
+    assert manifest.read_from(0) == ([], 0)
+    record(manifest, JOBS[0])
+    entries, offset = manifest.read_from(0)
+    assert [entry['index'] for entry in entries] == [0]
+
+    with open(os.path.join(str(tmp_path), MANIFEST_FILENAME), 'a') as fp:
+        fp.write('{"batch": 0, "index": 1')  # being written by another worker
+    assert manifest.read_from(offset) == ([], offset)
+    with open(os.path.join(str(tmp_path), MANIFEST_FILENAME), 'a') as fp:
+        fp.write(', "url": "b.onion", "torrc": "t0", "status": "ok", "start": 0, "end": 1}\n')
+    entries, offset = manifest.read_from(offset)
+    assert [entry['index'] for entry in entries] == [1]
+    assert manifest.read_from(offset) == ([], offset)
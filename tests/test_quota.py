@@ -0,0 +1,17 @@
+from models.manifest import STATUS_INVALID, STATUS_OK, Manifest
+from models.quota import QuotaScheduler
+
+
+def test_retried_visit_stays_in_flight(tmp_path):
+    manifest = Manifest(str(tmp_path))
+    scheduler = QuotaScheduler(['a.onion'], ['t0'], 1, manifest)
+    job = scheduler.next_job(0.0)
+    assert job == (0, 0, 'a.onion', 't0')
+    manifest.record(*job, STATUS_INVALID, 0.0, 1.0, retried=True)
+    scheduler.collect()
+    assert scheduler.in_flight[('a.onion', None)] == [0.0]
+    assert scheduler.failures[('a.onion', None)] == 0
+    manifest.record(*job, STATUS_OK, 1.0, 2.0)
+    scheduler.collect()
+    assert scheduler.in_flight[('a.onion', None)] == []
+    assert scheduler.ok[('a.onion', None)] == 1
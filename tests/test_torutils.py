@@ -0,0 +1,55 @@
+import pytest
+
+from models.torutils import parse_bootstrap_phase, parse_torrc
+
+
+def test_parse_bootstrap_event():
+    line = 'NOTICE BOOTSTRAP PROGRESS=85 TAG=ap_handshake_done SUMMARY="Handshake finished with a relay"'
+    assert parse_bootstrap_phase(line) == (85, 'ap_handshake_done')
+
+
+def test_parse_bootstrap_done():
+    line = 'NOTICE BOOTSTRAP PROGRESS=100 TAG=done SUMMARY="Done"'
+    assert parse_bootstrap_phase(line) == (100, 'done')
+
+
+def test_parse_bootstrap_missing_fields():
+    assert parse_bootstrap_phase('') == (0, 'unknown')
+    assert parse_bootstrap_phase('NOTICE BOOTSTRAP PROGRESS=5') == (5, 'unknown')
+
+
+def write_torrc(tmp_path, text):
+    path = tmp_path / 'test.torrc'
+    path.write_text(text)
+    return str(path)
+
+
+def test_parse_torrc(tmp_path):
+    path = write_torrc(tmp_path, '''# bridges
+UseBridges 1
+Bridge obfs4 192.0.2.1:443 FINGERPRINT cert=abc iat-mode=0   # first bridge
+Bridge obfs4 192.0.2.2:443 FINGERPRINT cert=def iat-mode=0
+
+ClientTransportPlugin obfs4 exec ./obfs4proxy
+''')
+    assert parse_torrc(path) == {
+        'UseBridges': ['1'],
+        'Bridge': ['obfs4 192.0.2.1:443 FINGERPRINT cert=abc iat-mode=0',
+                   'obfs4 192.0.2.2:443 FINGERPRINT cert=def iat-mode=0'],
+        'ClientTransportPlugin': ['obfs4 exec ./obfs4proxy'],
+    }
+
+
+def test_parse_torrc_tab_separated(tmp_path):
+    path = write_torrc(tmp_path, 'UseBridges\t1\nBridge \t obfs4 192.0.2.1:443 FINGERPRINT\n')
+    assert parse_torrc(path) == {'UseBridges': ['1'], 'Bridge': ['obfs4 192.0.2.1:443 FINGERPRINT']}
+
+
+def test_parse_torrc_keeps_crawler_keys(tmp_path):
+    assert parse_torrc(write_torrc(tmp_path, 'SOCKSPort 9150\n')) == {'SOCKSPort': ['9150']}
+
+
+@pytest.mark.parametrize('line', ['UseBridges', '1 UseBridges', 'Use-Bridges 1'])
+def test_parse_torrc_rejects_malformed_lines(tmp_path, line):
+    with pytest.raises(ValueError, match=':2:'):
+        parse_torrc(write_torrc(tmp_path, 'SafeLogging 1\n' + line + '\n'))
@@ -0,0 +1,70 @@
+import socket
+import struct
+
+import numpy as np
+
+from helper.pcaputils import LINKTYPE_RAW, PcapWriter
+from helper.traceutils import get_trace_path, is_up_to_date, load_trace, pcap_to_trace, save_trace
+
+MY_IP = '10.0.0.2'
+RELAY_IP = '198.51.100.7'
+
+
+def make_packet(src, dst, payload=b''):
+    """Return a raw IPv4/TCP packet (no link layer header) between a client port and a relay port."""
+    sport, dport = (40000, 443) if src == MY_IP else (443, 40000)
+    tcp = struct.pack('!HHIIBBHHH', sport, dport, 0, 0, 5 << 4, 0x18, 0, 0, 0) + payload
+    ip = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + len(tcp), 0, 0, 64, 6, 0,
+                     socket.inet_aton(src), socket.inet_aton(dst))
+    return ip + tcp
+
+
+def write_pcap(path, packets):
+    writer = PcapWriter(str(path), linktype=LINKTYPE_RAW)
+    for ts, data in packets:
+        writer.write(int(ts), int(round(ts % 1 * 1e9)), len(data), data)
+    writer.close()
+
+
+def test_pcap_to_trace(tmp_path):
+    pcap_path = tmp_path / 'tcp.pcap'
+    write_pcap(pcap_path, [
+        (100.0, make_packet(MY_IP, RELAY_IP, b'x' * 10)),
+        (100.5, make_packet(RELAY_IP, MY_IP, b'y' * 500)),
+        (100.75, make_packet('192.0.2.1', '192.0.2.2')),  # not ours
+        (101.0, make_packet(MY_IP, RELAY_IP)),
+    ])
+    trace = pcap_to_trace(str(pcap_path), MY_IP)
+    assert trace['direction'].tolist() == [1, -1, 1]
+    assert trace['size'].tolist() == [50, 540, 40]
+    assert np.allclose(trace['time'], [0, 0.5, 1.0])
+
+
+def test_local_address_from_capture(tmp_path):
+    pcap_path = tmp_path / 'tcp.pcap'
+    write_pcap(pcap_path, [
+        (100.0, make_packet(MY_IP, RELAY_IP)),
+        (100.5, make_packet(RELAY_IP, MY_IP)),
+        (101.0, make_packet(RELAY_IP, MY_IP)),
+    ])
+    expected = pcap_to_trace(str(pcap_path), MY_IP)
+    for my_ip in ('myip', '', None):
+        trace = pcap_to_trace(str(pcap_path), my_ip)
+        assert trace['direction'].tolist() == [1, -1, -1]
+        assert trace.tolist() == expected.tolist()
+
+
+def test_empty_pcap(tmp_path):
+    pcap_path = tmp_path / 'tcp.pcap'
+    write_pcap(pcap_path, [])
+    assert len(pcap_to_trace(str(pcap_path), MY_IP)) == 0
+
+
+def test_save_and_load_trace(tmp_path):
+    pcap_path = tmp_path / 'tcp.pcap'
+    write_pcap(pcap_path, [(5.0, make_packet(RELAY_IP, MY_IP))])
+    assert not is_up_to_date(str(tmp_path))
+    trace = pcap_to_trace(str(pcap_path), MY_IP)
+    save_trace(trace, get_trace_path(str(tmp_path)))
+    assert is_up_to_date(str(tmp_path))
+    assert load_trace(str(tmp_path)).tolist() == trace.tolist()
@@ -0,0 +1,54 @@
+from helper.urlsource import HashRing, UrlSource
+
+URLS = ['http://site{}.onion'.format(i) for i in range(2000)]
+
+
+def write_urls(tmp_path, urls):
+    path = tmp_path / 'urls.txt'
+    path.write_text(''.join(url + '\n' for url in urls))
+    return str(path)
+
+
+def test_ring_is_deterministic():
+    ring = HashRing(['s0', 's1', 's2'])
+    assert [ring.get_server(url) for url in URLS] == [HashRing(['s2', 's1', 's0']).get_server(url) for url in URLS]
+
+
+def test_ring_is_balanced():
+    ring = HashRing(['s0', 's1', 's2', 's3'])
+    counts = {}
+    for url in URLS:
+        server = ring.get_server(url)
+        counts[server] = counts.get(server, 0) + 1
+    assert sorted(counts) == ['s0', 's1', 's2', 's3']
+    assert min(counts.values()) > len(URLS) / 4 * 0.5
+
+
+def test_adding_a_server_only_moves_its_urls():
+    before = HashRing(['s0', 's1', 's2'])
+    after = HashRing(['s0', 's1', 's2', 's3'])
+    for url in URLS:
+        if before.get_server(url) != after.get_server(url):
+            assert after.get_server(url) == 's3'
+    moved = sum(before.get_server(url) != after.get_server(url) for url in URLS)
+    assert 0 < moved < len(URLS) / 2
+
+
+def test_source_reads_urls_back(tmp_path):
+    path = write_urls(tmp_path, ['a.onion', '', 'b.onion', 'c.onion', 'd.onion'])
+    source = UrlSource(path, exclude=['b.onion'])
+    assert len(source) == 3
+    assert list(source) == ['a.onion', 'c.onion', 'd.onion']
+    assert source[1] == 'c.onion'
+    assert source[1:] == ['c.onion', 'd.onion']
+    assert sorted(source.sample(2, seed=1)) == sorted(source.sample(2, seed=1))
+    assert UrlSource(path, limit=2)[:] == ['a.onion', 'b.onion']
+
+
+def test_shards_partition_the_source(tmp_path):
+    path = write_urls(tmp_path, URLS)
+    servers = ['s0', 's1', 's2']
+    ring = HashRing(servers)
+    shards = [list(UrlSource(path, ring=ring, shard=server)) for server in servers]
+    assert sorted(url for shard in shards for url in shard) == sorted(URLS)
+    assert all(ring.get_server(url) == server for server, shard in zip(servers, shards) for url in shard)
@@ -0,0 +1,110 @@
+import signal
+import threading
+import time
+
+import pytest
+
+from helper import utils
+
+
+def busy_wait(seconds):
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        pass
+
+
+def test_deadline_expires():
+    with pytest.raises(utils.TimeExceededError):
+        with utils.deadline(0.2):
+            busy_wait(5)
+
+
+def test_deadline_interrupts_sleep_in_main_thread():
+    start = time.monotonic()
+    with pytest.raises(utils.TimeExceededError):
+        with utils.deadline(0.2):
+            time.sleep(5)
+    assert time.monotonic() - start < 2
+
+
+def test_inner_deadline_fires_first():
+    with utils.deadline(3) as outer:
+        start = time.monotonic()
+        with pytest.raises(utils.TimeExceededError):
+            with utils.deadline(0.2):
+                busy_wait(5)
+        assert time.monotonic() - start < 2
+        assert not utils.has_expired(outer)
+
+
+def test_outer_deadline_survives_inner_one():
+    start = time.monotonic()
+    with pytest.raises(utils.TimeExceededError):
+        with utils.deadline(0.5):
+            with utils.deadline(5):
+                pass
+            busy_wait(5)
+    assert time.monotonic() - start < 2
+
+
+def test_swallowed_error_is_raised_again():
+    fired = []
+    with pytest.raises(utils.TimeExceededError):
+        with utils.deadline(0.2):
+            try:
+                busy_wait(5)
+            except utils.TimeExceededError:
+                fired.append(time.monotonic())
+            busy_wait(utils.WATCHDOG_REFIRE * 3)
+    assert fired
+
+
+def test_cancel_outer_cancels_inner():
+    outer = utils.timeout(0.2)
+    utils.timeout(0.2)
+    utils.cancel_timeout(outer)
+    busy_wait(0.6)  # neither fires
+
+
+def test_stale_alarm_is_ignored():
+    with utils.deadline(5):
+        utils.raise_signal(signal.SIGALRM, None)  # the deadline has not passed
+
+
+def test_cancelled_deadline_is_not_fired():
+    entry = utils.timeout(0)
+    entry[2] = False  # as pop() leaves it before taking the lock
+    busy_wait(0.3)
+    utils.cancel_timeout(entry)
+
+
+def test_deadline_in_a_thread():
+    errors = []
+
+    def task():
+        try:
+            with utils.deadline(0.2):
+                busy_wait(5)
+        except utils.TimeExceededError:
+            errors.append('timeout')
+
+    thread = threading.Thread(target=task)
+    thread.start()
+    thread.join(3)
+    assert errors == ['timeout']
+
+
+def test_run_concurrently():
+    done, killed = [], threading.Event()
+
+    def stubborn():
+        while not killed.is_set():  # swallows the deadline like a call blocked in C
+            try:
+                busy_wait(0.05)
+            except utils.TimeExceededError:
+                pass
+
+    overran = utils.run_concurrently([('quick', lambda: done.append('quick'), None),
+                                      ('stubborn', stubborn, killed.set)], 0.3, grace=2)
+    assert done == ['quick']
+    assert overran == ['stubborn']
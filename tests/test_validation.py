@@ -0,0 +1,82 @@
+import socket
+import struct
+
+from helper.pcaputils import LINKTYPE_RAW, PcapWriter
+from helper.validation import TOR_CELL_LEN, TlsRecordCounter, get_pcap_stats, validate_pcap
+
+LOCAL, RELAY = ('10.0.0.2', 40000), ('198.51.100.7', 9001)
+CELL_RECORD_LEN = TOR_CELL_LEN + 17  # one cell in a TLS 1.3 record
+
+
+def make_record(length=CELL_RECORD_LEN, content_type=23):
+    return struct.pack('!BBBH', content_type, 3, 3, length) + b'\0' * length
+
+
+def make_packet(src, dst, payload):
+    tcp = struct.pack('!HHIIBBHHH', src[1], dst[1], 0, 0, 5 << 4, 0x10, 0, 0, 0)
+    ip = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + len(tcp) + len(payload), 0, 0, 64, 6, 0,
+                     socket.inet_aton(src[0]), socket.inet_aton(dst[0]))
+    return ip + tcp + payload
+
+
+def write_capture(path, packets_in, snaplen=0):
+    writer = PcapWriter(path, snaplen, linktype=LINKTYPE_RAW)
+    writer.write(0, 0, 40, make_packet(LOCAL, RELAY, b''))
+    for i in range(packets_in):
+        data = make_packet(RELAY, LOCAL, make_record())
+        writer.write(1 + i, 0, len(data), data)
+    writer.close()
+    return path
+
+
+def test_counter_follows_records_over_segments():
+    counter = TlsRecordCounter()
+    first, second = make_record(), make_record()
+    payload = first + second
+    counter.add('flow', payload[:600], 600)  # the second record starts in this segment
+    counter.add('flow', payload[600:], len(payload) - 600)
+    assert (counter.records, counter.cell_records, counter.cells) == (2, 2, 2)
+
+
+def test_counter_skips_non_cell_records():
+    counter = TlsRecordCounter()
+    counter.add('flow', make_record(100) + make_record(content_type=99), 110 + CELL_RECORD_LEN)
+    assert (counter.records, counter.cell_records) == (1, 0)
+
+
+def test_valid_capture(tmp_path):
+    validation = validate_pcap(write_capture(str(tmp_path / 'tcp.pcap'), 60), LOCAL[0])
+    assert validation['valid'] and validation['reason'] == ''
+    assert validation['packets'] == 61
+    assert validation['bytes_out'] == 40
+    assert validation['cell_records'] == 60
+
+
+def test_local_address_is_guessed(tmp_path):
+    stats = get_pcap_stats(write_capture(str(tmp_path / 'tcp.pcap'), 3), 'myip')
+    assert stats['bytes_out'] == 40
+
+
+def test_too_few_packets(tmp_path):
+    validation = validate_pcap(write_capture(str(tmp_path / 'tcp.pcap'), 10), LOCAL[0])
+    assert not validation['valid'] and validation['reason'] == 'packets'
+
+
+def test_record_headers_are_enough(tmp_path):
+    # --headers_only keeps the TLS header at the start of each segment
+    validation = validate_pcap(write_capture(str(tmp_path / 'tcp.pcap'), 60, snaplen=128), LOCAL[0])
+    assert validation['valid']
+    assert validation['bytes_in'] == 60 * (40 + 5 + CELL_RECORD_LEN)
+
+
+def test_headers_only_capture(tmp_path):
+    validation = validate_pcap(write_capture(str(tmp_path / 'tcp.pcap'), 60, snaplen=40), LOCAL[0])
+    assert not validation['valid'] and validation['reason'] == 'cell_records'
+    assert validation['cell_records'] == 0
+
+
+def test_unreadable_capture(tmp_path):
+    path = tmp_path / 'tcp.pcap'
+    path.write_bytes(b'not a pcap')
+    validation = validate_pcap(str(path))
+    assert not validation['valid'] and validation['reason'].startswith('unreadable')